@@ -34,21 +34,68 @@ def normalise_path(path):
     return path
 
 
-def page_traffic(raw_traffic):
+class PathNormaliser(object):
+    """Normalises paths with `normalise_path`, remembering the results.
+
+    Most paths recur day after day, so one normaliser should be shared by
+    all the days in a run.  At most max_size raw paths are remembered; when
+    that's reached, the remembered paths are forgotten and it starts again.
+    A normaliser may be shared between threads.
+
+    """
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self._normalised = {}
+
+    def normalise(self, path):
+        """Reduces a given URL to a base path"""
+        return self.normalise_all((path,))[path]
+
+    def normalise_all(self, paths):
+        """Normalise a collection of paths at once.
+
+        Returns a dict from each path to its normalised form (or None, for
+        paths which should be ignored).
+
+        """
+        normalised = self._normalised
+        max_size = self.max_size
+        result = {}
+        for path in paths:
+            base_path = normalised.get(path, _UNSEEN)
+            if base_path is _UNSEEN:
+                if len(normalised) >= max_size:
+                    normalised.clear()
+                base_path = normalised[path] = normalise_path(path)
+            result[path] = base_path
+        return result
+
+
+# Marks a path that a PathNormaliser hasn't seen before.
+_UNSEEN = object()
+
+
+def page_traffic(raw_traffic, normaliser=None):
     """Agregates a number of records in the form:
         [URL, hit_count, is_erroring] to be a
         Counter containing records in the form:
         { "/base_path", total_hit_count }.
         Ignores all records where the url is
         erroring.
+
+        Paths are normalised with the given PathNormaliser, if any, so that
+        it can be shared between calls.
     """
+    if normaliser is None:
+        normaliser = PathNormaliser()
+    base_paths = normaliser.normalise_all(raw_traffic)
     result = Counter()
 
     # Add up traffic to urls which normalise to the same thing.
     for path, (traffic, erroring) in raw_traffic.items():
         if erroring:
             continue
-        path = normalise_path(path)
+        path = base_paths[path]
         if path is None:
             continue
         result[path] += traffic
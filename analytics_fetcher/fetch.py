@@ -1,69 +1,262 @@
-from .analysis import page_traffic
+from .analysis import page_traffic, PathNormaliser
 from .makebulk import page_info_docs
-from .support.ga_client import ClientContext
+from .traffic_table import TrafficTable
+from .support.bulk_writer import BulkWriter, check_compression
+from .support.cache_manager import CacheManager
+from .support.ga_client import (
+    CacheMissError,
+    ClientContext,
+    GAClient,
+    PAGE_SIZE,
+)
+from .support.telemetry import Telemetry
 from .ga import GAData
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
-import json
+import math
 import os
 
 
-def fetch(outfile, days_ago):
+def fetch(outfile, days_ago_buckets, workers=1, qps=1.0, burst=1,
+          cache_days=30, cache_max_bytes=None, compression=None,
+          es_url=None, es_index="page-traffic", es_concurrency=4,
+          rollup=False, page_workers=4, offline=False, batch=False,
+          range_days=None, split_sampled=False, telemetry_json=None,
+          telemetry_prom=None):
     if os.path.exists(outfile):
         raise ValueError("Output file %r already exists" % outfile)
+    # Fail before fetching anything if the output couldn't be written.
+    check_compression(compression)
 
-    with ClientContext(cache_days=30) as client:
-        traffic_by_page = fetch_page_traffic(
-            client,
-            datetime.date.today(),
-            [days_ago],
+    telemetry = None
+    if telemetry_json is not None or telemetry_prom is not None:
+        telemetry = Telemetry()
+
+    # The summary is written even if the run fails, as that's when it's
+    # most needed.
+    try:
+        client_context = ClientContext(
+            cache_days=cache_days,
+            qps=qps,
+            burst=burst,
+            cache_max_bytes=cache_max_bytes,
+            page_workers=page_workers,
+            offline=offline,
+            split_sampled=split_sampled,
+            telemetry=telemetry,
         )
+        today = datetime.date.today()
+        with client_context as client:
+            if offline:
+                # Fail before doing any work if we can't finish.
+                missing = [
+                    day['date'].isoformat()
+                    for day in plan_fetch(client, today, days_ago_buckets)
+                    if not day['cached']
+                ]
+                if missing:
+                    raise CacheMissError(
+                        "Can't work offline: %d days aren't cached: %s" % (
+                            len(missing), ', '.join(missing)))
+            traffic_by_page = fetch_page_traffic(
+                client,
+                today,
+                days_ago_buckets,
+                workers=workers,
+                batch=batch,
+                range_days=range_days,
+            )
+
+        sections = None
+        if rollup:
+            sections = traffic_by_page.section_rollups()
+
+        with BulkWriter(outfile, compression) as writer:
+            writer.write_all(page_info_docs(traffic_by_page, sections))
+
+        if es_url is not None:
+            # Imported here to avoid loading requests unless it's needed.
+            from .support.es_loader import BulkLoader
+            with BulkLoader(es_url, es_index, es_concurrency) as loader:
+                loader.add_all(page_info_docs(traffic_by_page, sections))
+    finally:
+        if telemetry_json is not None:
+            telemetry.write_json(telemetry_json)
+        if telemetry_prom is not None:
+            telemetry.write_prometheus(telemetry_prom)
+
+
+def fetch_day_traffic(ga_client, today, days_ago, normaliser=None):
+    """Fetch the normalised page traffic for the day `days_ago` before today.
+
+    """
+    date = today - datetime.timedelta(days=days_ago)
+    data = GAData(ga_client, date)
+    return page_traffic(data.fetch_traffic_info(), normaliser)
 
-    with open(outfile, "wb") as fobj:
-        for action, data in page_info_docs(traffic_by_page):
-            fobj.write(("%s\n%s\n" % (
-                json.dumps(action, separators=(',', ':')),
-                json.dumps(data, separators=(',', ':'))
-            )).encode('ascii'))
 
+def iter_daily_traffic(ga_client, today, oldest_days_ago, workers=1,
+                       normaliser=None):
+    """Yield (days_ago, traffic) pairs for each day up to oldest_days_ago.
 
-def fetch_page_traffic(ga_client, today, days_ago_buckets):
+    With more than one worker, the days are fetched concurrently, but are
+    still yielded in order of days_ago (each as soon as it and all the days
+    before it have arrived), so that callers see exactly the same sequence as
+    they would when fetching sequentially.
+
+    """
+    all_days_ago = range(1, oldest_days_ago + 1)
+    if workers <= 1:
+        for days_ago in all_days_ago:
+            yield days_ago, fetch_day_traffic(
+                ga_client, today, days_ago, normaliser)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                fetch_day_traffic, ga_client, today, days_ago, normaliser,
+            ): days_ago
+            for days_ago in all_days_ago
+        }
+        try:
+            arrived = {}
+            next_days_ago = 1
+            for future in as_completed(futures):
+                arrived[futures[future]] = future.result()
+                while next_days_ago in arrived:
+                    yield next_days_ago, arrived.pop(next_days_ago)
+                    next_days_ago += 1
+        finally:
+            # Don't start any more requests if we're bailing out early.
+            for future in futures:
+                future.cancel()
+
+
+def fetch_page_traffic(ga_client, today, days_ago_buckets, workers=1,
+                       batch=False, range_days=None):
     """Fetches page traffic for recent time periods.
 
     :param days_ago_buckets: A list of integers representing days_ago to fetch
     data for.  For example, [7, 14, 28] would return data on traffic in the
     last 7 days, the last 14 days, and the last 28 days.
+    :param workers: The number of days to fetch from GA concurrently.  The
+    result is the same whatever the number of workers.
+    :param batch: If True, the first page of results for every day which
+    isn't cached is requested up front, in batched requests.
+    :param range_days: If set, days which aren't cached are fetched up front
+    in queries covering up to this many consecutive days each, and split
+    into the cache entries for each day.
+
+    Each day is fetched once, however many buckets cover it: the days are
+    summed into a running total, most recent first, and each bucket is a
+    snapshot of the running total once all the days in it have been added.
 
-    Returns a dict keyed by path, for which each value is a list of the same
-    length as days_ago_buckets, containing the number of page views in the
-    corresponding date range.
+    Returns a TrafficTable.  This behaves like a dict keyed by path, for
+    which each value is a dict from days_ago to a list of the rank, the
+    number of page views, and the fraction of all page views for the page
+    in that date range.
 
     """
     if today is None:
         today = datetime.date.today()
     oldest_days_ago = max(days_ago_buckets)
-    traffic_buckets = {
-        days_ago: Counter() for days_ago in days_ago_buckets
-    }
-    for days_ago in range(1, oldest_days_ago + 1):
+    queries = [
+        GAData(
+            ga_client, today - datetime.timedelta(days=days_ago),
+        ).traffic_prefetch_query()
+        for days_ago in range(1, oldest_days_ago + 1)
+    ]
+    if range_days:
+        ga_client.prefetch_date_ranges(queries, max_days=range_days)
+    if batch:
+        ga_client.prefetch_first_pages(queries)
+    table = TrafficTable(days_ago_buckets)
+    daily_traffic = iter_daily_traffic(
+        ga_client, today, oldest_days_ago, workers=workers,
+        normaliser=PathNormaliser(),
+    )
+    for days_ago, traffic in daily_traffic:
+        table.add(traffic)
+        if days_ago in days_ago_buckets:
+            table.snapshot(days_ago)
+    table.rank()
+    return table
+
+
+def plan_fetch(ga_client, today, days_ago_buckets):
+    """Work out which days would be served from the cache, and which from GA.
+
+    Only the cache index is consulted; nothing is fetched.
+
+    Returns a list of dicts, one for each day, most recent first, holding:
+
+     - days_ago and date: the day
+     - cached: True iff the day's results are in the cache
+     - rows: the number of rows in the cached results, if known
+     - requests: an estimate of the number of requests to GA needed to fetch
+       the day: 0 if it's cached.  This is based on the size of the cached
+       days; None if there aren't any to go on (at least 1 will be needed).
+
+    """
+    days = []
+    for days_ago in range(1, max(days_ago_buckets) + 1):
         date = today - datetime.timedelta(days=days_ago)
-        data = GAData(ga_client, date)
-        raw_traffic = data.fetch_traffic_info()
-        traffic = page_traffic(raw_traffic)
-        for buckets_days_ago, bucket in list(traffic_buckets.items()):
-            if days_ago <= buckets_days_ago:
-                bucket.update(traffic)
-
-    views_per_day = {
-        days_ago: sum(bucket.values())
-        for days_ago, bucket in list(traffic_buckets.items())
-    }
-
-    traffic_by_page = {}
-    for days_ago, bucket in list(traffic_buckets.items()):
-        ranked = sorted(list(bucket.items()), key=lambda x: x[1], reverse=True)
-        for rank, (page, views) in enumerate(ranked, 1):
-            traffic_by_page.setdefault(page, {})[days_ago] = [
-                rank, views, float(views) / views_per_day[days_ago]
-            ]
-    return traffic_by_page
+        entry = GAData(ga_client, date).traffic_cache_entry()
+        days.append({
+            'days_ago': days_ago,
+            'date': date,
+            'cached': entry['cached'],
+            'rows': entry['rows'],
+        })
+
+    sizes = sorted(day['rows'] for day in days if day['rows'])
+    typical_rows = sizes[len(sizes) // 2] if sizes else None
+    for day in days:
+        if day['cached']:
+            day['requests'] = 0
+        elif typical_rows is None:
+            day['requests'] = None
+        else:
+            day['requests'] = max(1, int(math.ceil(
+                typical_rows / float(PAGE_SIZE))))
+    return days
+
+
+def plan(days_ago_buckets, today=None):
+    """Plan a fetch using the cache, without needing credentials for GA.
+
+    """
+    if today is None:
+        today = datetime.date.today()
+    cache_manager = CacheManager(read_only=True)
+    try:
+        client = GAClient(None, cache_manager, offline=True)
+        return plan_fetch(client, today, days_ago_buckets)
+    finally:
+        cache_manager.close()
+
+
+def format_plan(days):
+    """Format the result of `plan_fetch` as a report, one line per day.
+
+    """
+    lines = []
+    for day in days:
+        if day['cached']:
+            source = "cache: %s rows" % (
+                "?" if day['rows'] is None else day['rows'])
+        elif day['requests'] is None:
+            source = "GA: 1+ requests"
+        else:
+            source = "GA: ~%d requests" % day['requests']
+        lines.append("%4d  %s  %s" % (
+            day['days_ago'], day['date'].isoformat(), source))
+
+    missing = [day for day in days if not day['cached']]
+    requests = sum(day['requests'] or 1 for day in missing)
+    lines.append(
+        "%d of %d days cached; %d days to fetch from GA in about %d "
+        "requests" % (
+            len(days) - len(missing), len(days), len(missing), requests))
+    return "\n".join(lines)
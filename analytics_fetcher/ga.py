@@ -59,12 +59,9 @@ class GAData():
                 item[1] = (item[1] and not_found)
         return result
 
-    def get_traffic_from_api(self):
-        """Searches the Google API for page view data and returns
-            all matching rows.
-        """
-        return self.client.fetch(
-            'search', self.date,
+    def traffic_query(self):
+        """The arguments for the query to fetch page view data."""
+        return dict(
             metrics='ga:uniquePageViews',
             dimensions='ga:pagePath,ga:pageTitle',
             sort='-ga:uniquePageViews',
@@ -74,3 +71,19 @@ class GAData():
                 'pageTitle': 'title',
             },
         )
+
+    def get_traffic_from_api(self):
+        """Searches the Google API for page view data and returns
+            all matching rows.
+        """
+        return self.client.fetch('search', self.date, **self.traffic_query())
+
+    def traffic_prefetch_query(self):
+        """The (profile, date, kwargs) for the query, for prefetching."""
+        return 'search', self.date, self.traffic_query()
+
+    def traffic_cache_entry(self):
+        """Look up the cache entry for the page view data, without fetching.
+        """
+        return self.client.cache_entry(
+            'search', self.date, **self.traffic_query())
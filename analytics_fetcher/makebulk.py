@@ -2,6 +2,11 @@
 
 """
 
+# Section documents share the index (and document type) with page
+# documents, so their IDs are prefixed to keep them apart from the document
+# for the page at the same path.
+SECTION_ID_PREFIX = "section:"
+
 
 def path_components(path):
     """Creates an array with the base path and all given paths.
@@ -14,12 +19,49 @@ def path_components(path):
     return result
 
 
-def page_info_docs(traffic_by_page):
+class PathTrie(object):
+    """Builds path_components for many paths, sharing the prefix strings.
+
+    Paths are added to a trie keyed by path segment, and each node stores
+    the prefix string for the path up to that segment.  So each distinct
+    prefix (eg, "/government") is built once, and the same string object is
+    used in the components of every path under it.
+
+    `components` returns the same result as `path_components`.
+
+    """
+    def __init__(self):
+        # Maps a segment to a tuple of (prefix, children)
+        self._root = {}
+
+    def components(self, path):
+        """Creates an array with the base path and all given paths.
+        """
+        result = []
+        if path.startswith('/'):
+            prefix = ''
+            children = self._root
+            for segment in path.lstrip('/').split('/'):
+                node = children.get(segment)
+                if node is None:
+                    node = children[segment] = (prefix + '/' + segment, {})
+                prefix, children = node
+                result.append(prefix)
+        return result
+
+
+def page_info_docs(traffic_by_page, sections=None):
     """Creates a result set containing two elements.
         First element contains the action details,
         and the second the data details. Both are
         dict's.
 
+        The traffic data may be a TrafficTable, or a dict in the same shape.
+        If section traffic (eg, from `TrafficTable.section_rollups`) is
+        given, a document is produced for each section after the pages, with
+        an ID of the section's path prefixed by SECTION_ID_PREFIX, and a
+        "section" field set to true.
+
         Example traffic data...
         { "/fred": { 1: [1, 10, 0.1] } }
 
@@ -29,16 +71,27 @@ def page_info_docs(traffic_by_page):
         Result: data...
         { "path_components": ["/fred"], "rank_1": 1, "vc_1": 10, "vf_1": 0.1 }
     """
-    for page, info in traffic_by_page.items():
+    trie = PathTrie()
+    for doc in _traffic_docs(traffic_by_page, trie):
+        yield doc
+    if sections is not None:
+        for doc in _traffic_docs(sections, trie, section=True):
+            yield doc
+
+
+def _traffic_docs(traffic, trie, section=False):
+    for path, info in traffic.items():
         action = {
             "index": {
                 "_type": "page-traffic",
-                "_id": page,
+                "_id": SECTION_ID_PREFIX + path if section else path,
             }
         }
         data = {
-            "path_components": path_components(page),
+            "path_components": trie.components(path),
         }
+        if section:
+            data["section"] = True
         for days_ago, (rank, views, views_frac) in list(info.items()):
             data[f"rank_{days_ago}"] = rank
             data[f"vc_{days_ago}"] = views
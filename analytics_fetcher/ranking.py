@@ -0,0 +1,35 @@
+"""Rank pages by their traffic.
+
+Ranking is done in batch over integer arrays: for each window, the view
+counts are sorted once with a stable sort, and the ranks and view fractions
+of every page are computed from that.
+
+Ties are broken by position: of two pages with the same number of views, the
+one which appears first in the window gets the better (lower) rank.  This
+matches a stable sort of the window's items by views, descending.
+
+"""
+
+import numpy as np
+
+
+def rank_counts(counts, total=None):
+    """Rank an array of view counts, highest first.
+
+    Returns a tuple of three arrays:
+
+     - order: the indexes of the counts, sorted by rank
+     - ranks: the rank of each count, starting from 1
+     - fractions: each count divided by total (by default, the sum of all
+       the counts)
+
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    if total is None:
+        total = counts.sum()
+    order = np.argsort(-counts, kind='stable')
+    ranks = np.empty(len(counts), dtype=np.int64)
+    ranks[order] = np.arange(1, len(counts) + 1, dtype=np.int64)
+    fractions = counts / float(total)
+    return order, ranks, fractions
+
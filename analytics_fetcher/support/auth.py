@@ -28,10 +28,8 @@ AuthFileManager context is exited.  ie, if the secrets had been passed in the
 """
 
 from .utils import base64_encode, base64_decode, to_json
-import gapy.client
 import json
 import logging
-import oauth2client.tools
 import os
 import stat
 import tempfile
@@ -126,12 +124,14 @@ def calc_env_var(client_secrets_path):
         return afm.to_env_var()
 
 
-def open_client(afm):
+def open_client(afm, ga_hook=None):
     """
     Open an oauth2client.
 
     :param afm: an AuthFileManager which will be used to lookup the filenames
     needed.
+    :param ga_hook: a function which gapy will call with the arguments of
+    every query made to GA.
     """
 
     # Usually this would be an object that came from
@@ -143,9 +143,14 @@ def open_client(afm):
         auth_host_port = [8080, 8090]
         auth_host_name = 'localhost'
 
+    # Imported here, as the google client libraries are slow to import and
+    # aren't needed unless we actually talk to google.
+    import gapy.client
+
     return gapy.client.from_secrets_file(
         afm.path("client_secrets.json"),
         storage_path=afm.path("storage.json"),
         readonly=True,
         flags=Flags(),
+        ga_hook=ga_hook,
     )
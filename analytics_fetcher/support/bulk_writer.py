@@ -0,0 +1,155 @@
+"""Write documents to a file in Elasticsearch bulk load format.
+
+Each document is written as an action line followed by a data line.  Action
+lines are almost always of the form `{"index":{"_type":...,"_id":...}}`, so
+these are built from a template with only the `_id` serialised per document.
+Output is gathered in a large buffer and encoded and written in big chunks,
+optionally through gzip or zstd compression.
+
+zstd compression requires the `zstandard` package to be installed.
+
+"""
+
+import gzip
+import json
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ('gzip', 'zstd')
+
+
+def check_compression(compression):
+    """Check that a compression is known, and that it can be used.
+
+    Raises ValueError if not, so that callers can fail before doing any work
+    whose output couldn't be written.
+
+    """
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression %r" % (compression,))
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "zstd compression requires the zstandard package")
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class BulkEncoder(object):
+    """Encode (action, data) pairs as the lines of a bulk request.
+
+    """
+    def __init__(self):
+        self._templates = {}
+
+    def action_line(self, action):
+        if len(action) == 1:
+            op, meta = next(iter(action.items()))
+            if isinstance(meta, dict) and list(meta) == ["_type", "_id"]:
+                doc_type = meta["_type"]
+                template = self._templates.get((op, doc_type))
+                if template is None:
+                    template = self._templates[(op, doc_type)] = (
+                        '{%s:{"_type":%s,"_id":' % (
+                            _dumps(op), _dumps(doc_type))
+                    )
+                return template + _dumps(meta["_id"]) + '}}\n'
+        return _dumps(action) + '\n'
+
+    def encode(self, action, data):
+        """Return the action and data lines for a document, as a string.
+
+        """
+        return self.action_line(action) + _dumps(data) + '\n'
+
+
+class BulkWriter(object):
+    """Write (action, data) pairs to a bulk load file.
+
+    Use as a context manager; the file is flushed and closed on exit, and the
+    amount written and time taken are logged.
+
+    :param path: The path to write to.
+    :param compression: None, "gzip" or "zstd".
+    :param buffer_size: The number of characters to gather before writing.
+
+    """
+    def __init__(self, path, compression=None, buffer_size=1 << 20):
+        check_compression(compression)
+        self.path = path
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self._encoder = BulkEncoder()
+        self._pending = []
+        self._pending_size = 0
+
+        # Statistics, for reporting.
+        self.docs = 0
+        self.bytes = 0
+        self.compressed_bytes = None
+        self.seconds = None
+
+    def __enter__(self):
+        self._started = time.time()
+        self._raw = open(self.path, "wb")
+        if self.compression == "gzip":
+            self._fobj = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        elif self.compression == "zstd":
+            import zstandard
+            self._fobj = zstandard.ZstdCompressor().stream_writer(
+                self._raw, closefd=False)
+        else:
+            self._fobj = self._raw
+        return self
+
+    def __exit__(self, exc, value, tb):
+        try:
+            if exc is None:
+                self.flush()
+            if self._fobj is not self._raw:
+                self._fobj.close()
+            self.compressed_bytes = self._raw.tell()
+        finally:
+            self._raw.close()
+        self.seconds = time.time() - self._started
+        if exc is None:
+            logger.info(
+                "Wrote %d documents to %s: %d bytes (%d bytes on disk) "
+                "in %.2fs",
+                self.docs, self.path, self.bytes, self.compressed_bytes,
+                self.seconds,
+            )
+        return False
+
+    def write(self, action, data):
+        """Write a single document.
+
+        """
+        chunk = self._encoder.encode(action, data)
+        self._pending.append(chunk)
+        self._pending_size += len(chunk)
+        self.docs += 1
+        if self._pending_size >= self.buffer_size:
+            self.flush()
+
+    def write_all(self, docs):
+        """Write a sequence of (action, data) pairs.
+
+        """
+        for action, data in docs:
+            self.write(action, data)
+
+    def flush(self):
+        if self._pending:
+            data = ''.join(self._pending).encode('ascii')
+            self._fobj.write(data)
+            self.bytes += len(data)
+            self._pending = []
+            self._pending_size = 0
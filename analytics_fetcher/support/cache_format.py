@@ -0,0 +1,280 @@
+"""Compact columnar format for cached GA results.
+
+Cached results are lists of flat row dicts, with the same few keys in every
+row, and a handful of distinct titles and (across days) heavily repeated
+paths.  Rather than storing each row as a line of JSON, we store:
+
+ - a header: magic bytes and a format version
+ - a string table: every distinct string (column names and string values)
+   once, as a single UTF-8 blob with character offsets
+ - the columns: for each key, its name, type and (if any row lacks the key)
+   a presence mask, followed by the values for every row as a typed array.
+   String values are stored as indexes into the string table.
+ - a footer: the row count, a CRC32 of everything before the footer, and
+   end magic bytes
+
+All integers are little-endian.  Files are read through `mmap`, and the
+columns are decoded in bulk, so reading is dominated by building the row
+dicts rather than parsing.
+
+Rows containing values which aren't strings, ints or floats (or a key whose
+values have mixed types) can't be represented; `encode_rows` returns None
+for them, and the caller should fall back to JSON lines.
+
+"""
+
+from array import array
+import mmap
+import struct
+import sys
+import zlib
+
+
+MAGIC = b'GAC\x00'
+END_MAGIC = b'GACE'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHH')
+_FOOTER = struct.Struct('<QI4s')
+_COUNT = struct.Struct('<I')
+_COLUMN = struct.Struct('<IcB')
+
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+_TYPECODES = {
+    b's': _U32,
+    b'q': 'q',
+    b'd': 'd',
+}
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+_BYTESWAP = sys.byteorder != 'little'
+
+# Marks a key which is absent from a row.
+_MISSING = object()
+
+
+class CacheFormatError(ValueError):
+    pass
+
+
+def _to_bytes(values):
+    if _BYTESWAP:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if _BYTESWAP:
+        values.byteswap()
+    return values
+
+
+def _column_type(values):
+    """Find the storage type for a column, or None if it can't be stored.
+
+    """
+    kinds = set(type(value) for value in values if value is not _MISSING)
+    if kinds == {str}:
+        return b's'
+    if kinds == {int}:
+        if all(
+            _INT64_MIN <= value <= _INT64_MAX
+            for value in values if value is not _MISSING
+        ):
+            return b'q'
+        return None
+    if kinds == {float}:
+        return b'd'
+    return None
+
+
+def encode_rows(rows):
+    """Encode a list of row dicts in the columnar format.
+
+    Returns the encoded bytes, or None if the rows can't be represented.
+
+    """
+    names = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                if not isinstance(name, str):
+                    return None
+                seen.add(name)
+                names.append(name)
+
+    strings = []
+    string_ids = {}
+
+    def intern(value):
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = string_ids[value] = len(strings)
+            strings.append(value)
+        return string_id
+
+    columns = []
+    for name in names:
+        values = [row.get(name, _MISSING) for row in rows]
+        col_type = _column_type(values)
+        if col_type is None:
+            return None
+        if _MISSING in values:
+            mask = array('B', (value is not _MISSING for value in values))
+            filler = '' if col_type == b's' else 0
+            values = [
+                filler if value is _MISSING else value for value in values
+            ]
+        else:
+            mask = None
+        if col_type == b's':
+            values = [intern(value) for value in values]
+        columns.append((intern(name), col_type, mask, values))
+
+    text = ''.join(strings)
+    offsets = [0]
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+    if offsets[-1] > 0xffffffff:
+        return None
+
+    parts = [
+        _HEADER.pack(MAGIC, VERSION, 0),
+        _COUNT.pack(len(strings)),
+        _to_bytes(array(_U32, offsets)),
+    ]
+    try:
+        blob = text.encode('utf-8')
+    except UnicodeEncodeError:
+        # Lone surrogates can't be encoded; JSON escapes them.
+        return None
+    parts.append(_COUNT.pack(len(blob)))
+    parts.append(blob)
+    parts.append(struct.pack('<H', len(columns)))
+    for name_id, col_type, mask, values in columns:
+        parts.append(_COLUMN.pack(name_id, col_type, mask is not None))
+    for name_id, col_type, mask, values in columns:
+        if mask is not None:
+            parts.append(mask.tobytes())
+        parts.append(_to_bytes(array(_TYPECODES[col_type], values)))
+
+    body = b''.join(parts)
+    return body + _FOOTER.pack(len(rows), zlib.crc32(body), END_MAGIC)
+
+
+def is_columnar(prefix):
+    """Check if the leading bytes of a file are those of the columnar format.
+
+    """
+    return prefix[:len(MAGIC)] == MAGIC
+
+
+def _decode_columns(buf):
+    """Decode and validate a buffer in the columnar format.
+
+    Returns a tuple of (row count, list of (name, values, mask) tuples).
+
+    """
+    if len(buf) < _HEADER.size + _FOOTER.size:
+        raise CacheFormatError("Cache file truncated")
+    magic, version, _ = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise CacheFormatError("Not a columnar cache file")
+    if version != VERSION:
+        raise CacheFormatError("Unsupported cache format version %d" % version)
+    footer_pos = len(buf) - _FOOTER.size
+    row_count, checksum, end_magic = _FOOTER.unpack_from(buf, footer_pos)
+    if end_magic != END_MAGIC:
+        raise CacheFormatError("Cache file truncated")
+    with memoryview(buf) as view, view[:footer_pos] as body:
+        if zlib.crc32(body) != checksum:
+            raise CacheFormatError("Cache file checksum mismatch")
+
+    pos = _HEADER.size
+    (string_count,) = _COUNT.unpack_from(buf, pos)
+    pos += _COUNT.size
+    offsets_size = (string_count + 1) * 4
+    offsets = _from_bytes(_U32, buf[pos:pos + offsets_size])
+    pos += offsets_size
+    (blob_size,) = _COUNT.unpack_from(buf, pos)
+    pos += _COUNT.size
+    text = buf[pos:pos + blob_size].decode('utf-8')
+    pos += blob_size
+    strings = [
+        text[offsets[i]:offsets[i + 1]] for i in range(string_count)
+    ]
+
+    (column_count,) = struct.unpack_from('<H', buf, pos)
+    pos += 2
+    specs = []
+    for _ in range(column_count):
+        specs.append(_COLUMN.unpack_from(buf, pos))
+        pos += _COLUMN.size
+
+    columns = []
+    for name_id, col_type, has_mask in specs:
+        mask = None
+        if has_mask:
+            mask = buf[pos:pos + row_count]
+            pos += row_count
+        typecode = _TYPECODES.get(col_type)
+        if typecode is None:
+            raise CacheFormatError("Unknown column type %r" % col_type)
+        size = row_count * array(typecode).itemsize
+        values = _from_bytes(typecode, buf[pos:pos + size]).tolist()
+        pos += size
+        if col_type == b's':
+            values = [strings[value] for value in values]
+        columns.append((strings[name_id], values, mask))
+    if pos != footer_pos:
+        raise CacheFormatError("Cache file has unexpected length")
+    return row_count, columns
+
+
+def _iter_rows(columns):
+    names = [name for name, _, _ in columns]
+    if all(mask is None for _, _, mask in columns):
+        for values in zip(*[values for _, values, _ in columns]):
+            yield dict(zip(names, values))
+        return
+    for row_values in zip(*[
+        [
+            value if mask is None or mask[i] else _MISSING
+            for i, value in enumerate(values)
+        ]
+        for _, values, mask in columns
+    ]):
+        yield {
+            name: value
+            for name, value in zip(names, row_values)
+            if value is not _MISSING
+        }
+
+
+def decode_rows(buf):
+    """Decode a buffer in the columnar format.
+
+    The whole buffer is validated and decoded into columns before returning,
+    so the buffer may be released as soon as this returns.  Returns an
+    iterator of row dicts.
+
+    """
+    row_count, columns = _decode_columns(buf)
+    if not columns:
+        return ({} for _ in range(row_count))
+    return _iter_rows(columns)
+
+
+def read_rows(fobj):
+    """Read rows from a file object opened for binary reading.
+
+    The file is memory mapped, and validated before returning.  Returns an
+    iterator of row dicts.
+
+    """
+    with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return decode_rows(buf)
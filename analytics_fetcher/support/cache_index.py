@@ -0,0 +1,221 @@
+"""An index of the entries in the cache, stored in SQLite.
+
+The index records, for each cache entry, the query it holds results for and
+some metadata about it (the number of rows and bytes, how long it took to
+fetch and the worst sampling rate in it), along with when it was last used.
+It also keeps running totals of cache hits and misses.
+
+This lets us answer questions like "which days in this range have we got
+data for?" without opening any of the cached files.
+
+Cache keys are derived from a canonical form of the query parameters, so
+that logically identical queries always get the same key, however they were
+constructed.
+
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    profile TEXT,
+    date TEXT,
+    query TEXT,
+    rows INTEGER,
+    bytes INTEGER,
+    fetch_seconds REAL,
+    sample_rate REAL,
+    created REAL,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS entries_by_date ON entries (profile, date);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+ENTRY_FIELDS = (
+    'key', 'profile', 'date', 'query', 'rows', 'bytes', 'fetch_seconds',
+    'sample_rate', 'created', 'last_access',
+)
+
+
+def _canonicalise(value):
+    """Convert a value to a form with a single JSON representation.
+
+    """
+    if isinstance(value, dict):
+        return {str(k): _canonicalise(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonicalise(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonicalise(v) for v in value)
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time():
+            return value.date().isoformat()
+        return value.isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def canonical_query(params):
+    """Return the canonical JSON representation of a dict of query params.
+
+    Dict ordering doesn't matter, and dates and datetimes at midnight are
+    treated as equivalent.
+
+    """
+    return json.dumps(
+        _canonicalise(params), sort_keys=True, separators=(',', ':'))
+
+
+def cache_key(query):
+    """Return the cache key for a canonical query.
+
+    """
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def date_str(date):
+    """Format a date, or datetime, as stored in the index.
+
+    """
+    if date is None:
+        return None
+    return date.strftime("%Y-%m-%d")
+
+
+class CacheIndex(object):
+    """The index of a cache directory.
+
+    Safe to use from multiple threads.
+
+    If read_only is set, the database is opened read only (or, if it doesn't
+    exist, an empty one is made in memory), so only the methods which don't
+    update it can be used.
+
+    """
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self._lock = threading.Lock()
+        if not read_only:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+        elif os.path.exists(path):
+            self._db = sqlite3.connect(
+                "file:%s?mode=ro" % pathname2url(path),
+                uri=True, check_same_thread=False)
+        else:
+            self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        # The index is only bookkeeping, so losing the last few updates in a
+        # crash is fine; don't wait for the disk on every update.
+        self._db.execute("PRAGMA synchronous = OFF")
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record_entry(self, key, profile, date, query, rows, size,
+                     fetch_seconds, sample_rate, now):
+        """Record a newly written entry.
+
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, profile, date_str(date), query, rows, size,
+                 fetch_seconds, sample_rate, now, now),
+            )
+
+    def touch(self, key, now):
+        """Record that an entry was used.
+
+        Entries which aren't in the index yet are added, without metadata.
+
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO entries (key, created) VALUES (?, ?)",
+                (key, now),
+            )
+            self._db.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?",
+                (now, key),
+            )
+
+    def remove(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def retain(self, keys):
+        """Remove any entries whose key isn't in keys.
+
+        """
+        keys = set(keys)
+        with self._lock, self._db:
+            stale = [
+                (key,) for (key,) in self._db.execute(
+                    "SELECT key FROM entries")
+                if key not in keys
+            ]
+            self._db.executemany("DELETE FROM entries WHERE key = ?", stale)
+
+    def last_access_times(self):
+        """Return a dict from key to the time the entry was last used.
+
+        """
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT key, last_access FROM entries "
+                "WHERE last_access IS NOT NULL"))
+
+    def entry(self, key):
+        """Return a dict of the metadata for an entry, or None.
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ENTRY_FIELDS, row))
+
+    def entries_between(self, profile, start_date, end_date):
+        """Return metadata for all entries for a profile in a date range.
+
+        The range includes both its ends.
+
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM entries "
+                "WHERE profile = ? AND date >= ? AND date <= ? "
+                "ORDER BY date",
+                (profile, date_str(start_date), date_str(end_date)),
+            ).fetchall()
+        return [dict(zip(ENTRY_FIELDS, row)) for row in rows]
+
+    def increment(self, name, amount=1):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO counters VALUES (?, 0)", (name,))
+            self._db.execute(
+                "UPDATE counters SET value = value + ? WHERE name = ?",
+                (amount, name),
+            )
+
+    def counters(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT name, value FROM counters"))
@@ -1,12 +1,30 @@
 """Simple file-based caching support.
 
+Cached results are stored in the compact columnar format from
+`cache_format`, falling back to one JSON document per line for results which
+that format can't represent.  Files in either format can be read.
+
 """
 
+from analytics_fetcher.support.cache_format import (
+    CacheFormatError,
+    encode_rows,
+    is_columnar,
+    read_rows,
+)
+from analytics_fetcher.support.cache_index import (
+    cache_key,
+    canonical_query,
+    CacheIndex,
+)
+import datetime
 import hashlib
+import inspect
 import json
 import logging
 import os
 import tempfile
+import threading
 import time
 
 
@@ -18,6 +36,14 @@ DEFAULT_CACHE_DIR = os.path.join(
     "cache",
 )
 
+# The index of entries in the cache dir.  Files in the cache dir whose names
+# start with "." are for the manager's own use, and aren't cache entries.
+INDEX_FILENAME = ".index.sqlite3"
+
+
+class ReadOnlyCacheError(Exception):
+    """Raised when trying to change a read only cache."""
+
 
 class AtomicFileCreate(object):
     """A context manager for writing a file atomically.
@@ -27,16 +53,17 @@ class AtomicFileCreate(object):
     deletes
 
     """
-    def __init__(self, dirname, filename):
+    def __init__(self, dirname, filename, mode='w'):
         self.dirname = dirname
         self.filename = filename
+        self.mode = mode
 
     def __enter__(self):
         fd, self.tmppath = tempfile.mkstemp(
             prefix=self.filename + '.tmp_',
             dir=self.dirname,
         )
-        self.fobj = os.fdopen(fd, 'w')
+        self.fobj = os.fdopen(fd, self.mode)
         return self.fobj
 
     def __exit__(self, exc, value, tb):
@@ -51,17 +78,100 @@ class AtomicFileCreate(object):
 class CacheManager(object):
     """A simple manager for cached files.
 
-    Very simple policy: maintains a directory of files.  Any files in the
-    directory which are more than max_age_days old are deleted when `cleanup`
-    is called.
+    Maintains a directory of files, which are tidied up when `cleanup` is
+    called:
+
+     - if max_age_days is set, any files in the directory which are more than
+       max_age_days old are deleted.
+     - if max_bytes is set, the least recently used files are deleted until
+       the files in the directory total no more than max_bytes.
+
+    An index of the entries is kept in an SQLite database in the directory
+    (see `cache_index`).  This records the time each entry was last read or
+    written (rather than relying on filesystem access times, which are often
+    not updated), metadata about the query each entry holds, and counts of
+    cache hits and misses.
+
+    If read_only is set, nothing in the cache dir is changed: entries can be
+    read, but not written or removed, and reads aren't recorded in the index.
 
     """
-    def __init__(self, max_age_days):
+    def __init__(self, max_age_days=None, max_bytes=None, read_only=False):
         self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.read_only = read_only
         self.cache_path = os.environ.get("CACHE_DIR", DEFAULT_CACHE_DIR)
-        if not os.path.isdir(self.cache_path):
+        if not read_only and not os.path.isdir(self.cache_path):
             logger.info("Making cache dir %s", self.cache_path)
             os.makedirs(self.cache_path)
+        self.index = CacheIndex(
+            self._path(INDEX_FILENAME), read_only=read_only)
+        self._lock = threading.Lock()
+        # Hits and misses in this run.  Running totals are kept in the index.
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        """Close the connection to the cache index.
+
+        """
+        self.index.close()
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyCacheError(
+                "Cache dir %s is read only" % self.cache_path)
+
+    def _touch(self, filename):
+        if not self.read_only:
+            self.index.touch(filename, time.time())
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+        if not self.read_only:
+            self.index.increment('hits')
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+        if not self.read_only:
+            self.index.increment('misses')
+
+    def record_entry(self, filename, profile, date, query, rows,
+                     fetch_seconds, sample_rate):
+        """Record metadata about an entry that has just been written.
+
+        """
+        self._check_writable()
+        self.index.record_entry(
+            filename, profile, date, query, rows,
+            os.path.getsize(self._path(filename)),
+            fetch_seconds, sample_rate, time.time(),
+        )
+
+    def coverage(self, profile, start_date, end_date):
+        """Find which days in a date range have entries in the cache.
+
+        Uses only the index; no cached files are opened.
+
+        Returns a dict from each date in the range (including both ends) to a
+        list of dicts of metadata about the entries for that date.
+
+        """
+        if isinstance(start_date, datetime.datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime.datetime):
+            end_date = end_date.date()
+        result = {}
+        date = start_date
+        while date <= end_date:
+            result[date] = []
+            date += datetime.timedelta(days=1)
+        for entry in self.index.entries_between(profile, start_date, end_date):
+            date = datetime.datetime.strptime(entry['date'], "%Y-%m-%d").date()
+            result[date].append(entry)
+        return result
 
     def _path(self, filename):
         return os.path.join(self.cache_path, filename)
@@ -69,46 +179,225 @@ class CacheManager(object):
     def exists(self, filename):
         return os.path.exists(self._path(filename))
 
-    def open_for_read(self, filename):
-        return open(self._path(filename))
+    def open_for_read(self, filename, mode='r'):
+        return open(self._path(filename), mode)
+
+    def atomic_write(self, filename, mode='w'):
+        self._check_writable()
+        return AtomicFileCreate(self.cache_path, filename, mode)
 
-    def atomic_write(self, filename):
-        return AtomicFileCreate(self.cache_path, filename)
+    def rename(self, filename, new_filename):
+        self._check_writable()
+        os.rename(self._path(filename), self._path(new_filename))
+
+    def read_rows(self, filename):
+        """Read a list of rows stored by `write_rows`.
+
+        Returns an iterator of the rows.  Raises CacheFormatError if the file
+        is corrupt; this is raised before any rows are returned.
+
+        """
+        self._touch(filename)
+        with self.open_for_read(filename, 'rb') as fobj:
+            if is_columnar(fobj.read(4)):
+                fobj.seek(0)
+                return read_rows(fobj)
+            fobj.seek(0)
+            try:
+                return iter([json.loads(row) for row in fobj])
+            except ValueError as e:
+                raise CacheFormatError("Corrupt JSON cache file: %s" % e)
+
+    def write_rows(self, filename, rows):
+        """Store a list of rows atomically.
+
+        """
+        data = encode_rows(rows)
+        with self.atomic_write(filename, 'wb') as fobj:
+            if data is not None:
+                fobj.write(data)
+            else:
+                for row in rows:
+                    fobj.write(
+                        (json.dumps(row, separators=(',', ':')) + '\n')
+                        .encode('utf-8')
+                    )
+        self._touch(filename)
+
+    def _entry_names(self):
+        return [
+            filename for filename in os.listdir(self.cache_path)
+            if not filename.startswith('.')
+        ]
+
+    def _entries(self):
+        """List the files in the cache, as (filename, size, mtime) tuples.
+
+        """
+        entries = []
+        for filename in self._entry_names():
+            stat = os.stat(self._path(filename))
+            entries.append((filename, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _remove(self, filename):
+        self._check_writable()
+        os.unlink(self._path(filename))
+        self.index.remove(filename)
 
     def cleanup(self, now=None):
+        self._check_writable()
         if now is None:
             now = time.time()
-        mtime_limit = now - self.max_age_days * 24 * 60 * 60
-        for filename in os.listdir(self.cache_path):
-            path = os.path.join(self.cache_path, filename)
-            mtime = os.stat(path).st_mtime
-            logger.debug("Checking %s; mtime=%s mtime_limit=%s" % (
-                path, mtime, mtime_limit))
-            if mtime < mtime_limit:
-                logger.info("Removing old entry from cache: %s" % (path,))
-                os.unlink(path)
+        entries = self._entries()
+
+        if self.max_age_days is not None:
+            mtime_limit = now - self.max_age_days * 24 * 60 * 60
+            kept = []
+            for filename, size, mtime in entries:
+                logger.debug("Checking %s; mtime=%s mtime_limit=%s" % (
+                    filename, mtime, mtime_limit))
+                if mtime < mtime_limit:
+                    logger.info("Removing old entry from cache: %s" % (
+                        filename,))
+                    self._remove(filename)
+                else:
+                    kept.append((filename, size, mtime))
+            entries = kept
+
+        total_bytes = sum(size for _, size, _ in entries)
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            # Entries we've never seen used are treated as last used when
+            # they were written.
+            access_times = self.index.last_access_times()
+            entries.sort(key=lambda entry: access_times.get(
+                entry[0], entry[2]))
+            while entries and total_bytes > self.max_bytes:
+                filename, size, _ = entries.pop(0)
+                logger.info(
+                    "Evicting least recently used entry from cache: %s "
+                    "(%d bytes)", filename, size)
+                self._remove(filename)
+                total_bytes -= size
+
+        self.index.retain(filename for filename, _, _ in entries)
+        logger.info(
+            "Cache holds %d bytes in %d entries (budget: %s)",
+            total_bytes, len(entries),
+            "none" if self.max_bytes is None else "%d bytes" % self.max_bytes,
+        )
+        logger.info(
+            "Cache hits: %d, misses: %d", self.hits, self.misses)
 
 
 def cached_iterator(fn):
     """Wrap an iterator, serving its results from cache if cached.
 
     Requires that the iterator is a method on an object that has a
-    cache_manager property containing a CacheManager.
+    cache_manager property containing a CacheManager.  If the object also
+    has a telemetry property which isn't None, cache hits and misses are
+    recorded in it too.
+
+    The cache key is derived from a canonical form of the arguments, so any
+    logically identical call hits the same entry.  If the method has
+    `profile_name` and `date` arguments, they're recorded in the cache index
+    with the entry, along with the number of rows, the time taken to fetch
+    them and the worst sampling rate of any row.
+
+    The wrapped method has a `cache_key` attribute, which can be called with
+    the same arguments to find the key of the entry the call would use,
+    without making the call or changing the cache, and a `store` attribute,
+    which can be called with a list of rows and the time taken to fetch them,
+    followed by the same arguments, to store the rows as the results of the
+    call (for results obtained some other way).
 
     """
+    signature = inspect.signature(fn)
+
+    def lookup(self, args, kwargs):
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        del arguments[next(iter(signature.parameters))]
+        query = canonical_query(arguments)
+        return arguments, query, cache_key(query)
+
+    def adopt_legacy(cache_manager, h, args, kwargs):
+        # Entries written before keys were canonical are moved to the key
+        # they now have, or, if the cache is read only, read where they are.
+        # Returns the name of the file holding the entry.
+        if not cache_manager.exists(h):
+            legacy = hashlib.sha1(
+                repr([args, kwargs]).encode('ascii')).hexdigest()
+            if cache_manager.exists(legacy):
+                if cache_manager.read_only:
+                    return legacy
+                cache_manager.rename(legacy, h)
+        return h
+
     def wrapped(self, *args, **kwargs):
-        h = hashlib.sha1(repr([args, kwargs]).encode('ascii')).hexdigest()
-        if self.cache_manager.exists(h):
-            logger.info("Serving GA request from cache")
-            with self.cache_manager.open_for_read(h) as fobj:
-                for row in fobj:
-                    yield json.loads(row)
-            return
+        arguments, query, h = lookup(self, args, kwargs)
+        cache_manager = self.cache_manager
+        filename = adopt_legacy(cache_manager, h, args, kwargs)
+
+        if cache_manager.exists(filename):
+            try:
+                rows = cache_manager.read_rows(filename)
+            except CacheFormatError as e:
+                logger.warning(
+                    "Ignoring unreadable cache entry %s: %s", filename, e)
+            else:
+                logger.info("Serving GA request from cache")
+                cache_manager.record_hit()
+                record_cache(self, True)
+                for row in rows:
+                    yield row
+                return
 
         logger.info("Performing GA request %s", h)
-        with self.cache_manager.atomic_write(h) as fobj:
-            for result in fn(self, *args, **kwargs):
-                fobj.write(json.dumps(result, separators=(',', ':')) + '\n')
-                yield result
+        cache_manager.record_miss()
+        record_cache(self, False)
+        # Only time spent in fn counts as fetching, not time the consumer
+        # spends between results.
+        fetch_seconds = 0.0
+        results = []
+        iterator = fn(self, *args, **kwargs)
+        while True:
+            started = time.time()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                fetch_seconds += time.time() - started
+            results.append(result)
+            yield result
+        save(cache_manager, arguments, query, h, results, fetch_seconds)
+
+    def record_cache(self, hit):
+        telemetry = getattr(self, 'telemetry', None)
+        if telemetry is not None:
+            telemetry.record_cache(hit)
+
+    def save(cache_manager, arguments, query, h, results, fetch_seconds):
+        cache_manager.write_rows(h, results)
+        sample_rates = [
+            row['sampled'] for row in results if row.get('sampled')
+        ]
+        cache_manager.record_entry(
+            h,
+            arguments.get('profile_name'),
+            arguments.get('date'),
+            query,
+            len(results),
+            fetch_seconds,
+            min(sample_rates) if sample_rates else None,
+        )
+
+    def store(self, rows, fetch_seconds, *args, **kwargs):
+        arguments, query, h = lookup(self, args, kwargs)
+        save(self.cache_manager, arguments, query, h, list(rows),
+             fetch_seconds)
 
+    wrapped.cache_key = lambda self, *args, **kwargs: lookup(
+        self, args, kwargs)[2]
+    wrapped.store = store
     return wrapped
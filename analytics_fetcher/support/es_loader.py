@@ -0,0 +1,231 @@
+"""Load documents directly into Elasticsearch with the `_bulk` API.
+
+This is an alternative sink to writing a bulk load file: the (action, data)
+pairs produced by `page_info_docs` are encoded, grouped into chunks of
+limited size, and POSTed to the `_bulk` endpoint of an index.
+
+ - Requests are sent from a small pool of threads over a shared pool of
+   keep-alive connections, with at most `concurrency` requests in flight.
+ - If that many requests are already in flight, adding more documents
+   blocks until one completes, so memory use stays bounded however fast the
+   documents are produced.
+ - Items which Elasticsearch rejects with a retryable status (429, or a 5xx
+   error) are resent after a backoff, as are whole requests which fail.
+   Items rejected for other reasons (eg, mapping errors), and those still
+   failing after the last retry, are logged and counted as failed, and a
+   BulkLoadError is raised on exit if there were any.
+
+"""
+
+from analytics_fetcher.support.bulk_writer import BulkEncoder
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+def _retryable(status):
+    return status == 429 or status >= 500
+
+
+class BulkLoader(object):
+    """Send (action, data) pairs to an Elasticsearch index.
+
+    Use as a context manager; on exit, waits for all requests to complete
+    and logs the number of documents loaded and the rate, then raises
+    BulkLoadError if any documents failed to load.
+
+    :param url: The base URL of the Elasticsearch cluster.
+    :param index: The name of the index to load into.
+    :param concurrency: The maximum number of requests in flight.
+    :param chunk_bytes: The maximum size of a request body (a single
+    document larger than this is sent on its own).
+    :param max_retries: The number of times to resend a failed item.
+
+    """
+    def __init__(self, url, index, concurrency=4, chunk_bytes=5 << 20,
+                 max_retries=5, timeout=60, session=None):
+        self.endpoint = "%s/%s/_bulk" % (url.rstrip("/"), index)
+        self.concurrency = concurrency
+        self.chunk_bytes = chunk_bytes
+        self.max_retries = max_retries
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._encoder = BulkEncoder()
+        self._chunk = []
+        self._chunk_size = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._futures = []
+
+        # Statistics, for reporting.
+        self.docs = 0
+        self.loaded = 0
+        self.failed = 0
+        self.retries = 0
+        self.requests = 0
+        self.seconds = None
+
+    def __enter__(self):
+        self._started = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    def __exit__(self, exc, value, tb):
+        try:
+            if exc is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+        self.seconds = time.time() - self._started
+        if exc is None:
+            for future in self._futures:
+                # Re-raise any unexpected error from a worker.
+                future.result()
+            logger.info(
+                "Loaded %d of %d documents into %s in %.2fs (%.0f docs/s); "
+                "%d failed, %d retries, %d requests",
+                self.loaded, self.docs, self.endpoint, self.seconds,
+                self.docs_per_second, self.failed, self.retries,
+                self.requests,
+            )
+            if self.failed:
+                raise BulkLoadError(
+                    "Failed to load %d of %d documents into %s" % (
+                        self.failed, self.docs, self.endpoint))
+        return False
+
+    @property
+    def docs_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.loaded / self.seconds
+
+    def add(self, action, data):
+        """Queue a single document for loading.
+
+        """
+        doc = self._encoder.encode(action, data).encode("utf-8")
+        if self._chunk and self._chunk_size + len(doc) > self.chunk_bytes:
+            self.flush()
+        self._chunk.append(doc)
+        self._chunk_size += len(doc)
+        self.docs += 1
+
+    def add_all(self, docs):
+        """Queue a sequence of (action, data) pairs for loading.
+
+        """
+        for action, data in docs:
+            self.add(action, data)
+
+    def flush(self):
+        """Send the current chunk, blocking if too many are in flight.
+
+        """
+        if not self._chunk:
+            return
+        chunk = self._chunk
+        self._chunk = []
+        self._chunk_size = 0
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._send_chunk, chunk)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Futures which completed successfully are dropped, so the list
+        # doesn't grow with every chunk; failed ones are kept, so that their
+        # errors are raised on exit.
+        self._futures = [
+            f for f in self._futures
+            if not f.done() or f.exception() is not None
+        ]
+        self._futures.append(future)
+
+    def _post(self, docs):
+        """POST a list of encoded documents.
+
+        Returns a list of the HTTP status for each document.
+
+        """
+        with self._lock:
+            self.requests += 1
+        try:
+            resp = self.session.post(
+                self.endpoint,
+                data=b"".join(docs),
+                headers={"Content-Type": "application/x-ndjson"},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            logger.warning("Bulk request failed: %s", e)
+            return [503] * len(docs)
+        if resp.status_code != 200:
+            logger.warning(
+                "Bulk request failed: %s: %s", resp.status_code,
+                resp.text[:200])
+            return [resp.status_code] * len(docs)
+        body = resp.json()
+        items = body.get("items", [])
+        if len(items) != len(docs):
+            raise BulkLoadError(
+                "Bulk response had %d items for %d documents" % (
+                    len(items), len(docs)))
+        if not body.get("errors"):
+            return [200] * len(docs)
+        statuses = []
+        for item in items:
+            result = next(iter(item.values()))
+            status = result.get("status", 500)
+            if status >= 300 and not _retryable(status):
+                logger.error(
+                    "Failed to load %s: %s", result.get("_id"),
+                    json.dumps(result.get("error")))
+            statuses.append(status)
+        return statuses
+
+    def _send_chunk(self, docs):
+        attempt = 0
+        while docs:
+            statuses = self._post(docs)
+            retry = [
+                doc for doc, status in zip(docs, statuses)
+                if _retryable(status)
+            ]
+            with self._lock:
+                self.loaded += sum(1 for status in statuses if status < 300)
+                self.failed += sum(
+                    1 for status in statuses
+                    if status >= 300 and not _retryable(status))
+            if retry and attempt >= self.max_retries:
+                with self._lock:
+                    self.failed += len(retry)
+                logger.error(
+                    "Giving up on %d documents after %d retries",
+                    len(retry), attempt)
+                return
+            if retry:
+                with self._lock:
+                    self.retries += len(retry)
+                time.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+            docs = retry
+            attempt += 1
@@ -1,40 +1,135 @@
 """Wrap access to GA in a high level client with a "fetch" endpoint.
 
+The google client libraries are slow to import, so they're only imported
+when a request is actually made to GA: a run which is served entirely from
+the cache never loads them.
+
 """
 
-from analytics_fetcher.support.auth import open_client, AuthFileManager
+from analytics_fetcher.support.auth import AuthFileManager
+from analytics_fetcher.support.cache_index import canonical_query
 from analytics_fetcher.support.cache_manager import (
     cached_iterator,
     CacheManager,
 )
-from apiclient.errors import HttpError
+from analytics_fetcher.support.query_slices import (
+    add_filter,
+    initial_slices,
+    sort_rows,
+)
+from analytics_fetcher.support.rate_limiter import RateLimiter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from oauth2client.client import AccessTokenRefreshError
+import collections
+import json
 import logging
 import os
+import threading
 import time
 
 
 logger = logging.getLogger(__name__)
 
+# Reasons given by GA for rejecting a request which mean we should back off
+# and try again.  (dailyLimitExceeded is deliberately absent: retrying won't
+# help with that.)
+RATE_LIMIT_REASONS = frozenset([
+    'rateLimitExceeded',
+    'userRateLimitExceeded',
+    'quotaExceeded',
+])
+
+
+def is_rate_limit_error(error):
+    """Check if an HttpError from GA means that we've been rate limited.
+
+    """
+    status = error.resp.status
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error.content.decode('utf-8'))['error']['errors']
+        return any(e.get('reason') in RATE_LIMIT_REASONS for e in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+# The number of rows to ask GA for in each page of results.
+PAGE_SIZE = 10000
+
+# The name given to the ga:date column when splitting up a query over a
+# range of dates.
+RANGE_DATE_COLUMN = '_range_date'
+
 
 class GAError(Exception):
     pass
 
 
+class CacheMissError(GAError):
+    """Raised when working offline and a query's results aren't cached."""
+
+
+class _SampledData(Exception):
+    """Raised to abandon a query as soon as GA reports it's sampled."""
+
+
 class GAClient(object):
-    def __init__(self, afm, cache_manager):
+    def __init__(self, afm, cache_manager, rate_limiter=None, max_retries=5,
+                 page_workers=4, offline=False, split_sampled=False,
+                 split_ways=4, max_split_depth=4, telemetry=None):
         self.afm = afm
         self.cache_manager = cache_manager
 
+        # If set, a `Telemetry` which records every request made to GA, and
+        # every cache hit and miss.
+        self.telemetry = telemetry
+
+        # If set, a query which GA answers with sampled data is instead
+        # fetched in slices by page path (see `query_slices`), each split
+        # `split_ways` ways, and split again if still sampled, down to paths
+        # prefixes of max_split_depth characters.
+        self.split_sampled = split_sampled
+        self.split_ways = split_ways
+        self.max_split_depth = max_split_depth
+
+        # If set, only serve results from the cache, and raise CacheMissError
+        # for anything which would need a request to GA.
+        self.offline = offline
+
         # A mapping from readable profile names to the profile ID.
         self.profile_ids = {
             'search': 'ga:56562468',
         }
 
-        # Last time that a request was made.  Used to avoid hitting GA too
-        # frequently.
-        self._last_request = time.time()
+        # Used to avoid hitting GA too frequently.  May be shared with other
+        # clients.
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(qps=1.0, burst=1)
+        self.rate_limiter = rate_limiter
+
+        # Number of times to retry a request which GA rejected because we
+        # were going too fast.
+        self.max_retries = max_retries
+
+        # The client may be shared between threads (eg, when fetching several
+        # days concurrently).  The underlying http connection isn't thread
+        # safe, so each thread gets its own oauth client; other shared state
+        # is protected by the lock.
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # Number of pages of a query to fetch concurrently.  Pages are
+        # fetched by a shared pool of threads, created when first needed, so
+        # that their oauth clients are reused across queries.
+        self.page_workers = page_workers
+        self._executor = None
+
+        # First pages of queries fetched in advance by prefetch_first_pages,
+        # keyed by the canonical form of the query's params.
+        self._first_pages = {}
 
         # Worst sampling rate that we've seen.  None if none seen.
         # Callers of the client may reset this to None, and read it.
@@ -44,9 +139,13 @@ class GAClient(object):
         self.ga_latency = timedelta(hours=4)
 
     def oauth_client(self):
-        if getattr(self, '_oauth_client', None) is None:
-            self._oauth_client = open_client(self.afm)
-        return self._oauth_client
+        if getattr(self._local, 'oauth_client', None) is None:
+            from analytics_fetcher.support.auth import open_client
+            ga_hook = None
+            if self.telemetry is not None:
+                ga_hook = self.telemetry.ga_hook
+            self._local.oauth_client = open_client(self.afm, ga_hook=ga_hook)
+        return self._local.oauth_client
 
     def build_ga_params(self, profile_name, date, kwargs):
         """Build parameters for making a call to GA.
@@ -58,19 +157,47 @@ class GAClient(object):
             start_date=ga_date,
             end_date=ga_date,
             samplingLevel="HIGHER_PRECISION",
-            max_results=10000,
+            max_results=PAGE_SIZE,
         )
         params.update(kwargs)
         return params
 
-    def _rate_limit(self):
-        """Rate limit requests by simplest possible means.
+    def _get_raw_response(self, **kwargs):
+        """Make a single rate limited request to GA.
+
+        Requests which GA rejects for exceeding a rate limit or quota are
+        retried, after a backoff, up to max_retries times.
+
+        Returns a tuple of the response and the number of seconds spent
+        waiting for the rate limiter and backing off.
 
         """
-        since = time.time() - self._last_request
-        if since < 1:
-            time.sleep(1.0 - since)
-        self._last_request = time.time()
+        from apiclient.errors import HttpError
+
+        waited = 0.0
+        attempt = 0
+        while True:
+            waited += self.rate_limiter.acquire()
+            started = time.time()
+            try:
+                resp = self.oauth_client().query.get_raw_response(**kwargs)
+            except HttpError as error:
+                if attempt >= self.max_retries or not is_rate_limit_error(error):
+                    raise
+                delay = self.rate_limiter.throttled(attempt)
+                logger.warning(
+                    "GA rate limit exceeded (%s); retrying in %.1fs at %.2f qps",
+                    error.resp.status, delay, self.rate_limiter.rate,
+                )
+                time.sleep(delay)
+                waited += delay
+                attempt += 1
+                continue
+            self.rate_limiter.succeeded()
+            if self.telemetry is not None:
+                self.telemetry.record_request(
+                    kwargs, resp, time.time() - started, waited)
+            return resp, waited
 
     def _check_ga_latency(self, date):
         now = datetime.now()
@@ -82,6 +209,200 @@ class GAClient(object):
                 )
             )
 
+    def _page_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.page_workers)
+            return self._executor
+
+    def close(self):
+        """Stop the threads used for fetching pages concurrently, and drop
+        any prefetched first pages that weren't used.
+
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._first_pages.clear()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _parse_page(self, resp, profile_name, name_map, params):
+        """Convert the rows of a page of GA results to dicts.
+
+        """
+        if resp.get('containsSampledData'):
+            sample_size = int(resp.get('sampleSize', 0))
+            sample_space = int(resp.get('sampleSpace', 1))
+            sample_rate = sample_size * 100.0 / sample_space
+            logger.warning(
+                "GA query in %r profile used sampled data (%.2f%%: %s of %s): params %r",
+                profile_name,
+                sample_rate, sample_size, sample_space,
+                params)
+        else:
+            sample_rate = None
+
+        headers = [
+            name_map.get(header['name'][3:], header['name'][3:])
+            for header in resp['columnHeaders']
+        ]
+        header_types = [
+            {
+                'STRING': str,
+                'INTEGER': int,
+                'PERCENT': float,
+            }[header['dataType']]
+            for header in resp['columnHeaders']
+        ]
+
+        def makerow(row):
+            ret = dict(list(zip(
+                headers,
+                (header_type(value)
+                 for (header_type, value) in zip(header_types, row)))))
+            if 'hour' in ret:
+                hour = int(ret['hour'])
+                ret['hour'] = hour
+            if sample_rate:
+                ret['sampled'] = sample_rate
+            return ret
+
+        return [makerow(row) for row in resp.get('rows', ())]
+
+    def _fetch_pages(self, params):
+        """Yield (start_index, response, waited) for each page of results.
+
+        The first page is fetched on its own, to find out how many results
+        there are.  The remaining pages are then requested concurrently, up
+        to page_workers at a time and subject to the rate limiter, and
+        yielded in order.
+
+        """
+        with self._lock:
+            resp = self._first_pages.pop(canonical_query(params), None)
+        if resp is None:
+            resp, waited = self._get_raw_response(start_index=1, **params)
+        else:
+            waited = 0.0
+        yield 1, resp, waited
+
+        total_results = resp['totalResults']
+        page_size = len(resp.get('rows', ()))
+        if page_size == 0 or page_size >= total_results:
+            return
+
+        start_indexes = range(1 + page_size, total_results + 1, page_size)
+        if self.page_workers <= 1 or len(start_indexes) == 1:
+            for start_index in start_indexes:
+                resp, waited = self._get_raw_response(
+                    start_index=start_index, **params)
+                yield start_index, resp, waited
+            return
+
+        # Only page_workers pages are requested ahead of the one being
+        # consumed, so a slow consumer doesn't leave every page of a large
+        # query waiting in memory.
+        executor = self._page_executor()
+        pending = iter(start_indexes)
+        futures = collections.deque()
+
+        def submit_next():
+            start_index = next(pending, None)
+            if start_index is not None:
+                futures.append((start_index, executor.submit(
+                    self._get_raw_response, start_index=start_index,
+                    **params)))
+
+        for _ in range(self.page_workers):
+            submit_next()
+        try:
+            while futures:
+                start_index, future = futures.popleft()
+                resp, waited = future.result()
+                submit_next()
+                yield start_index, resp, waited
+        finally:
+            for _, future in futures:
+                future.cancel()
+
+    def prefetch_first_pages(self, queries):
+        """Fetch the first pages of several queries in batched requests.
+
+        :param queries: A list of (profile_name, date, kwargs) tuples, where
+        kwargs are the other arguments that will be passed to `fetch`.
+
+        Queries which are already cached, or too recent to fetch, are
+        skipped.  The first pages of the rest are requested in batches, and
+        held until the queries are made with `fetch`.  Any query whose first
+        page couldn't be fetched this way is simply fetched as normal.
+
+        Returns the number of first pages fetched.
+
+        """
+        if self.offline:
+            return 0
+        from apiclient.errors import HttpError
+        from httplib2 import HttpLib2Error
+
+        pending = []
+        for profile_name, date, kwargs in queries:
+            kwargs = dict(kwargs)
+            name_map = kwargs.pop('name_map', None)
+            entry = self.cache_entry(profile_name, date, name_map, **kwargs)
+            if entry['cached']:
+                continue
+            date = self._remove_time_components_from_date(date)
+            try:
+                self._check_ga_latency(date)
+            except RuntimeError:
+                continue
+            pending.append(self.build_ga_params(profile_name, date, kwargs))
+        if not pending:
+            return 0
+
+        fetched = []
+
+        def store(params):
+            def callback(resp, error):
+                if error is not None:
+                    if is_rate_limit_error(error):
+                        self.rate_limiter.throttled(0)
+                    return
+                self.rate_limiter.succeeded()
+                if self.telemetry is not None:
+                    self.telemetry.record_request(
+                        params, resp, time.time() - started, 0.0,
+                        batched=True)
+                with self._lock:
+                    self._first_pages[canonical_query(params)] = resp
+                fetched.append(params)
+            return callback
+
+        batch = self.oauth_client().query.batch()
+        for params in pending:
+            # Each query in a batch counts against GA's rate limits.
+            self.rate_limiter.acquire()
+            batch.get_raw_response(
+                callback=store(params), start_index=1, **params)
+        started = time.time()
+        try:
+            batch.execute()
+        except HttpError as error:
+            logger.warning(
+                "Batched GA request failed (%s); remaining queries will be "
+                "fetched individually", error.resp.status)
+        except (HttpLib2Error, OSError) as error:
+            # Eg, a socket timeout: the batch may have partly succeeded, but
+            # nothing is lost by fetching the rest as normal.
+            logger.warning(
+                "Batched GA request failed (%s); remaining queries will be "
+                "fetched individually", error)
+        logger.info(
+            "Fetched first pages of %d of %d queries in batches",
+            len(fetched), len(pending))
+        return len(fetched)
+
     @cached_iterator
     def _fetch_from_ga(self, profile_name, date, name_map, kwargs):
         """Call GA with the given profile, date and args.
@@ -89,68 +410,105 @@ class GAClient(object):
         Yield an iterator of the result.
 
         """
+        if self.offline:
+            raise CacheMissError(
+                "Results for %r profile on %s aren't cached" % (
+                    profile_name, date.date().isoformat()))
+
         self._check_ga_latency(date)
-        self._rate_limit()
         params = self.build_ga_params(profile_name, date, kwargs)
+        if not self.split_sampled:
+            for row in self._query_ga(profile_name, name_map, params):
+                yield row
+            return
 
         try:
-            start_index = 1
-            while True:
-                resp = self.oauth_client().query.get_raw_response(
-                    start_index=start_index,
-                    **params
-                )
+            rows = list(self._query_ga(
+                profile_name, name_map, params, abandon_if_sampled=True))
+        except _SampledData:
+            rows = self._query_ga_in_slices(profile_name, name_map, params)
+        for row in rows:
+            yield row
 
-                if resp.get('containsSampledData'):
-                    sample_size = int(resp.get('sampleSize', 0))
-                    sample_space = int(resp.get('sampleSpace', 1))
-                    sample_rate = sample_size * 100.0 / sample_space
-                    logger.warning(
-                        "GA query in %r profile used sampled data (%.2f%%: %s of %s): params %r",
-                        profile_name,
-                        sample_rate, sample_size, sample_space,
-                        params)
-                else:
-                    sample_rate = None
-                total_results = resp['totalResults']
-
-                headers = [
-                    name_map.get(header['name'][3:], header['name'][3:])
-                    for header in resp['columnHeaders']
-                ]
-                header_types = [
-                    {
-                        'STRING': str,
-                        'INTEGER': int,
-                        'PERCENT': float,
-                    }[header['dataType']]
-                    for header in resp['columnHeaders']
+    def _query_ga_in_slices(self, profile_name, name_map, params):
+        """Make a query to GA in disjoint slices, to avoid sampling.
+
+        Slices are fetched concurrently, and any slice which is still
+        sampled is split further, until it can't be.  Returns the rows of
+        all the slices, sorted as the query would be.
+
+        """
+        dimension = 'ga:pagePath'
+        logger.info(
+            "Splitting sampled GA query into slices by %s: params %r",
+            dimension, params)
+
+        def fetch_slice(path_slice):
+            splittable = (
+                path_slice.splittable and
+                path_slice.depth < self.max_split_depth
+            )
+            return list(self._query_ga(
+                profile_name, name_map,
+                add_filter(params, path_slice.filters(dimension)),
+                abandon_if_sampled=splittable,
+            ))
+
+        results = []
+        pending = initial_slices(self.split_ways)
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            while pending:
+                futures = [
+                    (path_slice, executor.submit(fetch_slice, path_slice))
+                    for path_slice in pending
                 ]
+                pending = []
+                for path_slice, future in futures:
+                    try:
+                        results.append((path_slice, future.result()))
+                    except _SampledData:
+                        pending.extend(path_slice.split(self.split_ways))
+
+        for path_slice, slice_rows in results:
+            if any(row.get('sampled') for row in slice_rows):
+                logger.error(
+                    "GA data for %s is still sampled, and can't be split "
+                    "any further; caching it sampled: params %r",
+                    path_slice.filters(dimension), params)
+
+        rows = [row for _, rows in results for row in rows]
+        logger.info(
+            "Fetched %d rows in %d slices; %d rows still sampled",
+            len(rows), len(results),
+            sum(1 for row in rows if row.get('sampled')))
+        return sort_rows(rows, params.get('sort'), name_map)
+
+    def _query_ga(self, profile_name, name_map, params,
+                  abandon_if_sampled=False):
+        """Make a query to GA, and yield the rows of the result.
+
+        If abandon_if_sampled is set, raises _SampledData (before yielding
+        any rows) if GA says the result is sampled.
 
-                def makerow(row):
-                    ret = dict(list(zip(
-                        headers,
-                        (header_type(value)
-                         for (header_type, value) in zip(header_types, row)))))
-                    if 'hour' in ret:
-                        hour = int(ret['hour'])
-                        ret['hour'] = hour
-                    if sample_rate:
-                        ret['sampled'] = sample_rate
-                    return ret
-
-                rows = resp.get('rows', ())
+        """
+        from apiclient.errors import HttpError
+        from oauth2client.client import AccessTokenRefreshError
+
+        try:
+            fetched = 0
+            waited = 0.0
+            for start_index, resp, page_waited in self._fetch_pages(params):
+                waited += page_waited
+                if abandon_if_sampled and resp.get('containsSampledData'):
+                    raise _SampledData()
+                rows = self._parse_page(resp, profile_name, name_map, params)
+                fetched = start_index - 1 + len(rows)
                 for row in rows:
-                    start_index += 1
-                    row = makerow(row)
-                    if row is not None:
-                        yield row
+                    yield row
                 logger.info(
-                    "Fetched %d of %d rows", start_index - 1, total_results
+                    "Fetched %d of %d rows (%.1fs waiting for rate limit)",
+                    fetched, resp['totalResults'], waited,
                 )
-
-                if start_index > total_results:
-                    return
         except AccessTokenRefreshError:
             logger.exception(
                 "Credentials error fetching data from GA",
@@ -163,10 +521,160 @@ class GAClient(object):
             )
             raise GAError("HTTP error fetching data from GA")
 
+    def prefetch_date_ranges(self, queries, max_days=31):
+        """Fill the cache for several days using queries over date ranges.
+
+        :param queries: A list of (profile_name, date, kwargs) tuples, where
+        kwargs are the other arguments that will be passed to `fetch`.
+        :param max_days: The most days to cover in a single query.
+
+        Days which are already cached, or too recent to fetch, are skipped.
+        The rest are grouped into runs of consecutive days with the same
+        query, and each run is fetched in a single GA query with `ga:date`
+        added as a dimension.  The rows are split up by date, and stored in
+        the cache as if each day had been fetched on its own, so `fetch`
+        then serves them from the cache.
+
+        GA is more likely to sample the results of a query over a range of
+        days than over a single day.  If it does, the rest of the run is
+        abandoned, and its days left uncached, to be fetched one at a time by
+        `fetch` (which will split them up further if `split_sampled` is set).
+
+        Returns the number of days fetched.
+
+        """
+        if self.offline:
+            return 0
+
+        runs = []
+        for profile_name, date, kwargs in sorted(
+                queries, key=lambda query: query[1]):
+            kwargs = dict(kwargs)
+            name_map = kwargs.pop('name_map', None) or {}
+            date = self._remove_time_components_from_date(date)
+            if 'ga:date' in kwargs.get('dimensions', '').split(','):
+                raise ValueError(
+                    "Can't split a query by date if it has a ga:date "
+                    "dimension")
+            if self.cache_entry(
+                    profile_name, date, name_map, **kwargs)['cached']:
+                continue
+            try:
+                self._check_ga_latency(date)
+            except RuntimeError:
+                continue
+            spec = canonical_query([profile_name, name_map, kwargs])
+            if (
+                runs and runs[-1]['spec'] == spec and
+                runs[-1]['dates'][-1] + timedelta(days=1) == date and
+                len(runs[-1]['dates']) < max_days
+            ):
+                runs[-1]['dates'].append(date)
+            else:
+                runs.append({
+                    'spec': spec,
+                    'profile_name': profile_name,
+                    'name_map': name_map,
+                    'kwargs': kwargs,
+                    'dates': [date],
+                })
+
+        fetched = 0
+        for run in runs:
+            fetched += self._fetch_date_range(
+                run['profile_name'], run['dates'], run['name_map'],
+                run['kwargs'])
+        return fetched
+
+    def _fetch_date_range(self, profile_name, dates, name_map, kwargs):
+        """Fetch a run of consecutive days in one query, and cache each day.
+
+        The results are sorted by date first, so each day's rows can be
+        stored as soon as the next day's start, rather than holding the
+        whole range in memory.  If GA sampled the results, the remaining
+        days are left uncached; those already stored came from pages which
+        weren't sampled.
+
+        Returns the number of days cached.
+
+        """
+        params = self.build_ga_params(profile_name, dates[0], kwargs)
+        params['end_date'] = dates[-1].strftime("%Y-%m-%d")
+        params['dimensions'] = ','.join(
+            ['ga:date'] + [d for d in kwargs.get('dimensions', '').split(',')
+                           if d])
+        params['sort'] = ','.join(
+            ['ga:date'] + [s for s in kwargs.get('sort', '').split(',') if s])
+        # The date column gets a name which can't clash with the others.
+        range_name_map = dict(name_map, date=RANGE_DATE_COLUMN)
+        stored = set()
+        last_stored = [time.time()]
+
+        def store(date_str, rows):
+            # Each day is charged the time since the previous one was stored.
+            now = time.time()
+            date = datetime.strptime(date_str, "%Y%m%d")
+            self._fetch_from_ga.store(
+                self, rows, now - last_stored[0], profile_name, date,
+                name_map, kwargs)
+            stored.add(date_str)
+            last_stored[0] = now
+
+        logger.info(
+            "Fetching %d days from %s to %s in one GA query",
+            len(dates), params['start_date'], params['end_date'])
+        current, day_rows = None, []
+        try:
+            for row in self._query_ga(
+                    profile_name, range_name_map, params,
+                    abandon_if_sampled=True):
+                date_str = row.pop(RANGE_DATE_COLUMN)
+                if date_str != current:
+                    if current is not None:
+                        store(current, day_rows)
+                    current, day_rows = date_str, []
+                day_rows.append(row)
+        except _SampledData:
+            logger.warning(
+                "GA sampled the query for %s to %s; fetching %d of its days "
+                "individually", params['start_date'], params['end_date'],
+                len(dates) - len(stored))
+            return len(stored)
+        if current is not None:
+            store(current, day_rows)
+
+        # Days with no rows at all.
+        for date in dates:
+            date_str = date.strftime("%Y%m%d")
+            if date_str not in stored:
+                store(date_str, [])
+        return len(stored)
+
     @staticmethod
     def _remove_time_components_from_date(date):
         return datetime(year=date.year, month=date.month, day=date.day)
 
+    def cache_entry(self, profile_name, date, name_map=None, **kwargs):
+        """Look up the cache entry that `fetch` would use, without fetching.
+
+        Takes the same arguments as `fetch`.  Returns a dict holding the
+        cache `key`, whether the entry is `cached`, and the number of `rows`
+        in it, if known from the cache index.
+
+        """
+        if name_map is None:
+            name_map = {}
+        date = self._remove_time_components_from_date(date)
+        key = self._fetch_from_ga.cache_key(
+            self, profile_name, date, name_map, kwargs)
+        cached = self.cache_manager.exists(key)
+        entry = self.cache_manager.index.entry(key) if cached else None
+        return {
+            'key': key,
+            'cached': cached,
+            'rows': entry['rows'] if entry else None,
+        }
+
     def fetch(self, profile_name, date, name_map=None, **kwargs):
         """Fetch some metrics.
 
@@ -195,30 +703,66 @@ class GAClient(object):
 
         for row in self._fetch_from_ga(profile_name, date, name_map, kwargs):
             sample_rate = row.get('sampled')
-            if (
-                self.worst_sample_rate is None or
-                sample_rate is None or
-                self.worst_sample_rate > sample_rate
-            ):
-                self.worst_sample_rate = sample_rate
+            with self._lock:
+                if (
+                    self.worst_sample_rate is None or
+                    sample_rate is None or
+                    self.worst_sample_rate > sample_rate
+                ):
+                    self.worst_sample_rate = sample_rate
             yield row
 
 
 class ClientContext(object):
-    def __init__(self, cache_days):
+    """Set up a GAClient, and tidy up the cache once it's been used.
+
+    If offline is set, no credentials are needed (or read from GAAUTH), and
+    the client only serves results from the cache, which is opened read only.
+
+    """
+    def __init__(self, cache_days, qps=1.0, burst=1, cache_max_bytes=None,
+                 page_workers=4, offline=False, split_sampled=False,
+                 telemetry=None):
         self.cache_days = cache_days
+        self.cache_max_bytes = cache_max_bytes
+        self.page_workers = page_workers
+        self.offline = offline
+        self.split_sampled = split_sampled
+        self.telemetry = telemetry
+        self.rate_limiter = RateLimiter(qps=qps, burst=burst)
         self.afm = None
         self.cache_manager = None
+        self.client = None
 
     def __enter__(self):
         assert self.afm is None
         assert self.cache_manager is None
-        self.afm = AuthFileManager()
-        self.afm.__enter__()
-        self.afm.from_env_var(os.environ["GAAUTH"])
-        self.cache_manager = CacheManager(self.cache_days)
-        return GAClient(self.afm, self.cache_manager)
+        if not self.offline:
+            self.afm = AuthFileManager()
+            self.afm.__enter__()
+            self.afm.from_env_var(os.environ["GAAUTH"])
+        self.cache_manager = CacheManager(
+            self.cache_days, max_bytes=self.cache_max_bytes,
+            read_only=self.offline,
+        )
+        self.client = GAClient(
+            self.afm, self.cache_manager, self.rate_limiter,
+            page_workers=self.page_workers, offline=self.offline,
+            split_sampled=self.split_sampled, telemetry=self.telemetry,
+        )
+        return self.client
 
     def __exit__(self, exc, value, tb):
-        self.cache_manager.cleanup()
-        return self.afm.__exit__(exc, value, tb)
+        self.client.close()
+        logger.info(
+            "Made %d GA requests; %.1fs spent waiting for rate limit",
+            self.rate_limiter.requests, self.rate_limiter.total_wait,
+        )
+        # When offline, the cache may be a copy we're replaying, so it's
+        # left as it is.
+        if not self.offline:
+            self.cache_manager.cleanup()
+        self.cache_manager.close()
+        if self.afm is not None:
+            return self.afm.__exit__(exc, value, tb)
+        return False
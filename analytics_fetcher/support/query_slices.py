@@ -0,0 +1,187 @@
+"""Split a GA query into disjoint slices by path prefix.
+
+When GA samples the results of a query, asking for smaller parts of the data
+separately often avoids sampling.  For page-level metrics, a query can be
+split into slices by adding a filter on the page path; as long as the
+slices are disjoint and together cover every path, the rows of the slices
+together are exactly the rows of the whole query.
+
+A slice is a path prefix, plus a set of characters (from `ALPHABET`) which
+the path must continue with.  For example, the slice ("/", "abc") covers
+every path starting with "/a", "/b" or "/c".  Every prefix also has a
+remainder slice, covering paths which start with the prefix but don't
+continue with a character from the alphabet (including the prefix itself).
+Splitting a slice with several characters gives a slice for each group of
+them; splitting a single character slice gives slices for the next
+character of the path.  One more slice covers any paths which don't start
+with "/".
+
+GA matches regular expressions case insensitively, so the letters in the
+alphabet also cover upper case letters.  The alphabet includes the digits
+and the punctuation common in paths, so that few paths are left in
+remainder slices, which can't be split any further.
+
+"""
+
+import string
+
+
+ALPHABET = string.ascii_lowercase + string.digits + "-_./%"
+
+# Characters with a special meaning in a regular expression, or in a GA
+# filter expression (where "," and ";" separate filters).
+_SPECIAL = set("\\.^$*+?()[]{}|,;")
+# Characters with a special meaning in a regular expression character class.
+_CLASS_SPECIAL = set("\\]^-,;")
+
+
+def escape(text):
+    """Escape text for use in a GA filter regular expression.
+
+    """
+    return "".join(
+        "\\" + char if char in _SPECIAL else char for char in text)
+
+
+def char_class(chars):
+    """A regular expression character class matching any of chars.
+
+    Runs of consecutive letters or digits are written as ranges, to keep
+    the expression short (GA limits the length of filter expressions).
+
+    """
+    parts = []
+    start = 0
+    while start < len(chars):
+        end = start
+        while (
+            end + 1 < len(chars) and
+            chars[end].isalnum() and chars[end + 1].isalnum() and
+            ord(chars[end + 1]) == ord(chars[end]) + 1
+        ):
+            end += 1
+        if end - start >= 2:
+            parts.append("%s-%s" % (chars[start], chars[end]))
+        else:
+            parts.extend(
+                "\\" + char if char in _CLASS_SPECIAL else char
+                for char in chars[start:end + 1])
+        start = end + 1
+    return "[%s]" % "".join(parts)
+
+
+class PathSlice(object):
+    """A set of paths, defined by a prefix and the characters that follow it.
+
+    :param prefix: The path prefix.
+    :param letters: The characters which may follow the prefix, or None for
+    the remainder slice: paths which start with the prefix, but don't
+    continue with a character from the alphabet.  A prefix of None stands
+    for paths which don't start with "/".
+
+    """
+    def __init__(self, prefix, letters):
+        self.prefix = prefix
+        self.letters = letters
+
+    def __repr__(self):
+        return "PathSlice(%r, %r)" % (self.prefix, self.letters)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, PathSlice) and
+            (self.prefix, self.letters) == (other.prefix, other.letters)
+        )
+
+    def __hash__(self):
+        return hash((self.prefix, self.letters))
+
+    @property
+    def depth(self):
+        return len(self.prefix or '')
+
+    @property
+    def splittable(self):
+        return self.letters is not None
+
+    def filters(self, dimension):
+        """The GA filter expression selecting the paths in the slice.
+
+        """
+        if self.prefix is None:
+            return "%s!~^/" % dimension
+        prefix = escape(self.prefix)
+        if self.letters is None:
+            return "%s=~^%s;%s!~^%s%s" % (
+                dimension, prefix, dimension, prefix, char_class(ALPHABET))
+        return "%s=~^%s%s" % (dimension, prefix, char_class(self.letters))
+
+    def split(self, ways):
+        """Split the slice into smaller disjoint slices which cover it.
+
+        """
+        if self.letters is None:
+            raise ValueError("Can't split a remainder slice")
+        if len(self.letters) > 1:
+            return [
+                PathSlice(self.prefix, letters)
+                for letters in _groups(self.letters, ways)
+            ]
+        return top_slices(self.prefix + self.letters, ways)
+
+
+def _groups(letters, ways):
+    size = -(-len(letters) // ways)
+    return [
+        letters[start:start + size]
+        for start in range(0, len(letters), size)
+    ]
+
+
+def initial_slices(ways):
+    """Split all paths into about `ways` slices.
+
+    """
+    return top_slices('/', ways) + [PathSlice(None, None)]
+
+
+def top_slices(prefix, ways):
+    """Split all the paths starting with prefix into about `ways` slices.
+
+    """
+    return [
+        PathSlice(prefix, letters) for letters in _groups(ALPHABET, ways)
+    ] + [PathSlice(prefix, None)]
+
+
+def add_filter(params, filters):
+    """Return a copy of GA query params, with an extra filter ANDed in.
+
+    """
+    params = dict(params)
+    if params.get('filters'):
+        params['filters'] = "%s;%s" % (params['filters'], filters)
+    else:
+        params['filters'] = filters
+    return params
+
+
+def sort_rows(rows, sort, name_map):
+    """Sort rows as GA would for a sort parameter such as '-ga:views'.
+
+    The sort is stable, so rows which compare equal keep their order.  For
+    the merged rows of several slices, that's the order of the slices, so
+    rows which tie on the sort fields may come in a different order from
+    the rows of a single unsplit query.
+
+    """
+    if not sort:
+        return rows
+    for field in reversed(sort.split(',')):
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        if name.startswith('ga:'):
+            name = name[3:]
+        column = name_map.get(name, name)
+        rows.sort(key=lambda row: row[column], reverse=descending)
+    return rows
@@ -0,0 +1,106 @@
+"""A token bucket rate limiter which can be shared between threads.
+
+The limiter allows up to `burst` requests to be made immediately, and then
+refills at `qps` requests per second.  Callers reserve a token by calling
+`acquire`, which sleeps until their reservation is due and returns the number
+of seconds waited.
+
+When the server tells us we're going too fast, call `throttled` to halve the
+current rate and get a jittered exponential backoff delay to wait before
+retrying.  Each subsequent successful request (reported by calling
+`succeeded`) recovers the rate a little, until it's back to the configured
+`qps`.
+
+"""
+
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket with adaptive rate.
+
+    :param qps: The maximum sustained number of requests per second.
+    :param burst: The number of requests which may be made without waiting.
+    :param min_qps: The lowest rate that throttling will reduce us to.
+    :param max_backoff: The longest delay, in seconds, returned by `throttled`.
+
+    """
+    def __init__(self, qps=1.0, burst=1, min_qps=0.05, max_backoff=64.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        if qps <= 0:
+            raise ValueError("qps must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.qps = qps
+        self.burst = burst
+        self.min_qps = min(min_qps, qps)
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._rate = float(qps)
+        self._tokens = float(burst)
+        self._updated = clock()
+
+        # Statistics, for reporting.
+        self.requests = 0
+        self.total_wait = 0.0
+        self.throttles = 0
+
+    @property
+    def rate(self):
+        """The current permitted rate, in requests per second."""
+        return self._rate
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(
+            float(self.burst),
+            self._tokens + elapsed * self._rate,
+        )
+
+    def acquire(self):
+        """Wait until a request may be made.
+
+        Returns the number of seconds that the caller waited.
+
+        """
+        with self._lock:
+            self._refill(self._clock())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                wait = 0.0
+            else:
+                # The token is reserved: it'll be ours once the bucket has
+                # refilled past zero.
+                wait = -self._tokens / self._rate
+            self.requests += 1
+            self.total_wait += wait
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def throttled(self, attempt):
+        """Record that the server rejected a request for going too fast.
+
+        Halves the current rate, and returns the number of seconds to wait
+        before retrying, for the given (zero based) retry attempt.  The
+        delay is chosen uniformly at random up to an exponentially growing
+        limit, so that concurrent callers don't retry in lockstep.
+
+        """
+        with self._lock:
+            self._refill(self._clock())
+            self._rate = max(self.min_qps, self._rate / 2)
+            self.throttles += 1
+        return random.uniform(0, min(self.max_backoff, 2.0 ** attempt))
+
+    def succeeded(self):
+        """Record a successful request, recovering some of the lost rate."""
+        with self._lock:
+            if self._rate < self.qps:
+                self._refill(self._clock())
+                self._rate = min(self.qps, self._rate + self.qps / 10.0)
@@ -0,0 +1,218 @@
+"""Collect statistics about the requests made to GA during a run.
+
+A `Telemetry` object is given to a `GAClient`, which records each response
+it gets from GA in it: how long the request took, how long was spent
+waiting for the rate limiter, the size of the response, and how many rows
+it held.  Its `ga_hook` is also passed to gapy, which calls it for every
+request made (including failed and retried requests, and those sent in
+batches), and the cache records hits and misses in it.
+
+At the end of a run, a summary can be written as JSON (including a record
+of every request), or in the Prometheus textfile format (totals and latency
+quantiles only), for the node exporter's textfile collector to pick up.
+
+"""
+
+from datetime import datetime
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+
+# The prefix for the names of the Prometheus metrics.
+METRIC_PREFIX = "search_analytics_fetch"
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def quantile(values, q):
+    """The q-quantile of a sorted list of values (nearest rank).
+
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))
+    return values[index]
+
+
+class Telemetry(object):
+    """A thread-safe collector of statistics about GA requests.
+
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+        self.ga_calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.requests = []
+
+    def ga_hook(self, kwargs):
+        """Called by gapy each time it makes a request to GA.
+
+        """
+        with self._lock:
+            self.ga_calls += 1
+
+    def record_cache(self, hit):
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def record_request(self, params, resp, seconds, waited, batched=False):
+        """Record a response received from GA.
+
+        :param params: The params the request was made with.
+        :param resp: The decoded response.
+        :param seconds: The time taken by the request, excluding any waiting
+        for the rate limiter.
+        :param waited: The time spent waiting for the rate limiter, and
+        backing off after being rate limited.
+        :param batched: True if the request was sent in a batch, in which
+        case seconds is the time until the whole batch completed.
+
+        """
+        record = {
+            'start_date': params.get('start_date'),
+            'end_date': params.get('end_date'),
+            'start_index': int(params.get('start_index', 1)),
+            'filters': params.get('filters'),
+            'seconds': seconds,
+            'rate_limit_wait': waited,
+            # The size of the response, re-encoded as compact JSON; near
+            # enough to the size of the (decompressed) body sent by GA.
+            'bytes': len(json.dumps(resp, separators=(',', ':'))),
+            'rows': len(resp.get('rows', ())),
+            'total_results': resp.get('totalResults'),
+            'sampled': bool(resp.get('containsSampledData')),
+            'batched': batched,
+        }
+        with self._lock:
+            self.requests.append(record)
+
+    def summary(self):
+        """Summarise the run so far, as a dict.
+
+        """
+        with self._lock:
+            requests = list(self.requests)
+            totals = {
+                'run_seconds': self._clock() - self.started,
+                'ga_calls': self.ga_calls,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+            }
+        latencies = sorted(request['seconds'] for request in requests)
+        totals.update({
+            'requests': len(requests),
+            'batched_requests': sum(
+                1 for request in requests if request['batched']),
+            'queries': sum(
+                1 for request in requests if request['start_index'] == 1),
+            'sampled_requests': sum(
+                1 for request in requests if request['sampled']),
+            'rows': sum(request['rows'] for request in requests),
+            'bytes': sum(request['bytes'] for request in requests),
+            'request_seconds': sum(latencies),
+            'rate_limit_wait_seconds': sum(
+                request['rate_limit_wait'] for request in requests),
+        })
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'totals': totals,
+            'latency_seconds': dict(
+                [('max', latencies[-1] if latencies else None)] +
+                [('p%d' % round(q * 100), quantile(latencies, q))
+                 for q in LATENCY_QUANTILES]
+            ),
+            'requests': requests,
+        }
+
+    def write_json(self, path):
+        """Write the summary, with a record of each request, as JSON.
+
+        """
+        _write_atomically(
+            path, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n")
+
+    def write_prometheus(self, path):
+        """Write the summary in the Prometheus textfile format.
+
+        """
+        _write_atomically(path, format_prometheus(self.summary()))
+
+
+# The totals exported to Prometheus, with their help text.
+PROMETHEUS_METRICS = [
+    ('run_seconds', "Wall clock time of the fetch run."),
+    ('ga_calls', "Requests made to GA, including failures and retries."),
+    ('requests', "Responses received from GA."),
+    ('batched_requests', "Responses received in batched requests."),
+    ('queries', "Queries made to GA (first pages)."),
+    ('sampled_requests', "Responses from GA which held sampled data."),
+    ('rows', "Rows received from GA."),
+    ('bytes', "Bytes of JSON received from GA."),
+    ('request_seconds', "Total time spent in requests to GA."),
+    ('rate_limit_wait_seconds',
+     "Total time spent waiting for the GA rate limit."),
+    ('cache_hits', "GA queries served from the cache."),
+    ('cache_misses', "GA queries not found in the cache."),
+]
+
+
+def format_prometheus(summary):
+    """Format a summary from `Telemetry.summary` as Prometheus metrics.
+
+    """
+    lines = []
+    totals = summary['totals']
+    for name, help_text in PROMETHEUS_METRICS:
+        metric = "%s_%s" % (METRIC_PREFIX, name)
+        lines.extend([
+            "# HELP %s %s" % (metric, help_text),
+            "# TYPE %s gauge" % metric,
+            "%s %s" % (metric, _format_value(totals[name])),
+        ])
+
+    metric = "%s_request_latency_seconds" % METRIC_PREFIX
+    lines.extend([
+        "# HELP %s Latency of requests to GA." % metric,
+        "# TYPE %s summary" % metric,
+    ])
+    for q in LATENCY_QUANTILES:
+        value = summary['latency_seconds']['p%d' % round(q * 100)]
+        lines.append('%s{quantile="%s"} %s' % (
+            metric, q, "NaN" if value is None else _format_value(value)))
+    lines.extend([
+        "%s_sum %s" % (metric, _format_value(totals['request_seconds'])),
+        "%s_count %d" % (metric, totals['requests']),
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return "%d" % value
+    return repr(float(value))
+
+
+def _write_atomically(path, text):
+    # The textfile collector may read the file at any time, so it's written
+    # to a temporary file and moved into place.
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.tmp_', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as fobj:
+            fobj.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,221 @@
+"""A compact table of page traffic for several day windows.
+
+Each normalised path is interned to an integer ID the first time it's seen,
+and the views, ranks and view fractions for each window are held in typed
+arrays indexed by that ID, rather than in dicts keyed by path.
+
+IDs are allocated in the order paths are first seen.  Since days are added
+most recent first, and each window is a snapshot of the running total once
+all the days in it have been added, the pages in a window are always
+exactly those with an ID below some limit.
+
+"""
+
+import numpy as np
+
+from .makebulk import PathTrie
+from .ranking import rank_counts
+
+
+class TrafficTable(object):
+    """Page traffic for a set of windows, keyed by days_ago.
+
+    Build a table by calling `add` with each day's traffic, most recent
+    first, calling `snapshot` once all the days for a window have been added,
+    and finally calling `rank`.
+
+    The table can then be used like a dict keyed by path: indexing it by
+    path, or iterating over `items`, gives a dict from days_ago to [rank,
+    views, fraction of views] for each window the page is in.  The
+    per-page dicts are built on demand, so iterating over a table doesn't
+    require them all to be in memory at once.
+
+    """
+    def __init__(self, windows):
+        self.paths = []
+        self.path_ids = {}
+        self._running = np.zeros(1024, dtype=np.int64)
+        # Windows, in the order given.  Each value is the number of pages
+        # in the window, or None if it hasn't been snapshotted yet.
+        self._sizes = {days_ago: None for days_ago in windows}
+        self.counts = {}
+        self.ranks = {}
+        self.fractions = {}
+        self._orders = {}
+
+    @property
+    def windows(self):
+        return list(self._sizes)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.path_ids
+
+    def _intern(self, path):
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+        return path_id
+
+    def add(self, traffic):
+        """Add a day's traffic: a mapping from path to number of views.
+
+        """
+        ids = np.array(
+            [self._intern(path) for path in traffic], dtype=np.int64)
+        views = np.fromiter(
+            traffic.values(), dtype=np.int64, count=len(ids))
+        if len(self.paths) > len(self._running):
+            running = np.zeros(
+                max(len(self.paths), 2 * len(self._running)), dtype=np.int64)
+            running[:len(self._running)] = self._running
+            self._running = running
+        # Paths are unique within a day, so there are no repeated IDs here.
+        self._running[ids] += views
+
+    def snapshot(self, days_ago):
+        """Record the running totals as the counts for a window.
+
+        """
+        size = len(self.paths)
+        self._sizes[days_ago] = size
+        self.counts[days_ago] = self._running[:size].copy()
+
+    def rank(self, totals=None):
+        """Calculate ranks and view fractions for every window.
+
+        :param totals: An optional dict from days_ago to the total views
+        that fractions are relative to.  By default, this is the total of
+        the counts in the window.
+
+        """
+        for days_ago, counts in self.counts.items():
+            total = None if totals is None else totals[days_ago]
+            order, ranks, fractions = rank_counts(counts, total)
+            self._orders[days_ago] = order
+            self.ranks[days_ago] = ranks
+            self.fractions[days_ago] = fractions
+
+    def _window_sizes(self):
+        return [
+            (days_ago, size) for days_ago, size in self._sizes.items()
+            if size
+        ]
+
+    def _info(self, path_id):
+        return {
+            days_ago: [
+                int(self.ranks[days_ago][path_id]),
+                int(self.counts[days_ago][path_id]),
+                float(self.fractions[days_ago][path_id]),
+            ]
+            for days_ago, size in self._window_sizes()
+            if path_id < size
+        }
+
+    def __getitem__(self, path):
+        return self._info(self.path_ids[path])
+
+    def page_ids(self):
+        """Return the IDs of all the pages, in output order.
+
+        This is rank order for the first window, followed by pages which are
+        only in later windows, in rank order for the first window they're in.
+
+        """
+        parts = [np.zeros(0, dtype=np.int64)]
+        covered = 0
+        for days_ago, size in self._window_sizes():
+            if size > covered:
+                order = self._orders[days_ago]
+                parts.append(order[order >= covered])
+                covered = size
+        return np.concatenate(parts)
+
+    def items(self, chunk_size=10000):
+        """Iterate over (path, info) pairs, in output order.
+
+        Values are converted from the arrays a chunk of pages at a time.
+
+        """
+        paths = self.paths
+        sizes = self._window_sizes()
+        page_ids = self.page_ids()
+        for start in range(0, len(page_ids), chunk_size):
+            chunk = page_ids[start:start + chunk_size]
+            columns = []
+            for days_ago, size in sizes:
+                clipped = np.minimum(chunk, size - 1)
+                columns.append((
+                    days_ago,
+                    (chunk < size).tolist(),
+                    self.ranks[days_ago][clipped].tolist(),
+                    self.counts[days_ago][clipped].tolist(),
+                    self.fractions[days_ago][clipped].tolist(),
+                ))
+            for i, path_id in enumerate(chunk.tolist()):
+                yield paths[path_id], {
+                    days_ago: [ranks[i], counts[i], fractions[i]]
+                    for days_ago, in_window, ranks, counts, fractions
+                    in columns
+                    if in_window[i]
+                }
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def section_rollups(self):
+        """Sum the traffic for every section, in every window.
+
+        A section is any path which is a prefix (in the sense of
+        `path_components`) of some other page's path.  The traffic for a
+        section is the total for all the pages whose path_components include
+        it, including the page at the section's own path, if there is one.
+
+        Returns a ranked TrafficTable of the sections.  Ranks are among the
+        sections, and view fractions are relative to the total views of all
+        pages in the window, so are comparable with those of pages.
+
+        """
+        trie = PathTrie()
+        prefixes = set()
+        for path in self.paths:
+            prefixes.update(trie.components(path)[:-1])
+
+        # Pair each page with each section it's in.  Pages are visited in ID
+        # order, so section IDs are in order of the first page in them, and
+        # the sections in each window are those with an ID below a limit,
+        # as for pages.
+        sections = TrafficTable(self.windows)
+        first_pages = []
+        pair_sections = []
+        pair_pages = []
+        for page_id, path in enumerate(self.paths):
+            for component in trie.components(path):
+                if component in prefixes:
+                    section_id = sections._intern(component)
+                    if section_id == len(first_pages):
+                        first_pages.append(page_id)
+                    pair_sections.append(section_id)
+                    pair_pages.append(page_id)
+        first_pages = np.array(first_pages, dtype=np.int64)
+        pair_sections = np.array(pair_sections, dtype=np.int64)
+        pair_pages = np.array(pair_pages, dtype=np.int64)
+
+        totals = {}
+        for days_ago, size in self._window_sizes():
+            section_count = int(np.searchsorted(first_pages, size))
+            in_window = pair_pages < size
+            views = np.bincount(
+                pair_sections[in_window],
+                weights=self.counts[days_ago][pair_pages[in_window]],
+                minlength=section_count,
+            )
+            sections._sizes[days_ago] = section_count
+            sections.counts[days_ago] = views[:section_count].astype(np.int64)
+            totals[days_ago] = self.counts[days_ago].sum()
+        sections.rank(totals)
+        return sections
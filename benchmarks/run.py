@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+"""Benchmark the stages of a fetch on synthetic GA data.
+
+Each benchmark is run on queries of each of the given sizes (in rows per
+day), using data from `synthetic_ga`.  The data is generated before timing
+starts, and served to the code being measured as GA would serve it.  Each
+benchmark is timed `--repeat` times, from a fresh setup each time, and then
+run once more under tracemalloc to measure its peak memory use.
+
+Results are saved as JSON in benchmarks/results, named after the commit
+they were measured at (with "-dirty" added if there were uncommitted
+changes), so that runs at different commits can be compared with
+`--compare`.  Only compare results measured on the same machine.
+
+A day of 5 million rows, and the rows and tables built from it during
+setup, need several GB of memory, so the default sizes stop at 1 million.
+
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from benchmarks.synthetic_ga import SyntheticGA
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+# The number of days fetched by the fetch_page_traffic benchmarks.
+FETCH_DAYS = 3
+
+TRAFFIC_NAME_MAP = {
+    'uniquePageViews': 'views',
+    'pagePath': 'path',
+    'pageTitle': 'title',
+}
+
+
+class RecordedQuery(object):
+    """Serve pages generated in advance, in place of a gapy query.
+
+    The same pages are served whatever the dates of the query, so one day of
+    synthetic data can stand in for several.
+
+    """
+    def __init__(self, pages):
+        self.pages = dict(
+            (int(page['query']['start-index']), page) for page in pages)
+
+    def get_raw_response(self, start_index=1, **kwargs):
+        return self.pages[int(start_index)]
+
+
+class FakeOAuthClient(object):
+    def __init__(self, query):
+        self.query = query
+
+
+class Data(object):
+    """The synthetic data for a size, generated once and shared.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pages = list(SyntheticGA(size).pages())
+        self._rows = None
+        self._raw_traffic = None
+
+    def query(self):
+        return RecordedQuery(self.pages)
+
+    def ga_client(self, workdir=None):
+        """A GAClient fetching from the data, caching in workdir, if given.
+
+        """
+        from analytics_fetcher.support.cache_manager import CacheManager
+        from analytics_fetcher.support.ga_client import GAClient
+        from analytics_fetcher.support.rate_limiter import RateLimiter
+
+        cache_manager = None
+        if workdir is not None:
+            with patch.dict(os.environ, {'CACHE_DIR': workdir}):
+                cache_manager = CacheManager()
+        client = GAClient(
+            None, cache_manager, RateLimiter(qps=1e9, burst=10 ** 9))
+        oauth_client = FakeOAuthClient(self.query())
+        client.oauth_client = lambda: oauth_client
+        return client
+
+    def rows(self):
+        """The rows of the traffic query, as returned by GAClient.fetch.
+
+        """
+        if self._rows is None:
+            client = self.ga_client()
+            self._rows = list(
+                client._query_ga('search', TRAFFIC_NAME_MAP, {}))
+            client.close()
+        return self._rows
+
+    def raw_traffic(self):
+        """The day's traffic, as from GAData.fetch_traffic_info."""
+        from analytics_fetcher.ga import GAData
+
+        if self._raw_traffic is None:
+            rows = self.rows()
+
+            class Client(object):
+                def fetch(self, *args, **kwargs):
+                    return iter(rows)
+
+            self._raw_traffic = GAData(
+                Client(), datetime.date(2020, 1, 1)).fetch_traffic_info()
+        return self._raw_traffic
+
+
+# The benchmarks, in the order they're run.  Each is a function taking the
+# Data and a fresh scratch directory, which does any setup and returns a
+# function to be measured, and optionally a function to tidy up after it.
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append((fn.__name__, fn))
+    return fn
+
+
+@benchmark
+def query_response_iter(data, workdir):
+    """Iterate over the rows of every page of a gapy QueryResponse."""
+    from gapy.response import QueryResponse
+
+    query = data.query()
+    first_page = query.get_raw_response(start_index=1)
+
+    def run():
+        response = QueryResponse(
+            query, first_page, ['uniquePageViews'], ['pagePath', 'pageTitle'],
+            max_results=None)
+        for _ in response:
+            pass
+    return run
+
+
+@benchmark
+def fetch_from_ga_rows(data, workdir):
+    """Fetch the pages of a query with GAClient and convert them to rows."""
+    client = data.ga_client()
+
+    def run():
+        for _ in client._query_ga('search', TRAFFIC_NAME_MAP, {}):
+            pass
+    return run, client.close
+
+
+def _cached_source(data, workdir):
+    from analytics_fetcher.support.cache_manager import (
+        cached_iterator,
+        CacheManager,
+    )
+
+    rows = data.rows()
+
+    class Source(object):
+        def __init__(self):
+            with patch.dict(os.environ, {'CACHE_DIR': workdir}):
+                self.cache_manager = CacheManager()
+
+        @cached_iterator
+        def fetch(self, profile_name, date):
+            for row in rows:
+                yield row
+
+    return Source()
+
+
+@benchmark
+def cached_iterator_write(data, workdir):
+    """Pass a day of rows through cached_iterator, writing them to cache."""
+    source = _cached_source(data, workdir)
+    date = datetime.datetime(2020, 1, 1)
+
+    def run():
+        for _ in source.fetch('search', date):
+            pass
+    return run, source.cache_manager.close
+
+
+@benchmark
+def cached_iterator_read(data, workdir):
+    """Read a day of rows back from the cache through cached_iterator."""
+    source = _cached_source(data, workdir)
+    date = datetime.datetime(2020, 1, 1)
+    for _ in source.fetch('search', date):
+        pass
+
+    def run():
+        for _ in source.fetch('search', date):
+            pass
+    return run, source.cache_manager.close
+
+
+@benchmark
+def page_traffic(data, workdir):
+    """Normalise and add up a day's traffic by path."""
+    from analytics_fetcher.analysis import page_traffic, PathNormaliser
+
+    raw = data.raw_traffic()
+
+    def run():
+        page_traffic(raw, PathNormaliser())
+    return run
+
+
+def _fetch(data, workdir):
+    from analytics_fetcher.fetch import fetch_page_traffic
+
+    client = data.ga_client(workdir)
+    today = datetime.date.today() - datetime.timedelta(days=1)
+
+    def run():
+        fetch_page_traffic(client, today, [1, FETCH_DAYS])
+
+    def tidy():
+        client.close()
+        client.cache_manager.close()
+    return run, tidy
+
+
+@benchmark
+def fetch_page_traffic(data, workdir):
+    """Fetch several days from GA, with an empty cache, into a table."""
+    return _fetch(data, workdir)
+
+
+@benchmark
+def fetch_page_traffic_cached(data, workdir):
+    """Fetch several days into a table, all served from the cache."""
+    run, close = _fetch(data, workdir)
+    run()
+    return run, close
+
+
+@benchmark
+def page_info_docs(data, workdir):
+    """Generate the documents for a ranked table of a day's traffic."""
+    from analytics_fetcher.analysis import page_traffic, PathNormaliser
+    from analytics_fetcher.makebulk import page_info_docs
+    from analytics_fetcher.traffic_table import TrafficTable
+
+    table = TrafficTable([1])
+    table.add(page_traffic(data.raw_traffic(), PathNormaliser()))
+    table.snapshot(1)
+    table.rank()
+
+    def run():
+        for _ in page_info_docs(table):
+            pass
+    return run
+
+
+def _setup(fn, data, workdir):
+    result = fn(data, workdir)
+    if isinstance(result, tuple):
+        return result
+    return result, None
+
+
+def measure(fn, data, repeat):
+    """Time a benchmark, and measure its peak memory use.
+
+    Returns a dict of the best and median times, in seconds, and the peak
+    memory allocated while running, in bytes.
+
+    """
+    times = []
+    for attempt in range(repeat + 1):
+        workdir = tempfile.mkdtemp(prefix='search-analytics-bench')
+        try:
+            run, tidy = _setup(fn, data, workdir)
+            gc.collect()
+            if attempt < repeat:
+                started = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - started)
+            else:
+                tracemalloc.start()
+                try:
+                    run()
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+            if tidy is not None:
+                tidy()
+        finally:
+            shutil.rmtree(workdir)
+    times.sort()
+    return {
+        'best_seconds': times[0],
+        'median_seconds': times[len(times) // 2],
+        'peak_bytes': peak,
+    }
+
+
+def run_benchmarks(sizes, repeat, only=None, log=print):
+    """Run the benchmarks at each size.
+
+    Returns a dict from the name of each benchmark to a dict from size (as
+    a string, for JSON) to the measurements.
+
+    """
+    results = {}
+    for size in sizes:
+        started = time.perf_counter()
+        data = Data(size)
+        log("Generated %d rows in %d pages in %.1fs" % (
+            size, len(data.pages), time.perf_counter() - started))
+        for name, fn in BENCHMARKS:
+            if only and name not in only:
+                continue
+            result = measure(fn, data, repeat)
+            results.setdefault(name, {})[str(size)] = result
+            log("%-26s %9d rows %9.3fs %12.0f rows/s %9.1f MB" % (
+                name, size, result['best_seconds'],
+                size / max(result['best_seconds'], 1e-9),
+                result['peak_bytes'] / 1e6))
+        del data
+    return results
+
+
+def git_revision():
+    """The current commit, with "-dirty" if there are uncommitted changes.
+
+    """
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short=12', 'HEAD'],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT,
+        ).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def results_path(revision):
+    """The path of the results for a revision, or of a results file.
+
+    """
+    if os.path.exists(revision):
+        return revision
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short=12', revision],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return os.path.join(RESULTS_DIR, '%s.json' % revision)
+
+
+def compare(base, current, max_slowdown=None):
+    """Compare two sets of results.
+
+    Returns a report, and a list of the benchmarks which are slower than
+    base by more than a factor of max_slowdown.
+
+    """
+    lines = ["%-26s %9s %9s %9s %7s %7s" % (
+        'benchmark', 'rows', 'base s', 'new s', 'time', 'memory')]
+    regressions = []
+    for name, sizes in sorted(current['results'].items()):
+        for size, result in sorted(sizes.items(), key=lambda i: int(i[0])):
+            base_result = base['results'].get(name, {}).get(size)
+            if base_result is None:
+                continue
+            time_ratio = (
+                result['best_seconds'] /
+                max(base_result['best_seconds'], 1e-9))
+            memory_ratio = (
+                result['peak_bytes'] / max(base_result['peak_bytes'], 1))
+            flag = ''
+            if max_slowdown is not None and time_ratio > max_slowdown:
+                regressions.append((name, size))
+                flag = '  SLOWER'
+            lines.append("%-26s %9s %9.3f %9.3f %6.2fx %6.2fx%s" % (
+                name, size, base_result['best_seconds'],
+                result['best_seconds'], time_ratio, memory_ratio, flag))
+    return "\n".join(lines), regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the fetch on synthetic GA data.'
+    )
+    parser.add_argument('--sizes',
+                        type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of rows per day to benchmark with')
+    parser.add_argument('--repeat',
+                        type=int, default=3,
+                        help='number of times to time each benchmark')
+    parser.add_argument('--only',
+                        type=str, nargs='+', default=None,
+                        choices=[name for name, _ in BENCHMARKS],
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--output',
+                        type=str, default=None,
+                        help='path to save results to (default: '
+                             'benchmarks/results/<commit>.json)')
+    parser.add_argument('--no-save',
+                        action='store_true',
+                        help="don't save the results")
+    parser.add_argument('--compare',
+                        type=str, default=None,
+                        help='commit (or results file) to compare with')
+    parser.add_argument('--max-slowdown',
+                        type=float, default=None,
+                        help='with --compare, fail if any benchmark is '
+                             'slower than this factor')
+    options = parser.parse_args(argv[1:])
+    return options
+
+
+def main(argv):
+    options = parse_args(argv)
+    revision = git_revision()
+    print("Benchmarking %s on Python %s" % (
+        revision, platform.python_version()))
+    results = {
+        'revision': revision,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'repeat': options.repeat,
+        'results': run_benchmarks(
+            options.sizes, options.repeat, options.only),
+    }
+
+    if not options.no_save:
+        path = options.output or os.path.join(
+            RESULTS_DIR, '%s.json' % revision)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as fobj:
+            json.dump(results, fobj, indent=2, sort_keys=True)
+        print("Saved results to %s" % path)
+
+    if options.compare:
+        with open(results_path(options.compare)) as fobj:
+            base = json.load(fobj)
+        report, regressions = compare(base, results, options.max_slowdown)
+        print("Compared with %s:" % base['revision'])
+        print(report)
+        if regressions:
+            print("%d benchmarks are more than %.2fx slower" % (
+                len(regressions), options.max_slowdown))
+            return True
+    return False
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,227 @@
+"""Generate realistic synthetic responses from the GA core reporting API.
+
+`SyntheticGA` stands in for the query object of a gapy client, answering
+the page traffic query (page path and title, by unique page views) for a
+day with as many rows as asked for, in pages linked by "nextLink" just as
+GA's are.  Rows are generated a page at a time when requested, so queries
+with millions of rows don't need to be held in memory.
+
+The data is shaped like GOV.UK's:
+
+ - views follow a Zipf distribution: the page at rank r has about
+   top_views / r ** zipf_s views, and rows come in descending order of
+   views, as the query sorts them.
+ - some rows are variants of a more popular page's path with a query string
+   (which `normalise_path` merges back into the page), or a trailing slash.
+ - some rows have the title of GOV.UK's "not found" page: mostly for paths
+   which don't exist, but some for paths which also appear with a real
+   title (which `GAData.fetch_traffic_info` must then not treat as not
+   found).
+
+The same seed always gives the same rows.
+
+"""
+
+import numpy
+
+NOT_FOUND_TITLE = 'Page not found - 404 - GOV.UK'
+
+SECTIONS = [
+    'browse', 'government/publications', 'government/news', 'guidance',
+    'government/organisations', 'business', 'benefits', 'tax', 'driving',
+    'visas-immigration', 'housing-local-services', 'education',
+    'employing-people', 'government/statistics', 'foreign-travel-advice',
+    'government/consultations',
+]
+
+WORDS = [
+    'apply', 'renew', 'check', 'report', 'register', 'vehicle', 'tax',
+    'licence', 'passport', 'visa', 'benefit', 'pension', 'universal',
+    'credit', 'self-assessment', 'return', 'company', 'charity', 'school',
+    'holiday', 'allowance', 'grant', 'funding', 'guidance', 'rules',
+    'rates', 'thresholds', 'statistics', 'annual', 'quarterly', 'local',
+    'council', 'planning', 'permit', 'fishing', 'energy', 'housing',
+    'student', 'finance', 'childcare',
+]
+
+COLUMN_HEADERS = [
+    {'name': 'ga:pagePath', 'columnType': 'DIMENSION', 'dataType': 'STRING'},
+    {'name': 'ga:pageTitle', 'columnType': 'DIMENSION', 'dataType': 'STRING'},
+    {'name': 'ga:uniquePageViews', 'columnType': 'METRIC',
+     'dataType': 'INTEGER'},
+]
+
+DATA_URL = "https://www.googleapis.com/analytics/v3/data/ga"
+
+
+def page_path(rank, seed=0):
+    """The path of the page at a given rank; a pure function of the rank.
+
+    """
+    if rank == 0:
+        return '/'
+    h = (rank * 2654435761 + seed * 40503) % 4294967296
+    section = SECTIONS[h % len(SECTIONS)]
+    h //= len(SECTIONS)
+    first = WORDS[h % len(WORDS)]
+    second = WORDS[(h // len(WORDS)) % len(WORDS)]
+    return '/%s/%s-%s-%d' % (section, first, second, rank)
+
+
+def page_title(rank):
+    return '%s %d - GOV.UK' % (WORDS[rank % len(WORDS)].capitalize(), rank)
+
+
+class SyntheticGA(object):
+    """Answer GA queries with synthetic page traffic rows.
+
+    :param total_rows: The number of rows in each query's results.
+    :param page_size: The number of rows in each page, unless the query
+    asks for fewer with max_results.
+    :param zipf_s: The exponent of the Zipf distribution of views.
+    :param top_views: The number of views of the most popular page.
+    :param variant_fraction: The fraction of rows which are a query string
+    or trailing slash variant of a more popular page.
+    :param not_found_fraction: The fraction of rows with the "not found"
+    title.
+    :param seed: Seeds the choice of rows.
+
+    Has a `get_raw_response` method taking the same arguments as
+    gapy's, so can be used as the `query` of a client, or the service of a
+    `QueryResponse`.  Also records the arguments of every request made in
+    `requests`.
+
+    """
+    def __init__(self, total_rows, page_size=10000, zipf_s=1.1,
+                 top_views=2000000, variant_fraction=0.2,
+                 not_found_fraction=0.02, seed=0):
+        self.total_rows = total_rows
+        self.page_size = page_size
+        self.zipf_s = zipf_s
+        self.top_views = top_views
+        self.variant_fraction = variant_fraction
+        self.not_found_fraction = not_found_fraction
+        self.seed = seed
+        self.requests = []
+
+    def views(self, start, stop):
+        """The views of the rows from index start up to stop (from 0).
+
+        """
+        ranks = numpy.arange(start + 1, stop + 1, dtype=numpy.float64)
+        views = numpy.floor(self.top_views / ranks ** self.zipf_s)
+        return numpy.maximum(views, 1).astype(numpy.int64)
+
+    def rows(self, start, stop):
+        """Generate the rows from index start up to stop (from 0).
+
+        Returns a list of [path, title, views] lists of strings, as GA
+        returns them.
+
+        """
+        stop = min(stop, self.total_rows)
+        if stop <= start:
+            return []
+        rng = numpy.random.default_rng([self.seed, start])
+        count = stop - start
+        kinds = rng.random(count)
+        # Variants are of more popular pages, with a skew to the top ones.
+        bases = (rng.random(count) ** 2 * numpy.arange(start, stop)).astype(
+            numpy.int64)
+        views = self.views(start, stop)
+
+        variant_limit = self.variant_fraction
+        not_found_limit = variant_limit + self.not_found_fraction
+        rows = []
+        for offset in range(count):
+            index = start + offset
+            kind = kinds[offset]
+            # GA gives one row for each path and title, so the rows which
+            # reuse another page's path and title are only made at indexes
+            # which map to that page uniquely.
+            if kind < variant_limit and index > 0:
+                if kind < variant_limit / 4 and index % 2 == 0:
+                    base = index // 2
+                    path = page_path(base, self.seed) + '/'
+                else:
+                    base = int(bases[offset])
+                    path = '%s?utm_source=synthetic&n=%d' % (
+                        page_path(base, self.seed), index)
+                title = page_title(base)
+            elif kind < not_found_limit:
+                if (
+                    kind < variant_limit + self.not_found_fraction / 4 and
+                    index % 3 == 0
+                ):
+                    # A real page which sometimes shows the not found page.
+                    path = page_path(index // 3, self.seed)
+                else:
+                    path = '/%s/no-such-page-%d' % (
+                        SECTIONS[index % len(SECTIONS)], index)
+                title = NOT_FOUND_TITLE
+            else:
+                path = page_path(index, self.seed)
+                title = page_title(index)
+            rows.append([path, title, str(views[offset])])
+        return rows
+
+    def get_raw_response(self, start_index=1, max_results=None, **kwargs):
+        """Return a page of results, like gapy's `get_raw_response`.
+
+        """
+        self.requests.append(dict(
+            kwargs, start_index=start_index, max_results=max_results))
+        start_index = int(start_index)
+        page_size = self.page_size
+        if max_results is not None:
+            page_size = min(page_size, int(max_results))
+        start = start_index - 1
+        stop = min(start + page_size, self.total_rows)
+
+        query = {
+            'ids': kwargs.get('ids', 'ga:1'),
+            'start-date': kwargs.get('start_date', '2020-01-01'),
+            'end-date': kwargs.get('end_date', '2020-01-01'),
+            'metrics': (kwargs.get('metrics') or 'ga:uniquePageViews').split(
+                ','),
+            'dimensions': kwargs.get(
+                'dimensions', 'ga:pagePath,ga:pageTitle'),
+            'sort': [kwargs.get('sort', '-ga:uniquePageViews')],
+            'start-index': start_index,
+            'max-results': page_size,
+        }
+        response = {
+            'kind': 'analytics#gaData',
+            'query': query,
+            'itemsPerPage': page_size,
+            'totalResults': self.total_rows,
+            'containsSampledData': False,
+            'columnHeaders': COLUMN_HEADERS,
+            'rows': self.rows(start, stop),
+        }
+        if stop < self.total_rows:
+            link_params = [
+                ('ids', query['ids']),
+                ('dimensions', query['dimensions']),
+                ('metrics', ','.join(query['metrics'])),
+                ('sort', ','.join(query['sort'])),
+                ('start-date', query['start-date']),
+                ('end-date', query['end-date']),
+                ('start-index', str(stop + 1)),
+                ('max-results', str(page_size)),
+            ]
+            response['nextLink'] = DATA_URL + '?' + '&'.join(
+                '%s=%s' % item for item in link_params)
+        return response
+
+    def pages(self, **kwargs):
+        """Generate every page of results for a query, in order.
+
+        """
+        start_index = 1
+        while True:
+            response = self.get_raw_response(start_index=start_index, **kwargs)
+            yield response
+            if 'nextLink' not in response:
+                return
+            start_index += len(response['rows'])
@@ -0,0 +1,240 @@
+"""An asyncio client for the GA core reporting API.
+
+`QueryClient` makes blocking requests through googleapiclient, so the only
+way to have several queries in flight is to use several threads.
+`AsyncQueryClient` instead makes its requests with a pluggable asynchronous
+transport, so a single thread can keep many queries in flight.
+
+The default transport, `AsyncioTransport`, is a minimal HTTP/1.1 client
+built on asyncio streams, with a pool of keep-alive connections.  Any
+object with compatible `request` and `close` coroutines can be used
+instead.
+"""
+
+import asyncio
+import gzip
+import json
+import urllib.parse
+
+from gapy.client import QueryClient
+from gapy.error import GapyError, GapyHttpError
+from gapy.response import AsyncQueryResponse
+
+DATA_URL = "https://www.googleapis.com/analytics/v3/data/ga"
+
+
+class AsyncioTransport(object):
+    """Make HTTP requests over pooled keep-alive connections.
+
+    At most `max_connections` requests are in flight at once; further
+    requests wait for one of them to complete.
+
+    asyncio connections belong to the event loop they were made on, so a
+    transport is bound to the loop it's first used on, and raises GapyError
+    if used on another.  Closing it releases it, so it can then be used on
+    a new loop (eg, by another call to `asyncio.run`).
+    """
+
+    def __init__(self, max_connections=10, timeout=60):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._loop = None
+        self._idle = {}
+        self._slots = None
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_connections)
+        elif self._loop is not loop:
+            raise GapyError(
+                "AsyncioTransport used on a different event loop; close it "
+                "before using it on a new loop")
+
+    async def request(self, method, url, headers=None, body=None):
+        """Make a request.
+
+        Returns a tuple of the status code, a dict of the response headers
+        (with lower case names) and the decoded response body.
+        """
+        self._bind()
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == "https"
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+        key = (host, port, secure)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        lines = [
+            "%s %s HTTP/1.1" % (method, target),
+            "Host: %s" % parts.netloc,
+            "Accept-Encoding: gzip",
+        ]
+        for name, value in (headers or {}).items():
+            lines.append("%s: %s" % (name, value))
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        if body is not None:
+            data += body
+
+        async with self._slots:
+            return await asyncio.wait_for(
+                self._send(key, data), self.timeout)
+
+    async def _send(self, key, data):
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                host, port, secure = key
+                reader, writer = await asyncio.open_connection(
+                    host, port, ssl=secure or None)
+            try:
+                writer.write(data)
+                await writer.drain()
+                status, headers, body, keep_alive = await _read_response(
+                    reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # The server probably closed the idle connection; try
+                    # again on a new one.
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.setdefault(key, []).append((reader, writer))
+            else:
+                writer.close()
+            return status, headers, body
+
+    async def close(self):
+        """Close all idle connections, and release the event loop."""
+        idle, self._idle = self._idle, {}
+        self._loop = None
+        self._slots = None
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise asyncio.IncompleteReadError(b"", None)
+    version, status = status_line.decode("latin-1").split(None, 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Skip any trailers.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    if headers.get("content-encoding", "").lower() == "gzip":
+        body = gzip.decompress(body)
+    return int(status), headers, body, keep_alive
+
+
+class AsyncQueryClient(QueryClient):
+    """Query the core reporting API from a coroutine.
+
+    Takes the same query arguments as `QueryClient`, but `get` and
+    `get_raw_response` are coroutines, and `get` returns an
+    `AsyncQueryResponse`.
+
+    Args:
+      credentials: oauth2client credentials used to authorise requests, or
+                   None to send requests without authorisation.
+      transport: the transport to make requests with; by default, an
+                 `AsyncioTransport`.
+      ga_hook: function, a hook that is called every time a query is made
+               against GA.
+      data_url: str, the URL of the API endpoint.
+    """
+
+    def __init__(self, credentials=None, transport=None, ga_hook=None,
+                 data_url=DATA_URL):
+        super(AsyncQueryClient, self).__init__(None, ga_hook)
+        self._credentials = credentials
+        self._transport = transport or AsyncioTransport()
+        self._data_url = data_url
+
+    async def get(self, ids, start_date, end_date, metrics,
+                  dimensions=None, filters=None,
+                  max_results=None, sort=None, segment=None):
+        metrics, dimensions, kwargs = self._build_query(
+            ids, start_date, end_date, metrics, dimensions, filters,
+            max_results, sort, segment)
+        return AsyncQueryResponse(
+            self,
+            await self.get_raw_response(**kwargs),
+            metrics, dimensions,
+            max_results=kwargs.get("max_results", None),
+        )
+
+    async def get_raw_response(self, **kwargs):
+        self._ga_hook(kwargs)
+        # Remove specific keyword arguments if they are `None`
+        for arg in "dimensions filters sort max_results segment".split():
+            kwargs = self._filter_empty(kwargs, arg)
+        query = urllib.parse.urlencode([
+            (key.replace("_", "-"), value) for key, value in kwargs.items()
+        ])
+        headers = {"Accept": "application/json"}
+        if self._credentials is not None:
+            headers["Authorization"] = "Bearer %s" % (
+                await self._access_token())
+
+        status, _, body = await self._transport.request(
+            "GET", "%s?%s" % (self._data_url, query), headers)
+        if status != 200:
+            raise GapyHttpError(status, body)
+        try:
+            return json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise GapyError("Invalid JSON in response from GA")
+
+    async def _access_token(self):
+        # Refreshing the token is a blocking request, but only happens when
+        # it has expired, so is done in a thread rather than reimplemented.
+        loop = asyncio.get_running_loop()
+        token = await loop.run_in_executor(
+            None, self._credentials.get_access_token)
+        return token.access_token
+
+    async def close(self):
+        await self._transport.close()
@@ -1,8 +1,14 @@
-from apiclient.discovery import build
-import httplib2
-from oauth2client.client import SignedJwtAssertionCredentials, flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client.tools import run_flow
+"""Clients for the GA management and core reporting APIs.
+
+googleapiclient, oauth2client and httplib2 are slow to import, so they're
+imported by the functions which need them, rather than when this module is
+loaded.
+"""
+
+import os
+import tempfile
+import threading
+import time
 
 from gapy.response import ManagementResponse, QueryResponse
 from gapy.error import GapyError
@@ -11,12 +17,26 @@ GOOGLE_API_SCOPE = "https://www.googleapis.com/auth/analytics"
 GOOGLE_API_SCOPE_READONLY = "https://www.googleapis.com/auth/analytics.readonly"
 REDIRECT_URI = "urn:ietf:wg:oauth:2.0:oob"
 
+DISCOVERY_URI = "https://www.googleapis.com/discovery/v1/apis/analytics/%s/rest"
+# How long a discovery document fetched from the network is kept on disk.
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+HTTP_TIMEOUT = 120
+
+# Discovery documents already loaded by this process, keyed by API version.
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+# Authorised http clients built on each thread, keyed by the path of the
+# storage the credentials were read from.
+_local = threading.local()
+
 
 def _get_storage(storage, storage_path):
     if not storage:
         if not storage_path:
             raise GapyError(
                 "Must provide either a storage object or a storage_path")
+        from oauth2client.file import Storage
         storage = Storage(filename=storage_path)
     return storage
 
@@ -51,12 +71,15 @@ def from_private_key(account_name, private_key=None, private_key_path=None,
 
     storage = _get_storage(storage, storage_path)
 
+    from oauth2client.client import SignedJwtAssertionCredentials
+
     scope = GOOGLE_API_SCOPE_READONLY if readonly else GOOGLE_API_SCOPE
     credentials = SignedJwtAssertionCredentials(account_name, private_key,
                                                 scope)
     credentials.set_store(storage)
 
-    return Client(_build(credentials, api_version, http_client), ga_hook)
+    return Client(
+        _build(credentials, api_version, http_client, storage_path), ga_hook)
 
 
 def from_secrets_file(client_secrets, storage=None, flags=None,
@@ -78,6 +101,9 @@ def from_secrets_file(client_secrets, storage=None, flags=None,
       ga_hook: function, a hook that is called every time a query is made
                against GA.
     """
+    from oauth2client.client import flow_from_clientsecrets
+    from oauth2client.tools import run_flow
+
     scope = GOOGLE_API_SCOPE_READONLY if readonly else GOOGLE_API_SCOPE
     flow = flow_from_clientsecrets(client_secrets,
                                    scope=scope)
@@ -86,7 +112,8 @@ def from_secrets_file(client_secrets, storage=None, flags=None,
     if credentials is None or credentials.invalid:
         credentials = run_flow(flow, storage, flags)
 
-    return Client(_build(credentials, api_version, http_client), ga_hook)
+    return Client(
+        _build(credentials, api_version, http_client, storage_path), ga_hook)
 
 
 def from_credentials_db(client_secrets, storage, api_version="v3",
@@ -111,14 +138,110 @@ def from_credentials_db(client_secrets, storage, api_version="v3",
     return Client(_build(credentials, api_version, http_client), ga_hook)
 
 
-def _build(credentials, api_version, http_client=None):
+def _build(credentials, api_version, http_client=None, storage_path=None):
     """Build the client object."""
-    if not http_client:
-        http_client = httplib2.Http()
+    from apiclient.discovery import build_from_document
 
-    authorised_client = credentials.authorize(http_client)
+    document = _discovery_document(api_version)
+    return build_from_document(
+        document,
+        http=_authorised_http(credentials, http_client, storage_path))
 
-    return build("analytics", api_version, http=authorised_client)
+
+def _authorised_http(credentials, http_client=None, storage_path=None):
+    """Return an http client which authorises requests with credentials.
+
+    Unless a client is given, clients built on the same thread with
+    credentials from the same storage path share one httplib2.Http, and so
+    its keep-alive connections, for as long as the stored credentials are
+    unchanged.  (httplib2 clients aren't thread safe, so can't be shared
+    between threads.)
+    """
+    import httplib2
+
+    if http_client:
+        return credentials.authorize(http_client)
+    if storage_path is None:
+        return credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+
+    shared = getattr(_local, "authorised_http", None)
+    if shared is None:
+        shared = _local.authorised_http = {}
+    key = os.path.abspath(storage_path)
+    cached = shared.get(key)
+    # The cached credentials write any refreshed token back to storage, so
+    # they match the stored ones unless those have been replaced.
+    if cached is None or cached[0].to_json() != credentials.to_json():
+        # authorize wraps the client's request method, so each set of
+        # credentials needs a client of its own.
+        cached = shared[key] = (
+            credentials,
+            credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT)),
+        )
+    return cached[1]
+
+
+def _discovery_document(api_version):
+    """Return the discovery document for a version of the analytics API.
+
+    This is the copy bundled with googleapiclient, if there is one.
+    Otherwise, the document is fetched and cached on disk for
+    DISCOVERY_CACHE_TTL seconds.  Either way, it's only loaded once per
+    process.
+    """
+    with _discovery_lock:
+        document = _discovery_documents.get(api_version)
+        if document is None:
+            document = _static_discovery_document(api_version)
+            if document is None:
+                document = _cached_discovery_document(api_version)
+            _discovery_documents[api_version] = document
+        return document
+
+
+def _static_discovery_document(api_version):
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        return None
+    return get_static_doc("analytics", api_version)
+
+
+def _discovery_cache_path(api_version):
+    cache_dir = os.environ.get(
+        "GAPY_DISCOVERY_CACHE",
+        os.path.join(tempfile.gettempdir(), "gapy-discovery"))
+    return os.path.join(cache_dir, "analytics.%s.json" % api_version)
+
+
+def _cached_discovery_document(api_version):
+    path = _discovery_cache_path(api_version)
+    try:
+        if time.time() - os.path.getmtime(path) < DISCOVERY_CACHE_TTL:
+            with open(path) as fobj:
+                return fobj.read()
+    except OSError:
+        pass
+
+    import httplib2
+
+    http_client = httplib2.Http(timeout=HTTP_TIMEOUT)
+    resp, content = http_client.request(DISCOVERY_URI % api_version)
+    if resp.status >= 400:
+        raise GapyError(
+            "Failed to fetch discovery document: HTTP %s" % resp.status)
+    document = content.decode("utf-8")
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as fobj:
+            fobj.write(document)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Not being able to cache the document isn't fatal.
+        pass
+    return document
 
 
 class Client(object):
@@ -197,7 +320,21 @@ class QueryClient(object):
 
     def get(self, ids, start_date, end_date, metrics,
             dimensions=None, filters=None,
-            max_results=None, sort=None, segment=None):
+            max_results=None, sort=None, segment=None, prefetch=0):
+        """Query the core reporting API.
+
+        If prefetch is greater than zero, iterating over the response
+        requests up to that many following pages in the background.
+        """
+        metrics, dimensions, kwargs = self._build_query(
+            ids, start_date, end_date, metrics, dimensions, filters,
+            max_results, sort, segment)
+        return self._get_response(
+            metrics, dimensions, prefetch=prefetch, **kwargs)
+
+    def _build_query(self, ids, start_date, end_date, metrics,
+                     dimensions, filters, max_results, sort, segment):
+        """Return the metrics, dimensions and GA parameters for a query."""
         ids = self._to_list(ids)
         metrics = self._to_list(metrics)
 
@@ -209,8 +346,7 @@ class QueryClient(object):
 
         sort = self._to_list(sort)
 
-        return self._get_response(
-            metrics, dimensions,
+        return metrics, dimensions, dict(
             ids=self._to_ga_param(ids),
             start_date=start_date,
             end_date=end_date,
@@ -219,7 +355,7 @@ class QueryClient(object):
             filters=self._to_ga_param(filters) or None,
             sort=self._to_ga_param(sort) or None,
             max_results=max_results,
-            segment=segment
+            segment=segment,
         )
 
     def _filter_empty(self, kwargs, key):
@@ -228,21 +364,103 @@ class QueryClient(object):
         return kwargs
 
     def get_raw_response(self, **kwargs):
+        return self._request(**kwargs).execute()
+
+    def _request(self, **kwargs):
+        """Build the googleapiclient request for a query, without sending it.
+        """
         self._ga_hook(kwargs)
         # Remove specific keyword arguments if they are `None`
         for arg in "dimensions filters sort max_results segment".split():
             kwargs = self._filter_empty(kwargs, arg)
-        return self._service.data().ga().get(**kwargs).execute()
+        return self._service.data().ga().get(**kwargs)
+
+    def batch(self):
+        """Start a batch of queries, to be sent in a single HTTP request.
 
-    def _get_response(self, m, d, **kwargs):
+        See `QueryBatch`.
+        """
+        return QueryBatch(self)
+
+    def _get_response(self, m, d, prefetch=0, **kwargs):
         return QueryResponse(
             self,
             self.get_raw_response(**kwargs),
             m, d,
             max_results=kwargs.get("max_results", None),
+            prefetch=prefetch,
         )
 
 
+class QueryBatch(object):
+    """A batch of queries, sent together as multipart HTTP requests.
+
+    Add queries with `get` or `get_raw_response`, which take the same
+    arguments as the QueryClient methods of the same names, then call
+    `execute`.  Queries are sent in batches of at most `max_batch_size`,
+    which is the most that the GA API accepts in one request.
+
+    `execute` returns a list with an entry for each query, in the order they
+    were added, of (response, error) pairs.  The response is a QueryResponse
+    for queries added with `get`, or a dict for those added with
+    `get_raw_response`; if a query failed, it's None and error holds the
+    HttpError for it.  A callback may also be given for each query; it's
+    called with the response and error as soon as they're available.
+    """
+
+    max_batch_size = 10
+
+    def __init__(self, query_client):
+        self._client = query_client
+        self._queries = []
+
+    def __len__(self):
+        return len(self._queries)
+
+    def get(self, ids, start_date, end_date, metrics,
+            dimensions=None, filters=None,
+            max_results=None, sort=None, segment=None, callback=None):
+        metrics, dimensions, kwargs = self._client._build_query(
+            ids, start_date, end_date, metrics, dimensions, filters,
+            max_results, sort, segment)
+
+        def wrap(response):
+            return QueryResponse(
+                self._client, response, metrics, dimensions,
+                max_results=kwargs.get("max_results", None),
+            )
+        self._add(self._client._request(**kwargs), wrap, callback)
+
+    def get_raw_response(self, callback=None, **kwargs):
+        self._add(self._client._request(**kwargs), None, callback)
+
+    def _add(self, request, wrap, callback):
+        self._queries.append((request, wrap, callback))
+
+    def execute(self):
+        results = [None] * len(self._queries)
+
+        def handle(request_id, response, error):
+            index = int(request_id)
+            _, wrap, callback = self._queries[index]
+            if error is None and wrap is not None:
+                response = wrap(response)
+            if error is not None:
+                response = None
+            results[index] = (response, error)
+            if callback is not None:
+                callback(response, error)
+
+        service = self._client._service
+        for start in range(0, len(self._queries), self.max_batch_size):
+            batch = service.new_batch_http_request(callback=handle)
+            chunk = self._queries[start:start + self.max_batch_size]
+            for offset, (request, _, _) in enumerate(chunk):
+                batch.add(request, request_id=str(start + offset))
+            batch.execute()
+        return results
+
+
 def _prefix_ga(value):
     """Prefix a string with 'ga:' if it is not already
 
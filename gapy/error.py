@@ -1,2 +1,12 @@
 class GapyError(Exception):
     pass
+
+
+class GapyHttpError(GapyError):
+    """An error response from the GA API."""
+
+    def __init__(self, status, content):
+        super(GapyHttpError, self).__init__(
+            "HTTP %s: %s" % (status, content[:200].decode("utf-8", "replace")))
+        self.status = status
+        self.content = content
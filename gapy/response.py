@@ -1,4 +1,6 @@
 from datetime import datetime
+import queue
+import threading
 import urllib.parse
 
 
@@ -28,56 +30,220 @@ class ManagementResponse(BaseResponse):
 
 
 class QueryResponse(BaseResponse):
-    def __init__(self, service, response, metrics, dimensions, max_results):
+    def __init__(self, service, response, metrics, dimensions, max_results,
+                 prefetch=0):
         super(QueryResponse, self).__init__(response)
         self._service = service
         self._metrics = metrics
         self._dimensions = dimensions
         self._max_results = max_results
+        self._prefetch = prefetch
 
     def __len__(self):
         return len(self._response.get("rows", []))
 
-    def __iter__(self):
+    def columns(self):
+        """Return the rows of the current page as columns.
+
+        The result is a dict like a row from `__iter__`, but with a list of
+        values, one per row, in place of each metric and dimension value.
+        Start and end dates are parsed once for the page, and datetimes once
+        for each distinct date (and hour) in it.
+        """
+        rows = self._response.get("rows", [])
+        query = self._response["query"]
+        n_dims = len(self._dimensions)
+        values = list(zip(*rows)) if rows else [()] * (
+            n_dims + len(self._metrics))
+
+        result = {
+            "metrics": dict(
+                (name, list(column)) for name, column
+                in zip(self._metrics, values[n_dims:])),
+            "start_date": _parse_date(query["start-date"]),
+            "end_date": _parse_date(query["end-date"]),
+        }
+
+        if self._dimensions:
+            dimensions = dict(
+                (name, list(column)) for name, column
+                in zip(self._dimensions, values[:n_dims]))
+            self._add_datetime_column(dimensions)
+            result["dimensions"] = dimensions
+
+        return result
+
+    def iter_batches(self):
+        """Iterate over the pages of results, as `columns()`.
+
+        Follows the "nextLink" of each page in the same way as `__iter__`.
+
+        If the response was created with `prefetch` greater than zero, up to
+        that many following pages are requested in a background thread while
+        earlier ones are being consumed.  An error from fetching a page is
+        raised when that page is reached.  If iteration stops early, the
+        background thread is told to stop, but isn't waited for.
+        """
+        if self._prefetch > 0:
+            for batch in self._iter_prefetched_batches():
+                yield batch
+            return
+
         count = 0
 
         while True:
-            for row in self._response.get("rows", []):
-                result = {
-                    "metrics": dict(
-                        list(zip(self._metrics, row[len(self._dimensions):]))),
-                    "start_date": datetime.strptime(
-                        self._response["query"]["start-date"],
-                        "%Y-%m-%d").date(),
-                    "end_date": datetime.strptime(
-                        self._response["query"]["end-date"], "%Y-%m-%d").date()
-                }
-
-                if self._dimensions:
-                    result["dimensions"] = dict(
-                        list(zip(self._dimensions, row[:len(self._dimensions)])))
-                    self._add_datetime(result["dimensions"])
-
-                count += 1
-                yield result
-
-            # Follow the "nextLink" if a maximum is not specified or exceeded
-            need_more = True
-            if self._max_results is not None and count >= self._max_results:
-                need_more = False
+            batch = self.columns()
+            count += len(self)
+            yield batch
 
-            if self._response.get("nextLink") and need_more:
-                next_kwargs = parse_ga_url(self._response.get("nextLink"))
-                self._response = self._service.get_raw_response(**next_kwargs)
+            if self._need_more(self._response, count):
+                self._response = self._next_page(self._response)
 
             else:
                 break
 
-    def _add_datetime(self, dimensions):
+    def _need_more(self, response, count):
+        # Follow the "nextLink" if a maximum is not specified or exceeded
+        if self._max_results is not None and count >= self._max_results:
+            return False
+        return bool(response.get("nextLink"))
+
+    def _next_page(self, response):
+        next_kwargs = parse_ga_url(response.get("nextLink"))
+        return self._service.get_raw_response(**next_kwargs)
+
+    def _iter_prefetched_batches(self):
+        pages = queue.Queue(maxsize=self._prefetch)
+        stop = threading.Event()
+        fetcher = threading.Thread(
+            target=self._fetch_pages,
+            args=(self._response, len(self), pages, stop),
+        )
+        fetcher.daemon = True
+        fetcher.start()
+        finished = False
+        try:
+            yield self.columns()
+            while True:
+                response, error = pages.get()
+                if error is not None:
+                    finished = True
+                    raise error
+                if response is None:
+                    finished = True
+                    break
+                self._response = response
+                yield self.columns()
+        finally:
+            stop.set()
+            # If the consumer stopped early, the fetcher may be in the middle
+            # of a slow request; it stops when that returns, and as a daemon
+            # thread doesn't hold up exit, so there's no need to wait for it.
+            if finished:
+                fetcher.join()
+
+    def _fetch_pages(self, response, count, pages, stop):
+        """Fetch the pages following a response onto a queue.
+
+        Puts (response, None) for each page, then (None, None) at the end,
+        or (None, error) if a fetch fails.  Stops early if `stop` is set.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            while self._need_more(response, count):
+                if stop.is_set():
+                    return
+                response = self._next_page(response)
+                count += len(response.get("rows", []))
+                if not put((response, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for result in _batch_rows(batch):
+                yield result
+
+    def _add_datetime_column(self, dimensions):
         if "date" in dimensions:
             if "hour" in dimensions:
-                dimensions["datetime"] = datetime.strptime(
-                    dimensions["date"] + dimensions["hour"], "%Y%m%d%H")
+                keys = [
+                    date + hour for date, hour
+                    in zip(dimensions["date"], dimensions["hour"])
+                ]
+                fmt = "%Y%m%d%H"
+            else:
+                keys = dimensions["date"]
+                fmt = "%Y%m%d"
+            parsed = {}
+            for key in set(keys):
+                parsed[key] = datetime.strptime(key, fmt)
+            dimensions["datetime"] = [parsed[key] for key in keys]
+
+
+class AsyncQueryResponse(QueryResponse):
+    """A QueryResponse whose following pages are fetched asynchronously.
+
+    The service must be an `AsyncQueryClient`.  Iterate over the rows with
+    `async for`, or over the pages with `aiter_batches()`.
+    """
+
+    async def aiter_batches(self):
+        count = 0
+
+        while True:
+            batch = self.columns()
+            count += len(self)
+            yield batch
+
+            if self._need_more(self._response, count):
+                next_kwargs = parse_ga_url(self._response.get("nextLink"))
+                self._response = await self._service.get_raw_response(
+                    **next_kwargs)
+
             else:
-                dimensions["datetime"] = datetime.strptime(dimensions["date"],
-                                                           "%Y%m%d")
+                break
+
+    async def __aiter__(self):
+        async for batch in self.aiter_batches():
+            for result in _batch_rows(batch):
+                yield result
+
+
+def _batch_rows(batch):
+    """Yield the rows of a batch from `QueryResponse.columns()` as dicts."""
+    start_date = batch["start_date"]
+    end_date = batch["end_date"]
+    metrics = list(batch["metrics"].items())
+    dimensions = list(batch.get("dimensions", {}).items())
+    columns = metrics + dimensions
+    size = len(columns[0][1]) if columns else 0
+
+    for i in range(size):
+        result = {
+            "metrics": dict(
+                (name, column[i]) for name, column in metrics),
+            "start_date": start_date,
+            "end_date": end_date,
+        }
+
+        if dimensions:
+            result["dimensions"] = dict(
+                (name, column[i]) for name, column in dimensions)
+
+        yield result
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
@@ -4,7 +4,6 @@ import os
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from analytics_fetcher.fetch import fetch
 import argparse
 import logging
 import sys
@@ -15,20 +14,133 @@ def parse_args(argv):
         description='Fetch data from Google Analytics.'
     )
     parser.add_argument('outfile',
-                        type=str, nargs=1,
-                        help='path to write output to')
+                        type=str, nargs='?',
+                        help='path to write output to (not needed with '
+                             '--plan)')
     parser.add_argument('days_ago',
-                        type=int, nargs=1,
-                        help='days ago to fetch data for')
+                        type=str, nargs='*',
+                        help='days ago to fetch data for; each value gives '
+                             'a window of that many days')
+    parser.add_argument('--workers',
+                        type=int, default=1,
+                        help='number of days to fetch from GA concurrently')
+    parser.add_argument('--page-workers',
+                        type=int, default=4,
+                        help='number of pages of a GA query to fetch '
+                             'concurrently')
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help='request the first page of every day in '
+                             'batched requests')
+    parser.add_argument('--range-days',
+                        type=int, default=None,
+                        help='fetch days which are not cached in queries '
+                             'covering up to this many days each')
+    parser.add_argument('--split-sampled',
+                        action='store_true',
+                        help='if GA samples the data for a day, fetch it '
+                             'again in slices by page path')
+    parser.add_argument('--qps',
+                        type=float, default=1.0,
+                        help='maximum sustained GA requests per second')
+    parser.add_argument('--burst',
+                        type=int, default=1,
+                        help='number of GA requests allowed without waiting')
+    parser.add_argument('--cache-days',
+                        type=int, default=30,
+                        help='remove cache entries older than this many '
+                             'days; 0 to keep them regardless of age')
+    parser.add_argument('--cache-max-bytes',
+                        type=int, default=None,
+                        help='evict least recently used cache entries to '
+                             'keep the cache within this size')
+    parser.add_argument('--compress',
+                        choices=['gzip', 'zstd'], default=None,
+                        help='compress the output file')
+    parser.add_argument('--rollup',
+                        action='store_true',
+                        help='also output traffic totals for each section '
+                             '(path prefix)')
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help='build the output from cached data only, '
+                             'without GA credentials; fails if any day '
+                             'is not cached')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='report which days would be fetched from GA '
+                             'and which from the cache, and exit')
+    parser.add_argument('--es-url',
+                        type=str, default=None,
+                        help='also load the documents directly into the '
+                             'elasticsearch cluster at this url')
+    parser.add_argument('--es-index',
+                        type=str, default='page-traffic',
+                        help='elasticsearch index to load documents into')
+    parser.add_argument('--es-concurrency',
+                        type=int, default=4,
+                        help='maximum bulk requests to have in flight')
+    parser.add_argument('--telemetry-json',
+                        type=str, default=None,
+                        help='write statistics about the GA requests made '
+                             'to this path, as JSON')
+    parser.add_argument('--telemetry-prom',
+                        type=str, default=None,
+                        help='write statistics about the GA requests made '
+                             'to this path, in the Prometheus textfile '
+                             'format')
     options = parser.parse_args(argv[1:])
+    # Both positional arguments are optional as far as argparse is
+    # concerned, so that --plan can be given just the days.
+    days_ago = options.days_ago
+    if options.plan and options.outfile is not None:
+        try:
+            int(options.outfile)
+        except ValueError:
+            pass
+        else:
+            days_ago = [options.outfile] + days_ago
+            options.outfile = None
+    if options.outfile is None and not options.plan:
+        parser.error('the following arguments are required: outfile')
+    if not days_ago:
+        parser.error('the following arguments are required: days_ago')
+    for value in days_ago:
+        try:
+            int(value)
+        except ValueError:
+            parser.error('argument days_ago: invalid int value: %r' % value)
     return {
-        'outfile': options.outfile[0],
-        'days_ago': options.days_ago[0],
+        'outfile': options.outfile,
+        'days_ago_buckets': [int(value) for value in days_ago],
+        'workers': options.workers,
+        'page_workers': options.page_workers,
+        'batch': options.batch,
+        'range_days': options.range_days,
+        'split_sampled': options.split_sampled,
+        'qps': options.qps,
+        'burst': options.burst,
+        'cache_days': options.cache_days or None,
+        'cache_max_bytes': options.cache_max_bytes,
+        'compression': options.compress,
+        'es_url': options.es_url,
+        'es_index': options.es_index,
+        'es_concurrency': options.es_concurrency,
+        'rollup': options.rollup,
+        'offline': options.offline,
+        'plan': options.plan,
+        'telemetry_json': options.telemetry_json,
+        'telemetry_prom': options.telemetry_prom,
     }
 
 
 def main(argv):
     options = parse_args(argv)
+    # Imported after parsing arguments, so that --help is quick.
+    from analytics_fetcher.fetch import fetch, format_plan, plan
+    if options.pop('plan'):
+        print(format_plan(plan(options['days_ago_buckets'])))
+        return False
     fetch(**options)
     return False
 
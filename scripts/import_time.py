@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Measure how long it takes to import a module, using `-X importtime`.
+
+The import is run in a fresh interpreter several times, and the fastest
+run is reported, along with the slowest imports in it.  Exits with an error
+if the import took longer than --max-ms, or loaded any of the modules that
+should only be imported when they're needed (by default, the google client
+libraries).
+
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import argparse
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFERRED_MODULES = [
+    'apiclient',
+    'googleapiclient',
+    'oauth2client',
+    'httplib2',
+    'requests',
+]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of a module.'
+    )
+    parser.add_argument('module',
+                        type=str, nargs='?', default='analytics_fetcher.fetch',
+                        help='module to import')
+    parser.add_argument('--repeat',
+                        type=int, default=5,
+                        help='number of times to import the module')
+    parser.add_argument('--top',
+                        type=int, default=10,
+                        help='number of slowest imports to list')
+    parser.add_argument('--max-ms',
+                        type=float, default=None,
+                        help='fail if the import takes longer than this')
+    parser.add_argument('--deferred',
+                        type=str, nargs='*', default=DEFERRED_MODULES,
+                        help='top level modules which must not be imported')
+    options = parser.parse_args(argv[1:])
+    return options
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter.
+
+    Returns a list of (cumulative microseconds, module name) for every
+    module imported, in the order they finished importing.
+
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True,
+    )
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times.append((int(cumulative), name.strip()))
+    return times
+
+
+def main(argv):
+    options = parse_args(argv)
+    runs = [import_times(options.module) for _ in range(options.repeat)]
+    best = min(runs, key=lambda times: times[-1][0])
+    total_ms = best[-1][0] / 1000.0
+    print("import %s: %.1fms (best of %d)" % (
+        options.module, total_ms, options.repeat))
+    slowest = [
+        (cumulative, name) for cumulative, name in sorted(best, reverse=True)
+        if name != options.module
+    ]
+    for cumulative, name in slowest[:options.top]:
+        print("  %8.1fms  %s" % (cumulative / 1000.0, name))
+
+    failed = False
+    loaded = sorted(set(
+        name for _, name in best
+        if name.split('.')[0] in options.deferred
+    ))
+    if loaded:
+        print("Imported modules which should be deferred: %s" % (
+            ', '.join(loaded)))
+        failed = True
+    if options.max_ms is not None and total_ms > options.max_ms:
+        print("Import took longer than %.1fms" % options.max_ms)
+        failed = True
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,32 @@
+"""
+Helpers shared by the analytics_fetcher tests
+"""
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from analytics_fetcher.support.cache_manager import CacheManager
+
+
+class TempCacheDirMixin(object):
+    """Points CACHE_DIR at a fresh temporary directory for each test.
+
+    The directory is in `self.cache_dir`, and is removed after the test.
+
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        patcher = patch.dict(os.environ, {'CACHE_DIR': self.cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def make_cache_manager(self, *args, **kwargs):
+        """A CacheManager for the temporary directory, closed after the test.
+
+        """
+        cache_manager = CacheManager(*args, **kwargs)
+        self.addCleanup(cache_manager.close)
+        return cache_manager
@@ -0,0 +1,88 @@
+"""
+Unit tests for bulk_writer.py
+"""
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from analytics_fetcher.fetch import fetch
+from analytics_fetcher.support.bulk_writer import BulkWriter
+
+
+DOCS = [
+    (
+        {"index": {"_type": "page-traffic", "_id": "/fred"}},
+        {"path_components": ["/fred"], "rank_1": 1, "vc_1": 10, "vf_1": 0.5},
+    ),
+    (
+        {"index": {"_type": "page-traffic", "_id": "/café\"x"}},
+        {"path_components": ["/café\"x"], "rank_1": 2, "vc_1": 10,
+         "vf_1": 0.5},
+    ),
+    (
+        {"delete": {"_id": "/wilma"}},
+        {},
+    ),
+]
+
+
+def expected_output(docs):
+    """The output of the original, unbuffered, writer."""
+    return b''.join(
+        ("%s\n%s\n" % (
+            json.dumps(action, separators=(',', ':')),
+            json.dumps(data, separators=(',', ':'))
+        )).encode('ascii')
+        for action, data in docs
+    )
+
+
+class TestBulkWriter(unittest.TestCase):
+    """
+    Testing writing bulk load files
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'out.dump')
+
+    def test_write(self):
+        with BulkWriter(self.path, buffer_size=50) as writer:
+            writer.write_all(DOCS)
+        with open(self.path, 'rb') as fobj:
+            output = fobj.read()
+        self.assertEqual(output, expected_output(DOCS))
+        self.assertEqual(writer.docs, 3)
+        self.assertEqual(writer.bytes, len(output))
+        self.assertEqual(writer.compressed_bytes, len(output))
+        self.assertTrue(writer.seconds >= 0)
+
+    def test_write_gzip(self):
+        with BulkWriter(self.path, compression='gzip') as writer:
+            writer.write_all(DOCS * 100)
+        with gzip.open(self.path, 'rb') as fobj:
+            self.assertEqual(fobj.read(), expected_output(DOCS * 100))
+        self.assertEqual(writer.compressed_bytes, os.path.getsize(self.path))
+        self.assertTrue(writer.compressed_bytes < writer.bytes)
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, BulkWriter, self.path, 'lzma')
+
+    def test_missing_zstandard(self):
+        with patch.dict(sys.modules, {'zstandard': None}):
+            self.assertRaises(ValueError, BulkWriter, self.path, 'zstd')
+
+    def test_fetch_checks_compression_first(self):
+        client_context = MagicMock()
+        with patch.dict(sys.modules, {'zstandard': None}), \
+                patch('analytics_fetcher.fetch.ClientContext',
+                      client_context):
+            with self.assertRaisesRegex(ValueError, 'zstandard'):
+                fetch(self.path, [1], compression='zstd')
+        self.assertFalse(client_context.called)
+        self.assertFalse(os.path.exists(self.path))
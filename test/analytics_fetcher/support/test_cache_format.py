@@ -0,0 +1,62 @@
+"""
+Unit tests for cache_format.py
+"""
+import unittest
+
+from analytics_fetcher.support.cache_format import (
+    CacheFormatError,
+    decode_rows,
+    encode_rows,
+    is_columnar,
+)
+
+
+class TestCacheFormat(unittest.TestCase):
+    """
+    Testing round trips through the columnar cache format
+    """
+    def roundtrip(self, rows):
+        data = encode_rows(rows)
+        self.assertTrue(is_columnar(data))
+        return list(decode_rows(data))
+
+    def test_roundtrip(self):
+        rows = [
+            {'path': '/fred', 'title': 'Fred', 'views': 100},
+            {'path': '/wilma', 'title': 'Fred', 'views': 2 ** 40},
+            {'path': '/café', 'title': '', 'views': -1},
+        ]
+        self.assertEqual(self.roundtrip(rows), rows)
+
+    def test_roundtrip_missing_keys(self):
+        rows = [
+            {'path': '/fred', 'views': 1, 'sampled': 12.5},
+            {'path': '/wilma', 'views': 2},
+            {'views': 3, 'hour': 4},
+        ]
+        self.assertEqual(self.roundtrip(rows), rows)
+
+    def test_roundtrip_empty(self):
+        self.assertEqual(self.roundtrip([]), [])
+        self.assertEqual(self.roundtrip([{}, {}]), [{}, {}])
+
+    def test_unsupported_rows(self):
+        self.assertIsNone(encode_rows([{'views': 1}, {'views': 1.5}]))
+        self.assertIsNone(encode_rows([{'views': None}]))
+        self.assertIsNone(encode_rows([{'views': True}]))
+        self.assertIsNone(encode_rows([{'views': 2 ** 64}]))
+        self.assertIsNone(encode_rows([{'views': [1]}]))
+        self.assertIsNone(encode_rows([{'path': '\ud800'}]))
+
+    def test_checksum(self):
+        data = bytearray(encode_rows([{'path': '/fred', 'views': 1}]))
+        data[12] ^= 0xff
+        self.assertRaises(CacheFormatError, decode_rows, bytes(data))
+
+    def test_truncated(self):
+        data = encode_rows([{'path': '/fred', 'views': 1}])
+        self.assertRaises(CacheFormatError, decode_rows, data[:-3])
+        self.assertRaises(CacheFormatError, decode_rows, data[:5])
+
+    def test_not_columnar(self):
+        self.assertFalse(is_columnar(b'{"path":"/fred"}\n'))
@@ -0,0 +1,276 @@
+"""
+Unit tests for cache_manager.py
+"""
+import datetime
+import hashlib
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from analytics_fetcher.support.cache_manager import (
+    cached_iterator,
+    ReadOnlyCacheError,
+)
+from analytics_fetcher.support.telemetry import Telemetry
+from test.analytics_fetcher.helpers import TempCacheDirMixin
+
+
+class Fetcher(object):
+    def __init__(self, cache_manager, rows):
+        self.cache_manager = cache_manager
+        self.rows = rows
+        self.calls = 0
+
+    @cached_iterator
+    def fetch(self, name):
+        self.calls += 1
+        for row in self.rows:
+            yield row
+
+    @cached_iterator
+    def fetch_day(self, profile_name, date, kwargs):
+        self.calls += 1
+        for row in self.rows:
+            yield row
+
+
+class TestCacheManager(TempCacheDirMixin, unittest.TestCase):
+    """
+    Testing the file cache and cached_iterator
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache_manager = self.make_cache_manager(30)
+
+    def test_write_and_read_rows(self):
+        rows = [{'path': '/fred', 'views': 1}, {'path': '/wilma', 'views': 2}]
+        self.cache_manager.write_rows('entry', rows)
+        self.assertEqual(list(self.cache_manager.read_rows('entry')), rows)
+
+    def test_write_and_read_unsupported_rows(self):
+        rows = [{'path': '/fred', 'views': None}]
+        self.cache_manager.write_rows('entry', rows)
+        with self.cache_manager.open_for_read('entry') as fobj:
+            self.assertEqual(fobj.read(), '{"path":"/fred","views":null}\n')
+        self.assertEqual(list(self.cache_manager.read_rows('entry')), rows)
+
+    def test_write_and_read_unencodable_rows(self):
+        rows = [{'path': '/fred\ud800', 'views': 1}]
+        self.cache_manager.write_rows('entry', rows)
+        self.assertEqual(list(self.cache_manager.read_rows('entry')), rows)
+
+    def test_reads_json_lines(self):
+        with self.cache_manager.atomic_write('entry') as fobj:
+            fobj.write('{"path":"/fred","views":1}\n')
+        self.assertEqual(
+            list(self.cache_manager.read_rows('entry')),
+            [{'path': '/fred', 'views': 1}],
+        )
+
+    def test_cached_iterator(self):
+        rows = [{'path': '/fred', 'views': 1}]
+        fetcher = Fetcher(self.cache_manager, rows)
+        self.assertEqual(list(fetcher.fetch('a')), rows)
+        self.assertEqual(list(fetcher.fetch('a')), rows)
+        self.assertEqual(fetcher.calls, 1)
+        self.assertEqual(list(fetcher.fetch('b')), rows)
+        self.assertEqual(fetcher.calls, 2)
+
+    def test_cached_iterator_records_telemetry(self):
+        fetcher = Fetcher(self.cache_manager, [{'views': 1}])
+        fetcher.telemetry = Telemetry()
+        list(fetcher.fetch('a'))
+        list(fetcher.fetch('a'))
+        list(fetcher.fetch('b'))
+        self.assertEqual(fetcher.telemetry.cache_hits, 1)
+        self.assertEqual(fetcher.telemetry.cache_misses, 2)
+
+    def test_cached_iterator_refetches_corrupt_entries(self):
+        rows = [{'path': '/fred', 'views': 1}]
+        fetcher = Fetcher(self.cache_manager, rows)
+        list(fetcher.fetch('a'))
+        for filename in self.cache_manager._entry_names():
+            with open(os.path.join(self.cache_dir, filename), 'r+b') as fobj:
+                fobj.truncate(10)
+        self.assertEqual(list(fetcher.fetch('a')), rows)
+        self.assertEqual(fetcher.calls, 2)
+        self.assertEqual(list(fetcher.fetch('a')), rows)
+        self.assertEqual(fetcher.calls, 2)
+
+    def test_cached_iterator_does_not_cache_partial_results(self):
+        fetcher = Fetcher(self.cache_manager, [{'views': 1}, {'views': 2}])
+        iterator = fetcher.fetch('a')
+        next(iterator)
+        iterator.close()
+        self.assertEqual(self.cache_manager._entry_names(), [])
+
+    def test_cached_iterator_canonical_keys(self):
+        fetcher = Fetcher(self.cache_manager, [{'views': 1}])
+        list(fetcher.fetch_day(
+            'search', datetime.datetime(2020, 1, 1), {'a': 1, 'b': 2}))
+        list(fetcher.fetch_day(
+            'search', date=datetime.date(2020, 1, 1), kwargs={'b': 2, 'a': 1}))
+        self.assertEqual(fetcher.calls, 1)
+        self.assertEqual(
+            (self.cache_manager.hits, self.cache_manager.misses), (1, 1))
+        self.assertEqual(
+            self.cache_manager.index.counters(), {'hits': 1, 'misses': 1})
+
+    def test_cached_iterator_adopts_legacy_entries(self):
+        rows = [{'path': '/fred', 'views': 1}]
+        args = ('search', datetime.datetime(2020, 1, 1), {})
+        legacy = hashlib.sha1(repr([args, {}]).encode('ascii')).hexdigest()
+        self.cache_manager.write_rows(legacy, rows)
+        fetcher = Fetcher(self.cache_manager, [])
+        self.assertEqual(list(fetcher.fetch_day(*args)), rows)
+        self.assertEqual(fetcher.calls, 0)
+        self.assertFalse(self.cache_manager.exists(legacy))
+
+    def test_cache_key_leaves_legacy_entries(self):
+        rows = [{'path': '/fred', 'views': 1}]
+        args = ('search', datetime.datetime(2020, 1, 1), {})
+        legacy = hashlib.sha1(repr([args, {}]).encode('ascii')).hexdigest()
+        self.cache_manager.write_rows(legacy, rows)
+        fetcher = Fetcher(self.cache_manager, [])
+        key = Fetcher.fetch_day.cache_key(fetcher, *args)
+        self.assertTrue(self.cache_manager.exists(legacy))
+        self.assertFalse(self.cache_manager.exists(key))
+
+    def test_coverage(self):
+        fetcher = Fetcher(
+            self.cache_manager, [{'views': 1}, {'views': 2, 'sampled': 50.0}])
+        list(fetcher.fetch_day('search', datetime.datetime(2020, 1, 2), {}))
+        list(fetcher.fetch_day('other', datetime.datetime(2020, 1, 3), {}))
+        coverage = self.cache_manager.coverage(
+            'search', datetime.date(2020, 1, 1), datetime.date(2020, 1, 3))
+        self.assertEqual(
+            sorted(coverage),
+            [datetime.date(2020, 1, day) for day in (1, 2, 3)])
+        self.assertEqual(coverage[datetime.date(2020, 1, 1)], [])
+        self.assertEqual(coverage[datetime.date(2020, 1, 3)], [])
+        [entry] = coverage[datetime.date(2020, 1, 2)]
+        self.assertEqual(entry['profile'], 'search')
+        self.assertEqual(entry['rows'], 2)
+        self.assertEqual(entry['sample_rate'], 50.0)
+        self.assertEqual(
+            entry['query'],
+            '{"date":"2020-01-02","kwargs":{},"profile_name":"search"}')
+        self.assertTrue(entry['bytes'] > 0)
+
+    def test_fetch_seconds_excludes_consumer_time(self):
+        fetcher = Fetcher(self.cache_manager, [{'views': 1}, {'views': 2}])
+        for _ in fetcher.fetch_day(
+                'search', datetime.datetime(2020, 1, 2), {}):
+            time.sleep(0.2)
+        [entry] = self.cache_manager.coverage(
+            'search', datetime.date(2020, 1, 2),
+            datetime.date(2020, 1, 2))[datetime.date(2020, 1, 2)]
+        self.assertLess(entry['fetch_seconds'], 0.1)
+
+    def snapshot(self):
+        files = {}
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            with open(path, 'rb') as fobj:
+                files[filename] = (os.path.getmtime(path), fobj.read())
+        return files
+
+    def test_read_only_cache_unchanged(self):
+        rows = [{'path': '/fred', 'views': 1}]
+        fetcher = Fetcher(self.cache_manager, rows)
+        list(fetcher.fetch_day('search', datetime.datetime(2020, 1, 1), {}))
+        legacy_args = ('search', datetime.datetime(2020, 1, 2), {})
+        legacy = hashlib.sha1(
+            repr([legacy_args, {}]).encode('ascii')).hexdigest()
+        self.cache_manager.write_rows(legacy, rows)
+        self.cache_manager.close()
+        before = self.snapshot()
+
+        read_only = self.make_cache_manager(read_only=True)
+        fetcher = Fetcher(read_only, [])
+        self.assertEqual(
+            list(fetcher.fetch_day(
+                'search', datetime.datetime(2020, 1, 1), {})),
+            rows)
+        self.assertEqual(list(fetcher.fetch_day(*legacy_args)), rows)
+        self.assertEqual(fetcher.calls, 0)
+        self.assertEqual(read_only.hits, 2)
+        self.assertEqual(self.snapshot(), before)
+        with self.assertRaises(ReadOnlyCacheError):
+            read_only.write_rows('entry', rows)
+        with self.assertRaises(ReadOnlyCacheError):
+            read_only.cleanup()
+
+    def test_read_only_cache_missing_dir(self):
+        with patch.dict(os.environ, {
+                'CACHE_DIR': os.path.join(self.cache_dir, 'missing')}):
+            read_only = self.make_cache_manager(read_only=True)
+        self.assertFalse(read_only.exists('entry'))
+        self.assertEqual(read_only.index.counters(), {})
+        self.assertEqual(os.listdir(self.cache_dir), ['.index.sqlite3'])
+
+
+class TestCacheCleanup(TempCacheDirMixin, unittest.TestCase):
+    """
+    Testing expiry and size-budgeted eviction of cache entries
+    """
+    def setUp(self):
+        super().setUp()
+        self.now = time.time()
+
+    def write(self, cache_manager, filename, size, mtime, accessed):
+        with cache_manager.atomic_write(filename) as fobj:
+            fobj.write('x' * size)
+        os.utime(os.path.join(self.cache_dir, filename), (mtime, mtime))
+        cache_manager.index.touch(filename, accessed)
+
+    def entries(self):
+        return sorted(
+            filename for filename in os.listdir(self.cache_dir)
+            if not filename.startswith('.')
+        )
+
+    def test_age_expiry(self):
+        cache_manager = self.make_cache_manager(max_age_days=30)
+        day = 24 * 60 * 60
+        self.write(cache_manager, 'old', 10, self.now - 31 * day, self.now)
+        self.write(cache_manager, 'new', 10, self.now - 29 * day, self.now)
+        cache_manager.cleanup(self.now)
+        self.assertEqual(self.entries(), ['new'])
+
+    def test_evicts_least_recently_used(self):
+        cache_manager = self.make_cache_manager(max_bytes=25)
+        self.write(cache_manager, 'a', 10, self.now - 3, self.now - 1)
+        self.write(cache_manager, 'b', 10, self.now - 2, self.now - 30)
+        self.write(cache_manager, 'c', 10, self.now - 1, self.now - 20)
+        cache_manager.cleanup(self.now)
+        self.assertEqual(self.entries(), ['a', 'c'])
+
+        cache_manager.max_bytes = 10
+        cache_manager.cleanup(self.now)
+        self.assertEqual(self.entries(), ['a'])
+
+    def test_reads_update_access_times(self):
+        cache_manager = self.make_cache_manager(max_bytes=1000)
+        cache_manager.write_rows('a', [{'views': 1}])
+        cache_manager.write_rows('b', [{'views': 1}])
+        cache_manager.index.touch('a', 0)
+        cache_manager.index.touch('b', 0)
+        list(cache_manager.read_rows('a'))
+        self.assertTrue(cache_manager.index.last_access_times()['a'] > 0)
+
+        cache_manager.max_bytes = os.path.getsize(
+            os.path.join(self.cache_dir, 'a'))
+        cache_manager.cleanup()
+        self.assertEqual(self.entries(), ['a'])
+
+    def test_access_times_persist(self):
+        cache_manager = self.make_cache_manager()
+        self.write(cache_manager, 'a', 10, self.now, self.now - 5)
+        self.write(cache_manager, 'b', 10, self.now, self.now - 5)
+        os.unlink(os.path.join(self.cache_dir, 'b'))
+        cache_manager.cleanup(self.now)
+        self.assertEqual(
+            self.make_cache_manager().index.last_access_times(),
+            {'a': self.now - 5})
@@ -0,0 +1,164 @@
+"""
+Unit tests for es_loader.py, against a local stand-in for Elasticsearch
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from analytics_fetcher.fetch import fetch
+from analytics_fetcher.support.es_loader import BulkLoadError, BulkLoader
+from analytics_fetcher.traffic_table import TrafficTable
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """Accepts bulk requests, rejecting the first attempt at some items."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeBulkHandler)
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.paths = []
+        self.connections = set()
+        self.reject_once = set()
+        self.reject_always = set()
+        self.fail_requests = 0
+        self.short_responses = 0
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        lines = body.decode('utf-8').splitlines()
+        with server.lock:
+            server.paths.append(self.path)
+            server.connections.add(self.client_address)
+            if server.fail_requests:
+                server.fail_requests -= 1
+                return self.respond(503, {'error': 'unavailable'})
+            items = []
+            for action_line, data_line in zip(lines[::2], lines[1::2]):
+                doc_id = json.loads(action_line)['index']['_id']
+                if doc_id in server.reject_always:
+                    status = 400
+                elif doc_id in server.reject_once:
+                    server.reject_once.discard(doc_id)
+                    status = 429
+                else:
+                    server.docs[doc_id] = json.loads(data_line)
+                    status = 201
+                items.append({'index': {'_id': doc_id, 'status': status}})
+            if server.short_responses and len(items) > 1:
+                server.short_responses -= 1
+                items.pop()
+        self.respond(200, {
+            'errors': any(i['index']['status'] > 300 for i in items),
+            'items': items,
+        })
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def docs(count):
+    return [
+        ({'index': {'_type': 'page-traffic', '_id': '/page-%d' % i}},
+         {'path_components': ['/page-%d' % i], 'vc_1': i})
+        for i in range(count)
+    ]
+
+
+@patch('analytics_fetcher.support.es_loader.time.sleep')
+class TestBulkLoader(unittest.TestCase):
+    """
+    Testing loading documents over HTTP
+    """
+    def setUp(self):
+        self.server = FakeElasticsearch()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def test_load_in_chunks(self, sleep):
+        with BulkLoader(self.url, 'page-traffic', concurrency=2,
+                        chunk_bytes=1000) as loader:
+            loader.add_all(docs(100))
+        self.assertEqual(len(self.server.docs), 100)
+        self.assertEqual(self.server.docs['/page-7'],
+                         {'path_components': ['/page-7'], 'vc_1': 7})
+        self.assertEqual(loader.loaded, 100)
+        self.assertEqual(loader.failed, 0)
+        self.assertTrue(loader.requests > 5)
+        self.assertEqual(set(self.server.paths), {'/page-traffic/_bulk'})
+        # Connections are kept alive and reused.
+        self.assertTrue(len(self.server.connections) <= 2)
+        self.assertTrue(loader.docs_per_second > 0)
+
+    def test_retries_rejected_items(self, sleep):
+        self.server.reject_once = {'/page-3', '/page-5'}
+        self.server.reject_always = {'/page-8'}
+        with self.assertRaisesRegex(BulkLoadError, 'Failed to load 1 of 10'):
+            with BulkLoader(self.url, 'page-traffic') as loader:
+                loader.add_all(docs(10))
+        self.assertEqual(len(self.server.docs), 9)
+        self.assertNotIn('/page-8', self.server.docs)
+        self.assertEqual(
+            (loader.loaded, loader.failed, loader.retries), (9, 1, 2))
+
+    def test_retries_failed_requests(self, sleep):
+        self.server.fail_requests = 2
+        with BulkLoader(self.url, 'page-traffic') as loader:
+            loader.add_all(docs(10))
+        self.assertEqual(len(self.server.docs), 10)
+        self.assertEqual(loader.requests, 3)
+
+    def test_gives_up_after_max_retries(self, sleep):
+        self.server.fail_requests = 100
+        with self.assertRaisesRegex(BulkLoadError, 'Failed to load 10 of 10'):
+            with BulkLoader(self.url, 'page-traffic', max_retries=2) as loader:
+                loader.add_all(docs(10))
+        self.assertEqual((loader.loaded, loader.failed), (0, 10))
+        self.assertEqual(loader.requests, 3)
+
+    def test_wrong_item_count_is_raised(self, sleep):
+        self.server.short_responses = 1
+        with self.assertRaises(BulkLoadError):
+            with BulkLoader(self.url, 'page-traffic', concurrency=2,
+                            chunk_bytes=200) as loader:
+                loader.add_all(docs(20))
+        self.assertTrue(loader.loaded < 20)
+
+    def test_fetch_fails_if_documents_rejected(self, sleep):
+        self.server.reject_always = {'/wilma'}
+        table = TrafficTable([1])
+        table.add({'/fred': 5, '/wilma': 10})
+        table.snapshot(1)
+        table.rank()
+        outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outdir)
+        with patch('analytics_fetcher.fetch.ClientContext', MagicMock()), \
+                patch('analytics_fetcher.fetch.fetch_page_traffic',
+                      return_value=table):
+            with self.assertRaisesRegex(BulkLoadError, 'Failed to load 1'):
+                fetch(os.path.join(outdir, 'page-traffic.dump'), [1],
+                      es_url=self.url)
+        self.assertEqual(set(self.server.docs), {'/fred'})
@@ -0,0 +1,325 @@
+"""
+Unit tests for ga_client.py
+"""
+import json
+import re
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import httplib2
+from apiclient.errors import HttpError
+
+from analytics_fetcher.support.ga_client import (
+    GAClient,
+    _SampledData,
+    is_rate_limit_error,
+)
+from analytics_fetcher.support.rate_limiter import RateLimiter
+from analytics_fetcher.support.telemetry import Telemetry
+
+
+def http_error(status, reason=None):
+    content = b''
+    if reason is not None:
+        content = json.dumps({
+            'error': {'errors': [{'reason': reason}], 'message': reason},
+        }).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class TestIsRateLimitError(unittest.TestCase):
+    """
+    Testing detection of GA rate limit errors
+    """
+    def test_too_many_requests(self):
+        self.assertTrue(is_rate_limit_error(http_error(429)))
+
+    def test_forbidden_for_rate(self):
+        self.assertTrue(is_rate_limit_error(
+            http_error(403, 'userRateLimitExceeded')))
+        self.assertTrue(is_rate_limit_error(http_error(403, 'quotaExceeded')))
+
+    def test_forbidden_for_other_reasons(self):
+        self.assertFalse(is_rate_limit_error(
+            http_error(403, 'dailyLimitExceeded')))
+        self.assertFalse(is_rate_limit_error(http_error(403, 'forbidden')))
+        self.assertFalse(is_rate_limit_error(http_error(403)))
+
+    def test_other_status(self):
+        self.assertFalse(is_rate_limit_error(http_error(500, 'backendError')))
+
+
+class TestGAClientRetries(unittest.TestCase):
+    """
+    Testing that GAClient backs off and retries rate limited requests
+    """
+    def setUp(self):
+        self.limiter = RateLimiter(qps=100.0, burst=100)
+        self.client = GAClient(None, None, self.limiter, max_retries=2)
+        self.query = Mock()
+        self.client.oauth_client = Mock(return_value=Mock(query=self.query))
+
+    @patch('analytics_fetcher.support.ga_client.time.sleep')
+    def test_retries_then_succeeds(self, sleep):
+        self.query.get_raw_response.side_effect = [
+            http_error(429), http_error(403, 'rateLimitExceeded'), {'ok': 1},
+        ]
+        resp, waited = self.client._get_raw_response(start_index=1)
+        self.assertEqual(resp, {'ok': 1})
+        self.assertEqual(self.query.get_raw_response.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.limiter.throttles, 2)
+        self.assertTrue(self.limiter.rate < 100.0)
+        self.assertTrue(waited >= 0)
+
+    @patch('analytics_fetcher.support.ga_client.time.sleep')
+    def test_gives_up_after_max_retries(self, sleep):
+        self.query.get_raw_response.side_effect = [http_error(429)] * 3
+        self.assertRaises(HttpError, self.client._get_raw_response)
+        self.assertEqual(self.query.get_raw_response.call_count, 3)
+
+    @patch('analytics_fetcher.support.ga_client.time.sleep')
+    def test_does_not_retry_other_errors(self, sleep):
+        self.query.get_raw_response.side_effect = [http_error(500)]
+        self.assertRaises(HttpError, self.client._get_raw_response)
+        self.assertEqual(self.query.get_raw_response.call_count, 1)
+        sleep.assert_not_called()
+
+
+class FakePagedQuery(object):
+    """Serves pages of GA results, with one row per result index."""
+    def __init__(self, total_results, page_size, delay=0.0):
+        self.total_results = total_results
+        self.page_size = page_size
+        self.delay = delay
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_raw_response(self, start_index, **kwargs):
+        with self.lock:
+            self.requested.append(start_index)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        end = min(start_index + self.page_size, self.total_results + 1)
+        return {
+            'totalResults': self.total_results,
+            'columnHeaders': [
+                {'name': 'ga:pagePath', 'dataType': 'STRING'},
+                {'name': 'ga:pageviews', 'dataType': 'INTEGER'},
+            ],
+            'rows': [['/%d' % i, str(i)] for i in range(start_index, end)],
+        }
+
+
+class TestGAClientPages(unittest.TestCase):
+    """
+    Testing that GAClient fetches the pages of a query concurrently
+    """
+    def client(self, query, page_workers):
+        client = GAClient(
+            None, None, RateLimiter(qps=1000.0, burst=1000),
+            page_workers=page_workers)
+        client.oauth_client = Mock(return_value=Mock(query=query))
+        self.addCleanup(client.close)
+        return client
+
+    def rows(self, client):
+        params = {'max_results': 3}
+        rows = []
+        for _, resp, _ in client._fetch_pages(params):
+            rows.extend(client._parse_page(resp, 'search', {}, params))
+        return rows
+
+    def test_rows_in_order(self):
+        query = FakePagedQuery(total_results=10, page_size=3, delay=0.01)
+        rows = self.rows(self.client(query, page_workers=4))
+        self.assertEqual(
+            [row['pageviews'] for row in rows], list(range(1, 11)))
+        self.assertEqual(sorted(query.requested), [1, 4, 7, 10])
+        self.assertEqual(query.requested[0], 1)
+        self.assertTrue(query.max_in_flight > 1)
+
+    def test_same_rows_as_sequential(self):
+        query = FakePagedQuery(total_results=10, page_size=3)
+        sequential = self.rows(self.client(query, page_workers=1))
+        self.assertEqual(query.max_in_flight, 1)
+        concurrent = self.rows(self.client(query, page_workers=3))
+        self.assertEqual(concurrent, sequential)
+
+    def test_single_page(self):
+        query = FakePagedQuery(total_results=2, page_size=3)
+        rows = self.rows(self.client(query, page_workers=4))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(query.requested, [1])
+
+    def test_records_telemetry(self):
+        query = FakePagedQuery(total_results=10, page_size=3)
+        client = self.client(query, page_workers=2)
+        client.telemetry = Telemetry()
+        self.rows(client)
+        requests = sorted(
+            client.telemetry.requests,
+            key=lambda request: request['start_index'])
+        self.assertEqual(
+            [request['start_index'] for request in requests], [1, 4, 7, 10])
+        self.assertEqual(
+            [request['rows'] for request in requests], [3, 3, 3, 1])
+        for request in requests:
+            self.assertTrue(request['bytes'] > 0)
+            self.assertTrue(request['seconds'] >= 0)
+            self.assertFalse(request['batched'])
+
+    def test_requests_bounded_by_workers(self):
+        query = FakePagedQuery(total_results=10, page_size=1)
+        client = self.client(query, page_workers=2)
+        pages = client._fetch_pages({'max_results': 1})
+        self.addCleanup(pages.close)
+        next(pages)
+        next(pages)
+        # Wait for the requests already made to finish.
+        client.close()
+        self.assertEqual(sorted(query.requested), [1, 2, 3, 4])
+
+    @patch('analytics_fetcher.support.ga_client.time.sleep')
+    def test_error_in_later_page(self, sleep):
+        query = FakePagedQuery(total_results=10, page_size=3)
+        fetch = query.get_raw_response
+
+        def get_raw_response(start_index, **kwargs):
+            if start_index == 7:
+                raise http_error(500)
+            return fetch(start_index, **kwargs)
+        query.get_raw_response = get_raw_response
+
+        with self.assertRaises(HttpError):
+            self.rows(self.client(query, page_workers=4))
+
+
+class FakeSamplingQuery(object):
+    """Serves page views for a set of paths, honouring pagePath filters.
+
+    Any query which matches more than `max_unsampled` paths is answered
+    with sampled data, with every count halved.
+    """
+    def __init__(self, views, max_unsampled):
+        self.views = views
+        self.max_unsampled = max_unsampled
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def matches(self, filters, path):
+        for expression in filters.split(';') if filters else []:
+            negate = '!~' in expression
+            _, regex = re.split('=~|!~', expression, maxsplit=1)
+            if (re.search(regex, path, re.IGNORECASE) is None) != negate:
+                return False
+        return True
+
+    def get_raw_response(self, start_index, **kwargs):
+        filters = kwargs.get('filters')
+        with self.lock:
+            self.requested.append(filters)
+        paths = [
+            path for path in sorted(self.views)
+            if self.matches(filters, path)
+        ]
+        sampled = len(paths) > self.max_unsampled
+        resp = {
+            'totalResults': len(paths),
+            'columnHeaders': [
+                {'name': 'ga:pagePath', 'dataType': 'STRING'},
+                {'name': 'ga:uniquePageViews', 'dataType': 'INTEGER'},
+            ],
+            'rows': [
+                [path, str(self.views[path] // 2 if sampled else
+                           self.views[path])]
+                for path in paths
+            ],
+        }
+        if sampled:
+            resp.update(
+                containsSampledData=True, sampleSize=1, sampleSpace=2)
+        return resp
+
+
+class TestGAClientSplitSampled(unittest.TestCase):
+    """
+    Testing that GAClient splits sampled queries into unsampled slices
+    """
+    VIEWS = {
+        '/': 50, '/about': 8, '/bank-holidays': 40, '/browse': 6,
+        '/browse/tax': 4, '/government': 12, '/government/news': 10,
+        '/government/organisations': 10, '/guidance': 2, '/vat-rates': 30,
+        '/1': 1, '(not set)': 3,
+    }
+
+    def client(self, query, **kwargs):
+        client = GAClient(
+            None, None, RateLimiter(qps=1000.0, burst=1000), **kwargs)
+        client.oauth_client = Mock(return_value=Mock(query=query))
+        self.addCleanup(client.close)
+        return client
+
+    def params(self):
+        return {
+            'dimensions': 'ga:pagePath',
+            'metrics': 'ga:uniquePageViews',
+            'sort': '-ga:uniquePageViews',
+            'max_results': 100,
+        }
+
+    def test_abandons_sampled_query(self):
+        query = FakeSamplingQuery(self.VIEWS, max_unsampled=3)
+        client = self.client(query)
+        with self.assertRaises(_SampledData):
+            list(client._query_ga(
+                'search', {}, self.params(), abandon_if_sampled=True))
+        rows = list(client._query_ga('search', {}, self.params()))
+        self.assertEqual(len(rows), len(self.VIEWS))
+        self.assertTrue(all(row['sampled'] for row in rows))
+
+    def test_slices_give_exact_rows(self):
+        query = FakeSamplingQuery(self.VIEWS, max_unsampled=3)
+        client = self.client(query, split_ways=2)
+        rows = client._query_ga_in_slices('search', {}, self.params())
+
+        expected = sorted(
+            self.VIEWS.items(), key=lambda item: -item[1])
+        self.assertEqual(
+            sorted(
+                [(row['pagePath'], row['uniquePageViews']) for row in rows],
+                key=lambda item: -item[1]),
+            expected)
+        self.assertEqual(
+            [row['uniquePageViews'] for row in rows],
+            [views for _, views in expected])
+        self.assertFalse(any('sampled' in row for row in rows))
+        # Some slices had to be split down to the second letter of the path.
+        self.assertTrue(any(
+            filters.startswith('ga:pagePath=~^/g[')
+            for filters in query.requested))
+
+    def test_keeps_sampled_rows_beyond_max_depth(self):
+        query = FakeSamplingQuery(self.VIEWS, max_unsampled=1)
+        client = self.client(query, split_ways=2, max_split_depth=2)
+        with self.assertLogs(
+                'analytics_fetcher.support.ga_client', 'ERROR') as logs:
+            rows = client._query_ga_in_slices('search', {}, self.params())
+        self.assertEqual(
+            sorted(row['pagePath'] for row in rows), sorted(self.VIEWS))
+        sampled = sorted(row['pagePath'] for row in rows if 'sampled' in row)
+        self.assertEqual(sampled, [
+            '/bank-holidays', '/browse', '/browse/tax',
+            '/government', '/government/news', '/government/organisations',
+            '/guidance',
+        ])
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("ga:pagePath=~^/b[a-u] is still sampled",
+                      logs.output[0])
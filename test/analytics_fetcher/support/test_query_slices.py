@@ -0,0 +1,135 @@
+"""
+Unit tests for query_slices.py
+"""
+import re
+import unittest
+
+from analytics_fetcher.support.query_slices import (
+    ALPHABET,
+    PathSlice,
+    add_filter,
+    char_class,
+    escape,
+    initial_slices,
+    sort_rows,
+)
+
+
+PATHS = [
+    '/', '/a', '/about', '/Browse', '/browse/tax', '/government/news',
+    '/g', '/zz', '/1-2-3', '/-', '/_x', '/.well-known', '/%7Efoo',
+    '/government/', '/government.', '/governmentx', '/?q=1', '/(x)',
+    '(not set)', 'www.gov.uk/x', '',
+]
+
+
+def matches(filters, path):
+    """Evaluate a GA filter expression of ANDed regex filters on a path."""
+    for expression in filters.split(';'):
+        negate = '!~' in expression
+        _, regex = re.split('=~|!~', expression, maxsplit=1)
+        found = re.search(regex, path, re.IGNORECASE) is not None
+        if found == negate:
+            return False
+    return True
+
+
+class TestPathSlices(unittest.TestCase):
+    def assertPartition(self, slices, paths):
+        for path in paths:
+            covering = [
+                path_slice for path_slice in slices
+                if matches(path_slice.filters('ga:pagePath'), path)
+            ]
+            self.assertEqual(
+                len(covering), 1, "%r is covered by %r" % (path, covering))
+
+    def test_initial_slices_partition_paths(self):
+        slices = initial_slices(4)
+        self.assertEqual(len(slices), 6)
+        self.assertPartition(slices, PATHS)
+
+    def test_split_slices_partition_the_slice(self):
+        path_slice = PathSlice('/', 'abcdefg')
+        paths = [path for path in PATHS if matches(
+            path_slice.filters('ga:pagePath'), path)]
+        self.assertEqual(
+            paths, ['/a', '/about', '/Browse', '/browse/tax',
+                    '/government/news', '/g', '/government/',
+                    '/government.', '/governmentx'])
+
+        children = path_slice.split(4)
+        self.assertEqual(
+            [child.letters for child in children], ['ab', 'cd', 'ef', 'g'])
+        self.assertPartition(children, paths)
+
+        grandchildren = children[0].split(4)
+        self.assertEqual(len(grandchildren), 2)
+        self.assertPartition(grandchildren, paths[:4])
+
+        under_g = children[3].split(4)
+        self.assertEqual(under_g[0], PathSlice('/g', 'abcdefghijk'))
+        self.assertEqual(under_g[-1], PathSlice('/g', None))
+        self.assertPartition(under_g, ['/g', '/government/news'])
+
+    def test_remainder_holds_only_rare_characters(self):
+        remainder = PathSlice('/', None)
+        self.assertEqual(
+            [path for path in PATHS
+             if matches(remainder.filters('ga:pagePath'), path)],
+            ['/', '/?q=1', '/(x)'])
+
+    def test_slices_after_non_letters(self):
+        path_slice = PathSlice('/government', './')
+        self.assertEqual(
+            path_slice.filters('ga:pagePath'), 'ga:pagePath=~^/government[./]')
+        children = path_slice.split(4)
+        self.assertEqual(
+            children, [PathSlice('/government', '.'),
+                       PathSlice('/government', '/')])
+        self.assertPartition(
+            children[1].split(4), ['/government/', '/government/news'])
+
+    def test_prefix_escaped(self):
+        path_slice = PathSlice('/a.b', None)
+        self.assertEqual(
+            path_slice.filters('ga:pagePath'),
+            'ga:pagePath=~^/a\\.b;ga:pagePath!~^/a\\.b[a-z0-9\\-_./%]')
+        self.assertTrue(matches(path_slice.filters('ga:pagePath'), '/a.b'))
+        self.assertFalse(matches(path_slice.filters('ga:pagePath'), '/axb'))
+        self.assertEqual(escape('/a,b;c(d)'), '/a\\,b\\;c\\(d\\)')
+
+    def test_char_class(self):
+        self.assertEqual(char_class(ALPHABET), '[a-z0-9\\-_./%]')
+        self.assertEqual(char_class('abd'), '[abd]')
+        self.assertEqual(char_class('xyz012'), '[x-z0-2]')
+
+    def test_remainder_not_splittable(self):
+        self.assertFalse(PathSlice('/', None).splittable)
+        self.assertFalse(PathSlice(None, None).splittable)
+        self.assertRaises(ValueError, PathSlice('/', None).split, 4)
+
+    def test_add_filter(self):
+        self.assertEqual(
+            add_filter({'ids': 'x'}, 'ga:pagePath=~^/a'),
+            {'ids': 'x', 'filters': 'ga:pagePath=~^/a'})
+        self.assertEqual(
+            add_filter({'filters': 'ga:x==1'}, 'ga:pagePath=~^/a'),
+            {'filters': 'ga:x==1;ga:pagePath=~^/a'})
+
+    def test_sort_rows(self):
+        rows = [
+            {'path': '/a', 'views': 1},
+            {'path': '/b', 'views': 3},
+            {'path': '/c', 'views': 1},
+            {'path': '/d', 'views': 3},
+        ]
+        self.assertEqual(
+            [row['path'] for row in sort_rows(
+                list(rows), '-ga:uniquePageViews',
+                {'uniquePageViews': 'views'})],
+            ['/b', '/d', '/a', '/c'])
+        self.assertEqual(
+            [row['path'] for row in sort_rows(
+                list(rows), 'ga:views,-ga:path', {})],
+            ['/c', '/a', '/d', '/b'])
@@ -0,0 +1,78 @@
+"""
+Unit tests for rate_limiter.py
+"""
+import unittest
+
+from analytics_fetcher.support.rate_limiter import RateLimiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Testing the RateLimiter token bucket
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, **kwargs):
+        return RateLimiter(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_burst_then_steady_rate(self):
+        """
+        Testing that a burst is allowed immediately, then requests are spaced
+        """
+        limiter = self.limiter(qps=2.0, burst=3)
+        waits = [limiter.acquire() for _ in range(5)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.5, 0.5])
+        self.assertEqual(limiter.total_wait, 1.0)
+        self.assertEqual(limiter.requests, 5)
+
+    def test_refills_while_idle(self):
+        """
+        Testing that tokens accumulate, up to the burst size, when idle
+        """
+        limiter = self.limiter(qps=1.0, burst=2)
+        limiter.acquire()
+        limiter.acquire()
+        self.clock.now += 10
+        self.assertEqual([limiter.acquire() for _ in range(3)], [0.0, 0.0, 1.0])
+
+    def test_throttled_halves_rate_and_backs_off(self):
+        """
+        Testing that throttling lowers the rate, and success recovers it
+        """
+        limiter = self.limiter(qps=4.0, burst=1, max_backoff=3.0)
+        delays = [limiter.throttled(attempt) for attempt in range(4)]
+        self.assertEqual(limiter.rate, 0.25)
+        self.assertEqual(limiter.throttles, 4)
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= min(3.0, 2 ** attempt))
+        for _ in range(20):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 4.0)
+
+    def test_throttled_respects_min_qps(self):
+        """
+        Testing that the rate never drops below min_qps
+        """
+        limiter = self.limiter(qps=1.0, min_qps=0.5)
+        limiter.throttled(0)
+        limiter.throttled(1)
+        self.assertEqual(limiter.rate, 0.5)
+
+    def test_invalid_arguments(self):
+        """
+        Testing that nonsensical limits are rejected
+        """
+        self.assertRaises(ValueError, RateLimiter, qps=0)
+        self.assertRaises(ValueError, RateLimiter, burst=0)
@@ -0,0 +1,135 @@
+"""
+Unit tests for telemetry.py
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from analytics_fetcher.fetch import fetch
+from analytics_fetcher.support.ga_client import GAError
+from analytics_fetcher.support.telemetry import Telemetry, quantile
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def page(rows, total_results, sampled=False):
+    resp = {
+        'totalResults': total_results,
+        'rows': [['/%d' % i, str(i)] for i in range(rows)],
+    }
+    if sampled:
+        resp['containsSampledData'] = True
+    return resp
+
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.telemetry = Telemetry(clock=self.clock)
+        params = {'start_date': '2020-01-01', 'end_date': '2020-01-01'}
+        for _ in range(3):
+            self.telemetry.ga_hook(params)
+        self.telemetry.record_request(
+            dict(params, start_index=1), page(2, 3), 0.5, 1.0)
+        self.telemetry.record_request(
+            dict(params, start_index=3), page(1, 3, sampled=True), 0.25, 0.0)
+        self.telemetry.record_request(
+            params, page(0, 0), 2.0, 0.0, batched=True)
+        self.telemetry.record_cache(True)
+        self.telemetry.record_cache(False)
+        self.clock.now += 10
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_quantile(self):
+        self.assertEqual(quantile([], 0.5), None)
+        self.assertEqual(quantile([1], 0.99), 1)
+        self.assertEqual(quantile(list(range(1, 101)), 0.5), 50)
+        self.assertEqual(quantile(list(range(1, 101)), 0.99), 99)
+        self.assertEqual(quantile([1, 2, 3, 4, 5], 0.5), 3)
+        self.assertEqual(quantile([1, 2, 3, 4, 5], 0.9), 5)
+        self.assertEqual(quantile([1, 2, 3], 0.5), 2)
+
+    def test_summary(self):
+        summary = self.telemetry.summary()
+        totals = summary['totals']
+        self.assertEqual(totals['run_seconds'], 10)
+        self.assertEqual(totals['ga_calls'], 3)
+        self.assertEqual(totals['requests'], 3)
+        self.assertEqual(totals['batched_requests'], 1)
+        self.assertEqual(totals['queries'], 2)
+        self.assertEqual(totals['sampled_requests'], 1)
+        self.assertEqual(totals['rows'], 3)
+        self.assertEqual(totals['request_seconds'], 2.75)
+        self.assertEqual(totals['rate_limit_wait_seconds'], 1.0)
+        self.assertEqual(totals['cache_hits'], 1)
+        self.assertEqual(totals['cache_misses'], 1)
+        self.assertEqual(
+            totals['bytes'],
+            sum(request['bytes'] for request in summary['requests']))
+        self.assertEqual(summary['latency_seconds'], {
+            'max': 2.0, 'p50': 0.5, 'p90': 2.0, 'p99': 2.0,
+        })
+        self.assertEqual(summary['requests'][1]['start_index'], 3)
+        self.assertEqual(summary['requests'][1]['total_results'], 3)
+
+    def test_write_json(self):
+        path = os.path.join(self.tmpdir, 'telemetry.json')
+        self.telemetry.write_json(path)
+        with open(path) as fobj:
+            data = json.load(fobj)
+        self.assertEqual(data['totals']['requests'], 3)
+        self.assertEqual(len(data['requests']), 3)
+        self.assertEqual(os.listdir(self.tmpdir), ['telemetry.json'])
+
+    def test_write_prometheus(self):
+        path = os.path.join(self.tmpdir, 'fetch.prom')
+        self.telemetry.write_prometheus(path)
+        with open(path) as fobj:
+            lines = fobj.read().splitlines()
+        self.assertIn('search_analytics_fetch_requests 3', lines)
+        self.assertIn('search_analytics_fetch_cache_hits 1', lines)
+        self.assertIn(
+            'search_analytics_fetch_rate_limit_wait_seconds 1.0', lines)
+        self.assertIn(
+            '# TYPE search_analytics_fetch_request_latency_seconds summary',
+            lines)
+        self.assertIn(
+            'search_analytics_fetch_request_latency_seconds'
+            '{quantile="0.5"} 0.5', lines)
+        self.assertIn(
+            'search_analytics_fetch_request_latency_seconds_count 3', lines)
+        for line in lines:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                float(value)
+
+    def test_empty_prometheus(self):
+        path = os.path.join(self.tmpdir, 'fetch.prom')
+        Telemetry().write_prometheus(path)
+        with open(path) as fobj:
+            text = fobj.read()
+        self.assertIn(
+            'search_analytics_fetch_request_latency_seconds'
+            '{quantile="0.9"} NaN', text)
+
+    def test_written_when_fetch_fails(self):
+        path = os.path.join(self.tmpdir, 'fetch.json')
+        with patch('analytics_fetcher.fetch.ClientContext', MagicMock()), \
+                patch('analytics_fetcher.fetch.fetch_page_traffic',
+                      side_effect=GAError("HTTP error")):
+            with self.assertRaises(GAError):
+                fetch(os.path.join(self.tmpdir, 'page-traffic.dump'), [1],
+                      telemetry_json=path)
+        with open(path) as fobj:
+            self.assertEqual(json.load(fobj)['totals']['requests'], 0)
@@ -1,7 +1,11 @@
 from collections import Counter
 import unittest
 
-from analytics_fetcher.analysis import normalise_path, page_traffic
+from analytics_fetcher.analysis import (
+    normalise_path,
+    page_traffic,
+    PathNormaliser,
+)
 
 
 class TestAnalysis(unittest.TestCase):
@@ -60,3 +64,32 @@ class TestAnalysis(unittest.TestCase):
         expected = Counter({'/wilma': 401, '/fred': 250})
 
         self.assertEqual(page_traffic(traffic), expected)
+
+    def test_path_normaliser_matches_normalise_path(self):
+        paths = [
+            'hello-world', '/y/', '/y/hello-world', '/hello-world?foo=bar',
+            '/hello-world/', '/', '/a/y/b?c', '/why/y', '/hello-world',
+        ]
+        normaliser = PathNormaliser()
+        expected = {path: normalise_path(path) for path in paths}
+        self.assertEqual(normaliser.normalise_all(paths), expected)
+        self.assertEqual(normaliser.normalise_all(paths), expected)
+        for path in paths:
+            self.assertEqual(normaliser.normalise(path), expected[path])
+
+    def test_path_normaliser_is_bounded(self):
+        normaliser = PathNormaliser(max_size=3)
+        for i in range(10):
+            self.assertEqual(normaliser.normalise('/p%d/' % i), '/p%d' % i)
+            self.assertTrue(len(normaliser._normalised) <= 3)
+
+    def test_page_traffic_with_shared_normaliser(self):
+        normaliser = PathNormaliser()
+        traffic = {
+            '/fred': [250, False],
+            '/fred?x=1': [1, False],
+            '/y/wilma': [400, False],
+        }
+        expected = Counter({'/fred': 251})
+        self.assertEqual(page_traffic(traffic, normaliser), expected)
+        self.assertEqual(page_traffic(traffic, normaliser), expected)
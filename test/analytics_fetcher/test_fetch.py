@@ -0,0 +1,365 @@
+import datetime
+import shutil
+import socket
+import time
+import unittest
+from unittest.mock import Mock
+
+from analytics_fetcher.fetch import (
+    fetch_page_traffic,
+    format_plan,
+    plan,
+    plan_fetch,
+)
+from analytics_fetcher.ga import GAData
+from analytics_fetcher.support.ga_client import CacheMissError, GAClient
+from test.analytics_fetcher.helpers import TempCacheDirMixin
+
+
+class FakeGAClient(object):
+    """Serves canned rows for each date, slower for more recent dates so that
+    concurrent fetches complete out of order.
+
+    """
+    def __init__(self, rows_by_date):
+        self.rows_by_date = rows_by_date
+
+    def fetch(self, profile_name, date, **kwargs):
+        time.sleep(0.002 * (len(self.rows_by_date) - len(
+            [d for d in self.rows_by_date if d > date])))
+        return list(self.rows_by_date[date])
+
+
+class TestFetchPageTraffic(unittest.TestCase):
+    def setUp(self):
+        self.today = datetime.date(2020, 1, 10)
+        rows_by_date = {}
+        for days_ago in range(1, 8):
+            date = self.today - datetime.timedelta(days=days_ago)
+            rows_by_date[date] = [
+                {'path': '/day-%d' % days_ago, 'views': 5, 'title': 't'},
+                {'path': '/fred?x=%d' % days_ago, 'views': days_ago,
+                 'title': 't'},
+                {'path': '/wilma', 'views': 10, 'title': 't'},
+            ]
+        self.client = FakeGAClient(rows_by_date)
+
+    def test_fetch_page_traffic(self):
+        result = fetch_page_traffic(self.client, self.today, [1, 2])
+        self.assertEqual(result['/wilma'], {1: [1, 10, 10.0 / 16],
+                                            2: [1, 20, 20.0 / 33]})
+        self.assertEqual(result['/fred'], {1: [3, 1, 1.0 / 16],
+                                           2: [4, 3, 3.0 / 33]})
+        self.assertEqual(result['/day-2'], {2: [3, 5, 5.0 / 33]})
+
+    def test_concurrent_fetch_matches_sequential(self):
+        sequential = fetch_page_traffic(self.client, self.today, [3, 7])
+        concurrent = fetch_page_traffic(
+            self.client, self.today, [3, 7], workers=4)
+        # Compare as lists so that ordering (and hence tie-breaking of
+        # ranks) is checked too.
+        self.assertEqual(
+            [(page, list(info.items())) for page, info in sequential.items()],
+            [(page, list(info.items())) for page, info in concurrent.items()],
+        )
+
+    def test_windows_are_summed_in_one_pass(self):
+        calls = []
+        fetch = self.client.fetch
+
+        def counting_fetch(profile_name, date, **kwargs):
+            calls.append(date)
+            return fetch(profile_name, date, **kwargs)
+        self.client.fetch = counting_fetch
+
+        result = fetch_page_traffic(self.client, self.today, [7, 2, 2])
+        self.assertEqual(len(calls), 7)
+        self.assertEqual(result['/wilma'], {7: [1, 70, 70.0 / 133],
+                                            2: [1, 20, 20.0 / 33]})
+        self.assertEqual(result['/day-7'], {7: [9, 5, 5.0 / 133]})
+
+
+def ga_page(rows):
+    return {
+        'totalResults': len(rows),
+        'columnHeaders': [
+            {'name': 'ga:pagePath', 'dataType': 'STRING'},
+            {'name': 'ga:pageTitle', 'dataType': 'STRING'},
+            {'name': 'ga:uniquePageViews', 'dataType': 'INTEGER'},
+        ],
+        'rows': [
+            [row['path'], row['title'], str(row['views'])] for row in rows
+        ],
+    }
+
+
+class TestOfflineAndPlan(TempCacheDirMixin, unittest.TestCase):
+    """
+    Testing building output from the cache alone, and planning fetches
+    """
+    def setUp(self):
+        super().setUp()
+        self.today = datetime.date(2020, 1, 10)
+        self.rows = [
+            {'path': '/fred', 'views': 5, 'title': 't'},
+            {'path': '/wilma', 'views': 10, 'title': 't'},
+        ]
+        # Fill the cache for the most recent three days.
+        online = GAClient(None, self.make_cache_manager(), page_workers=1)
+        online._get_raw_response = lambda **kwargs: (ga_page(self.rows), 0.0)
+        fetch_page_traffic(online, self.today, [3])
+
+    def offline_client(self):
+        return GAClient(None, self.make_cache_manager(), offline=True)
+
+    def test_offline_served_from_cache(self):
+        result = fetch_page_traffic(self.offline_client(), self.today, [3])
+        self.assertEqual(result['/wilma'], {3: [1, 30, 30.0 / 45]})
+
+    def test_offline_missing_day(self):
+        with self.assertRaises(CacheMissError):
+            fetch_page_traffic(self.offline_client(), self.today, [4])
+
+    def test_plan(self):
+        days = plan_fetch(self.offline_client(), self.today, [2, 5])
+        self.assertEqual(
+            [(day['days_ago'], day['cached'], day['rows'], day['requests'])
+             for day in days],
+            [(1, True, 2, 0), (2, True, 2, 0), (3, True, 2, 0),
+             (4, False, None, 1), (5, False, None, 1)],
+        )
+        self.assertEqual(days[3]['date'], datetime.date(2020, 1, 6))
+        report = format_plan(days)
+        self.assertIn("   1  2020-01-09  cache: 2 rows", report)
+        self.assertIn("   4  2020-01-06  GA: ~1 requests", report)
+        self.assertTrue(report.endswith(
+            "3 of 5 days cached; 2 days to fetch from GA in about 2 "
+            "requests"))
+
+    def test_plan_without_cached_days(self):
+        days = plan([2], today=datetime.date(2019, 1, 1))
+        self.assertEqual([day['requests'] for day in days], [None, None])
+        self.assertIn("GA: 1+ requests", format_plan(days))
+
+
+class FakeBatch(object):
+    def __init__(self, batches, rows, error=None):
+        self.batches = batches
+        self.rows = rows
+        self.error = error
+        self.queries = []
+
+    def get_raw_response(self, callback=None, **kwargs):
+        self.queries.append((callback, kwargs))
+
+    def execute(self):
+        self.batches.append([kwargs for _, kwargs in self.queries])
+        for callback, kwargs in self.queries:
+            if self.error is not None:
+                raise self.error
+            callback(ga_page(self.rows), None)
+
+
+class TestBatchedFirstPages(TempCacheDirMixin, unittest.TestCase):
+    """
+    Testing fetching the first pages of all the days in batches
+    """
+    def setUp(self):
+        super().setUp()
+        self.today = datetime.date(2020, 1, 10)
+        self.rows = [
+            {'path': '/fred', 'views': 5, 'title': 't'},
+            {'path': '/wilma', 'views': 10, 'title': 't'},
+        ]
+        self.batches = []
+        self.batch_error = None
+        self.single_requests = []
+        self.client = GAClient(
+            None, self.make_cache_manager(), page_workers=1)
+        query = Mock()
+        query.batch = lambda: FakeBatch(
+            self.batches, self.rows, self.batch_error)
+        self.client.oauth_client = Mock(return_value=Mock(query=query))
+
+        def get_raw_response(**kwargs):
+            self.single_requests.append(kwargs)
+            return ga_page(self.rows), 0.0
+        self.client._get_raw_response = get_raw_response
+
+    def test_first_pages_batched(self):
+        batched = fetch_page_traffic(
+            self.client, self.today, [3], batch=True)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(
+            [kwargs['start_date'] for kwargs in self.batches[0]],
+            ['2020-01-09', '2020-01-08', '2020-01-07'])
+        self.assertEqual(self.single_requests, [])
+        self.assertEqual(batched['/wilma'], {3: [1, 30, 30.0 / 45]})
+
+    def test_cached_days_not_batched(self):
+        fetch_page_traffic(self.client, self.today, [2])
+        self.assertEqual(len(self.single_requests), 2)
+        fetch_page_traffic(self.client, self.today, [3], batch=True)
+        self.assertEqual(
+            [kwargs['start_date'] for kwargs in self.batches[0]],
+            ['2020-01-07'])
+        self.assertEqual(len(self.single_requests), 2)
+
+    def test_transport_error_falls_back_to_single_requests(self):
+        self.batch_error = socket.timeout("timed out")
+        with self.assertLogs('analytics_fetcher', 'WARNING'):
+            result = fetch_page_traffic(
+                self.client, self.today, [3], batch=True)
+        self.assertEqual(
+            [kwargs['start_date'] for kwargs in self.single_requests],
+            ['2020-01-09', '2020-01-08', '2020-01-07'])
+        self.assertEqual(result['/wilma'], {3: [1, 30, 30.0 / 45]})
+
+    def test_unused_first_pages_dropped_on_close(self):
+        self.client.prefetch_first_pages([
+            GAData(self.client, self.today).traffic_prefetch_query()])
+        self.assertEqual(len(self.client._first_pages), 1)
+        self.client.close()
+        self.assertEqual(self.client._first_pages, {})
+
+
+class TestDateRangeQueries(TempCacheDirMixin, unittest.TestCase):
+    """
+    Testing fetching several days in one query, split into per-day entries
+    """
+    def setUp(self):
+        super().setUp()
+        self.today = datetime.date(2020, 1, 10)
+        self.requests = []
+        self.sample_ranges = False
+        # If set, range queries are served in pages of this many rows, and
+        # sampled from the page starting at sample_from.
+        self.range_page_size = None
+        self.sample_from = None
+        self.client = GAClient(
+            None, self.make_cache_manager(), page_workers=1)
+        self.client._get_raw_response = self.get_raw_response
+
+    def day_rows(self, date_str):
+        day = int(date_str[-2:])
+        return [
+            {'path': '/day-%d' % day, 'views': day, 'title': 't'},
+            {'path': '/wilma', 'views': 10, 'title': 't'},
+        ]
+
+    def get_raw_response(self, **params):
+        self.requests.append(params)
+        start = datetime.datetime.strptime(params['start_date'], '%Y-%m-%d')
+        end = datetime.datetime.strptime(params['end_date'], '%Y-%m-%d')
+        if params['dimensions'].startswith('ga:date,'):
+            rows = []
+            date = start
+            while date <= end:
+                rows.extend(
+                    [date.strftime('%Y%m%d'), row['path'], row['title'],
+                     str(row['views'])]
+                    for row in self.day_rows(date.strftime('%Y%m%d')))
+                date += datetime.timedelta(days=1)
+            page = ga_page([])
+            page['columnHeaders'].insert(
+                0, {'name': 'ga:date', 'dataType': 'STRING'})
+            page['totalResults'] = len(rows)
+            start_index = params.get('start_index', 1)
+            if self.range_page_size:
+                rows = rows[
+                    start_index - 1:start_index - 1 + self.range_page_size]
+            page['rows'] = rows
+            if self.sample_ranges or (
+                    self.sample_from and start_index >= self.sample_from):
+                page.update(
+                    containsSampledData=True, sampleSize=1, sampleSpace=2)
+            return page, 0.0
+        return ga_page(self.day_rows(start.strftime('%Y%m%d'))), 0.0
+
+    def test_range_matches_daily(self):
+        daily = fetch_page_traffic(self.client, self.today, [2, 5])
+        self.assertEqual(len(self.requests), 5)
+
+        shutil.rmtree(self.cache_dir)
+        self.client.cache_manager = self.make_cache_manager()
+        self.requests = []
+        ranged = fetch_page_traffic(
+            self.client, self.today, [2, 5], range_days=3)
+        self.assertEqual(
+            [(r['start_date'], r['end_date']) for r in self.requests],
+            [('2020-01-05', '2020-01-07'), ('2020-01-08', '2020-01-09')])
+        self.assertEqual(
+            [(page, list(info.items())) for page, info in daily.items()],
+            [(page, list(info.items())) for page, info in ranged.items()],
+        )
+
+    def test_days_served_from_cache_afterwards(self):
+        fetch_page_traffic(self.client, self.today, [4], range_days=31)
+        self.assertEqual(len(self.requests), 1)
+        self.requests = []
+        fetch_page_traffic(self.client, self.today, [4])
+        self.assertEqual(self.requests, [])
+        entry = GAData(
+            self.client, datetime.date(2020, 1, 8)).traffic_cache_entry()
+        self.assertEqual(entry['rows'], 2)
+
+    def test_only_uncached_days_fetched(self):
+        fetch_page_traffic(self.client, self.today, [1])
+        fetch_page_traffic(self.client, self.today, [3], range_days=31)
+        self.assertEqual(
+            [(r['start_date'], r['end_date']) for r in self.requests],
+            [('2020-01-09', '2020-01-09'), ('2020-01-07', '2020-01-08')])
+
+    def test_range_sorted_by_date(self):
+        fetch_page_traffic(self.client, self.today, [3], range_days=31)
+        self.assertEqual(
+            [r['sort'] for r in self.requests],
+            ['ga:date,-ga:uniquePageViews'])
+
+    def test_days_before_sampled_page_cached(self):
+        # Two rows a day, so the first page has all of the first day, and
+        # the start of the second, which is only finished on the sampled
+        # page.
+        self.range_page_size = 3
+        self.sample_from = 4
+        self.assertEqual(self.client.prefetch_date_ranges([
+            GAData(self.client, datetime.date(2020, 1, day))
+            .traffic_prefetch_query()
+            for day in (7, 8, 9)
+        ]), 1)
+        self.assertEqual(
+            [GAData(self.client, datetime.date(2020, 1, day))
+             .traffic_cache_entry()['cached'] for day in (7, 8, 9)],
+            [True, False, False])
+        rows = list(GAData(
+            self.client, datetime.date(2020, 1, 7)).get_traffic_from_api())
+        self.assertEqual(rows, [
+            {'path': '/day-7', 'views': 7, 'title': 't'},
+            {'path': '/wilma', 'views': 10, 'title': 't'},
+        ])
+
+    def test_sampled_range_left_uncached(self):
+        self.sample_ranges = True
+        self.assertEqual(self.client.prefetch_date_ranges([
+            GAData(self.client, datetime.date(2020, 1, day))
+            .traffic_prefetch_query()
+            for day in (7, 8, 9)
+        ]), 0)
+        self.assertEqual(len(self.requests), 1)
+        self.assertFalse(any(
+            GAData(self.client, datetime.date(2020, 1, day))
+            .traffic_cache_entry()['cached']
+            for day in (7, 8, 9)))
+
+        self.requests = []
+        fetch_page_traffic(self.client, self.today, [3], range_days=31)
+        self.assertEqual(
+            [(r['start_date'], r['end_date']) for r in self.requests],
+            [('2020-01-07', '2020-01-09'), ('2020-01-09', '2020-01-09'),
+             ('2020-01-08', '2020-01-08'), ('2020-01-07', '2020-01-07')])
+        rows = list(GAData(
+            self.client, datetime.date(2020, 1, 8)).get_traffic_from_api())
+        self.assertEqual(rows, [
+            {'path': '/day-8', 'views': 8, 'title': 't'},
+            {'path': '/wilma', 'views': 10, 'title': 't'},
+        ])
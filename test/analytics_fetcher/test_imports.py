@@ -0,0 +1,39 @@
+"""
+Check that slow, rarely needed libraries aren't imported up front
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+DEFERRED = ['apiclient', 'googleapiclient', 'oauth2client', 'httplib2',
+            'requests']
+
+
+def modules_loaded_by(module):
+    """Import a module in a fresh interpreter and list all loaded modules."""
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, %s; print("\\n".join(sys.modules))' % module],
+        cwd=ROOT, universal_newlines=True,
+    )
+    return set(name.split('.')[0] for name in output.split())
+
+
+class TestDeferredImports(unittest.TestCase):
+    def assertDeferred(self, module):
+        loaded = modules_loaded_by(module)
+        self.assertEqual(
+            sorted(loaded.intersection(DEFERRED)), [],
+            "importing %s loaded libraries which should be deferred" % (
+                module,))
+
+    def test_fetch(self):
+        self.assertDeferred('analytics_fetcher.fetch')
+
+    def test_gapy_async_client(self):
+        self.assertDeferred('gapy.async_client')
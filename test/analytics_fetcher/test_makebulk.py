@@ -1,6 +1,10 @@
 import unittest
 
-from analytics_fetcher.makebulk import page_info_docs, path_components
+from analytics_fetcher.makebulk import (
+    page_info_docs,
+    path_components,
+    PathTrie,
+)
 
 
 class TestMakebulk(unittest.TestCase):
@@ -10,6 +14,20 @@ class TestMakebulk(unittest.TestCase):
     def test_multiple_components(self):
         self.assertEqual(path_components('/fred/wilma'), ['/fred', '/fred/wilma'])
 
+    def test_path_trie_matches_path_components(self):
+        trie = PathTrie()
+        for path in ['/fred', '/fred/wilma', '/', '//fred', '/fred//wilma',
+                     '/fred/wilma/', 'fred', '', '/barney/fred']:
+            self.assertEqual(trie.components(path), path_components(path))
+
+    def test_path_trie_shares_prefixes(self):
+        trie = PathTrie()
+        first = trie.components('/government/publications/a')
+        second = trie.components('/government/publications/b')
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertEqual(second[2], '/government/publications/b')
+
     def test_page_info_docs(self):
         traffic = {
             "/fred": { 1: [1, 10, 0.1] }
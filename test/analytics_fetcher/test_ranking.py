@@ -0,0 +1,12 @@
+import unittest
+
+from analytics_fetcher.ranking import rank_counts
+
+
+class TestRanking(unittest.TestCase):
+    def test_rank_counts_ties_ranked_by_position(self):
+        order, ranks, fractions = rank_counts([5, 10, 5, 1])
+        self.assertEqual(order.tolist(), [1, 0, 2, 3])
+        self.assertEqual(ranks.tolist(), [2, 1, 3, 4])
+        self.assertEqual(fractions.tolist(), [5 / 21, 10 / 21, 5 / 21, 1 / 21])
+
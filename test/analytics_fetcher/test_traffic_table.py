@@ -0,0 +1,153 @@
+from collections import Counter
+import random
+import unittest
+
+from analytics_fetcher.makebulk import page_info_docs, path_components
+from analytics_fetcher.traffic_table import TrafficTable
+
+
+def reference_rank_buckets(traffic_buckets):
+    """The original, pure python, ranking."""
+    views_per_day = {
+        days_ago: sum(bucket.values())
+        for days_ago, bucket in list(traffic_buckets.items())
+    }
+    traffic_by_page = {}
+    for days_ago, bucket in list(traffic_buckets.items()):
+        ranked = sorted(list(bucket.items()), key=lambda x: x[1], reverse=True)
+        for rank, (page, views) in enumerate(ranked, 1):
+            traffic_by_page.setdefault(page, {})[days_ago] = [
+                rank, views, float(views) / views_per_day[days_ago]
+            ]
+    return traffic_by_page
+
+
+def build(days, windows):
+    """Build a TrafficTable, and the equivalent buckets of Counters."""
+    table = TrafficTable(windows)
+    running = Counter()
+    buckets = {}
+    for days_ago, traffic in enumerate(days, 1):
+        table.add(traffic)
+        running.update(traffic)
+        if days_ago in windows:
+            table.snapshot(days_ago)
+            buckets[days_ago] = Counter(running)
+    table.rank()
+    return table, {days_ago: buckets[days_ago] for days_ago in windows}
+
+
+class TestTrafficTable(unittest.TestCase):
+    def test_lookup(self):
+        table, _ = build([
+            {'/fred': 10, '/wilma': 30},
+            {'/fred': 10, '/barney': 20},
+        ], [1, 2])
+        self.assertEqual(len(table), 3)
+        self.assertIn('/barney', table)
+        self.assertNotIn('/betty', table)
+        self.assertEqual(table['/fred'], {1: [2, 10, 0.25], 2: [2, 20, 20 / 70]})
+        self.assertEqual(table['/barney'], {2: [3, 20, 20 / 70]})
+        self.assertRaises(KeyError, lambda: table['/betty'])
+
+    def test_matches_reference(self):
+        rand = random.Random(7)
+        pages = ['/page-%d' % i for i in range(3000)]
+        days = [
+            Counter({
+                page: rand.randint(0, 20) for page in rand.sample(pages, 400)
+            })
+            for _ in range(7)
+        ]
+        table, buckets = build(days, [3, 7, 1])
+        expected = reference_rank_buckets(buckets)
+        self.assertEqual(
+            [(page, list(info.items())) for page, info in expected.items()],
+            [(page, list(info.items()))
+             for page, info in table.items(chunk_size=100)],
+        )
+        self.assertEqual(table.to_dict(), expected)
+
+    def test_page_info_docs(self):
+        table, buckets = build([{'/fred/wilma': 10}, {'/barney': 5}], [2])
+        self.assertEqual(
+            list(page_info_docs(table)),
+            list(page_info_docs(reference_rank_buckets(buckets))),
+        )
+
+    def test_empty(self):
+        table, _ = build([{}], [1])
+        self.assertEqual(table.to_dict(), {})
+
+    def test_section_rollups(self):
+        table, _ = build([
+            {'/a': 10, '/a/b': 5, '/e': 7},
+            {'/a/c/d': 3, '/e/f': 1},
+        ], [1, 2])
+        sections = table.section_rollups()
+        self.assertEqual(sections.to_dict(), {
+            '/a': {1: [1, 15, 15 / 22], 2: [1, 18, 18 / 26]},
+            '/a/c': {2: [3, 3, 3 / 26]},
+            '/e': {1: [2, 7, 7 / 22], 2: [2, 8, 8 / 26]},
+        })
+
+    def test_section_rollups_match_reference(self):
+        rand = random.Random(3)
+        pages = [
+            '/%s/%s/%d' % (rand.choice('abc'), rand.choice('xyz'), i)
+            for i in range(300)
+        ] + ['/a', '/b/x']
+        days = [
+            Counter({
+                page: rand.randint(0, 9) for page in rand.sample(pages, 60)
+            })
+            for _ in range(5)
+        ]
+        table, buckets = build(days, [2, 5])
+        prefixes = set()
+        for page in buckets[5]:
+            prefixes.update(path_components(page)[:-1])
+        section_buckets = {}
+        for days_ago, bucket in buckets.items():
+            section_bucket = section_buckets[days_ago] = Counter()
+            for page, views in bucket.items():
+                for component in path_components(page):
+                    if component in prefixes:
+                        section_bucket[component] += views
+        sections = table.section_rollups()
+        for days_ago, bucket in section_buckets.items():
+            total = sum(buckets[days_ago].values())
+            self.assertEqual(
+                {
+                    path: info[days_ago][1:]
+                    for path, info in sections.items() if days_ago in info
+                },
+                {
+                    path: [views, views / total]
+                    for path, views in bucket.items()
+                },
+            )
+            ranked = sorted(
+                (info[days_ago] for info in sections.to_dict().values()
+                 if days_ago in info),
+                key=lambda x: x[0])
+            self.assertEqual(
+                [rank for rank, _, _ in ranked], list(range(1, len(bucket) + 1)))
+            self.assertEqual(
+                [views for _, views, _ in ranked],
+                sorted(bucket.values(), reverse=True))
+
+    def test_page_info_docs_with_sections(self):
+        table, _ = build([{'/a/b': 10, '/a': 5}], [1])
+        docs = list(page_info_docs(table, table.section_rollups()))
+        self.assertEqual(docs[2], (
+            {'index': {'_type': 'page-traffic', '_id': 'section:/a'}},
+            {'path_components': ['/a'], 'rank_1': 1, 'vc_1': 15,
+             'vf_1': 1.0, 'section': True},
+        ))
+        # Section and page documents can share an index.
+        ids = [action['index']['_id'] for action, _ in docs]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(
+            set(action['index']['_type'] for action, _ in docs),
+            {'page-traffic'})
@@ -0,0 +1,65 @@
+"""
+Unit tests for the synthetic GA data used by the benchmarks
+"""
+import unittest
+
+from benchmarks.run import BENCHMARKS, compare, run_benchmarks
+from benchmarks.synthetic_ga import NOT_FOUND_TITLE, SyntheticGA
+from gapy.response import QueryResponse
+
+
+class TestSyntheticGA(unittest.TestCase):
+    def test_pages(self):
+        ga = SyntheticGA(2500, page_size=1000)
+        pages = list(ga.pages())
+        self.assertEqual(
+            [len(page['rows']) for page in pages], [1000, 1000, 500])
+        self.assertEqual(
+            [request['start_index'] for request in ga.requests],
+            [1, 1001, 2001])
+        self.assertTrue(all(page['totalResults'] == 2500 for page in pages))
+        self.assertNotIn('nextLink', pages[-1])
+
+        rows = [row for page in pages for row in page['rows']]
+        views = [int(row[2]) for row in rows]
+        self.assertEqual(views, sorted(views, reverse=True))
+        self.assertEqual(len(set((row[0], row[1]) for row in rows)), 2500)
+        self.assertTrue(any('?' in row[0] for row in rows))
+        self.assertTrue(any(row[1] == NOT_FOUND_TITLE for row in rows))
+
+    def test_deterministic(self):
+        self.assertEqual(
+            SyntheticGA(500, seed=1).rows(0, 500),
+            SyntheticGA(500, seed=1).rows(0, 500))
+        self.assertNotEqual(
+            SyntheticGA(500, seed=1).rows(0, 500),
+            SyntheticGA(500, seed=2).rows(0, 500))
+
+    def test_follows_next_links(self):
+        ga = SyntheticGA(25, page_size=10)
+        response = QueryResponse(
+            ga, ga.get_raw_response(start_index=1),
+            ['uniquePageViews'], ['pagePath', 'pageTitle'], max_results=None)
+        rows = list(response)
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['dimensions']['pagePath'], '/')
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_and_compare(self):
+        results = run_benchmarks([200], repeat=1, log=lambda line: None)
+        self.assertEqual(
+            sorted(results), sorted(name for name, _ in BENCHMARKS))
+        for sizes in results.values():
+            self.assertTrue(sizes['200']['peak_bytes'] > 0)
+
+        base = {'revision': 'a', 'results': results}
+        slower = {'revision': 'b', 'results': {
+            'page_traffic': {'200': dict(
+                results['page_traffic']['200'],
+                best_seconds=results['page_traffic']['200'][
+                    'best_seconds'] * 2)},
+        }}
+        report, regressions = compare(base, slower, max_slowdown=1.5)
+        self.assertEqual(regressions, [('page_traffic', '200')])
+        self.assertIn('SLOWER', report)
@@ -0,0 +1,236 @@
+import asyncio
+import datetime
+import gzip
+import json
+import unittest
+import urllib.parse
+
+from gapy.async_client import AsyncioTransport, AsyncQueryClient
+from gapy.error import GapyError, GapyHttpError
+
+
+class FakeGAServer(object):
+    """A local stand-in for the GA data API.
+
+    Serves `total_results` rows, one per result index, in pages of
+    `page_size` rows, over keep-alive HTTP/1.1 connections.
+    """
+    def __init__(self, total_results=5, page_size=2, delay=0.0,
+                 chunked=False):
+        self.total_results = total_results
+        self.page_size = page_size
+        self.delay = delay
+        self.chunked = chunked
+        self.status = 200
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:%d/analytics/v3/data/ga" % port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                target = request_line.decode().split()[1]
+                self.requests.append((target, headers))
+
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                await asyncio.sleep(self.delay)
+                self.in_flight -= 1
+
+                writer.write(self.response(target))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def response(self, target):
+        if self.status != 200:
+            body = json.dumps({"error": {"code": self.status}}).encode()
+            return (
+                "HTTP/1.1 %d Error\r\nContent-Length: %d\r\n\r\n" % (
+                    self.status, len(body))
+            ).encode() + body
+
+        query = dict(urllib.parse.parse_qsl(
+            urllib.parse.urlsplit(target).query))
+        start = int(query.get("start-index", 1))
+        end = min(start + self.page_size, self.total_results + 1)
+        data = {
+            "query": {
+                "start-date": query["start-date"],
+                "end-date": query["end-date"],
+            },
+            "totalResults": self.total_results,
+            "rows": [["/%d" % i, str(i)] for i in range(start, end)],
+        }
+        if end <= self.total_results:
+            next_query = dict(query, **{"start-index": str(end)})
+            data["nextLink"] = "%s?%s" % (
+                self.url, urllib.parse.urlencode(next_query))
+        body = gzip.compress(json.dumps(data).encode())
+
+        head = "HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n"
+        if not self.chunked:
+            return (
+                head + "Content-Length: %d\r\n\r\n" % len(body)
+            ).encode() + body
+        half = len(body) // 2
+        return (head + "Transfer-Encoding: chunked\r\n\r\n").encode() + (
+            b"%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n" % (
+                half, body[:half], len(body) - half, body[half:]))
+
+
+class FakeToken(object):
+    access_token = "secret"
+
+
+class FakeCredentials(object):
+    def get_access_token(self):
+        return FakeToken()
+
+
+class TestAsyncQueryClient(unittest.IsolatedAsyncioTestCase):
+    async def client(self, server, **kwargs):
+        await server.start()
+        self.addAsyncCleanup(server.stop)
+        client = AsyncQueryClient(data_url=server.url, **kwargs)
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def query(self, client, **kwargs):
+        return await client.get(
+            "12345", datetime.date(2020, 1, 1), datetime.date(2020, 1, 1),
+            "pageviews", "pagePath", **kwargs)
+
+    async def test_paginates(self):
+        server = FakeGAServer(total_results=5)
+        client = await self.client(server)
+        response = await self.query(client)
+        rows = [row async for row in response]
+        self.assertEqual(
+            [row["dimensions"]["pagePath"] for row in rows],
+            ["/1", "/2", "/3", "/4", "/5"])
+        self.assertEqual(rows[0]["metrics"], {"pageviews": "1"})
+        self.assertEqual(rows[0]["start_date"], datetime.date(2020, 1, 1))
+        self.assertEqual(len(server.requests), 3)
+        # Pages were all requested over the same connection.
+        self.assertEqual(server.connections, 1)
+
+        target = urllib.parse.urlsplit(server.requests[0][0])
+        self.assertEqual(dict(urllib.parse.parse_qsl(target.query)), {
+            "ids": "ga:12345",
+            "start-date": "2020-01-01",
+            "end-date": "2020-01-01",
+            "metrics": "ga:pageviews",
+            "dimensions": "ga:pagePath",
+        })
+
+    async def test_batches_from_chunked_response(self):
+        server = FakeGAServer(total_results=3, chunked=True)
+        client = await self.client(server)
+        response = await self.query(client)
+        batches = [batch async for batch in response.aiter_batches()]
+        self.assertEqual(
+            [batch["metrics"]["pageviews"] for batch in batches],
+            [["1", "2"], ["3"]])
+
+    async def test_honours_max_results(self):
+        server = FakeGAServer(total_results=5)
+        client = await self.client(server)
+        response = await self.query(client, max_results=2)
+        rows = [row async for row in response]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(len(server.requests), 1)
+
+    async def test_many_queries_in_flight(self):
+        server = FakeGAServer(total_results=1, delay=0.05)
+        client = await self.client(
+            server, transport=AsyncioTransport(max_connections=8))
+        responses = await asyncio.gather(*[
+            self.query(client) for _ in range(20)
+        ])
+        self.assertEqual(len(responses), 20)
+        self.assertEqual(server.max_in_flight, 8)
+        self.assertEqual(server.connections, 8)
+
+    async def test_authorisation(self):
+        server = FakeGAServer()
+        client = await self.client(server, credentials=FakeCredentials())
+        await self.query(client)
+        headers = server.requests[0][1]
+        self.assertEqual(headers["authorization"], "Bearer secret")
+
+    async def test_ga_hook(self):
+        calls = []
+        server = FakeGAServer()
+        client = await self.client(server, ga_hook=calls.append)
+        await self.query(client)
+        self.assertEqual(calls[0]["ids"], "ga:12345")
+
+    async def test_error_status(self):
+        server = FakeGAServer()
+        server.status = 403
+        client = await self.client(server)
+        with self.assertRaises(GapyHttpError) as cm:
+            await self.query(client)
+        self.assertEqual(cm.exception.status, 403)
+
+
+class TestAsyncioTransportLoops(unittest.TestCase):
+    """
+    Testing that a transport is only used on one event loop at a time
+    """
+    def run_query(self, transport):
+        async def query():
+            server = FakeGAServer()
+            await server.start()
+            try:
+                status, _, _ = await transport.request(
+                    "GET", server.url + "?start-date=x&end-date=x")
+                await transport.close()
+                return status
+            finally:
+                await server.stop()
+        return asyncio.run(query())
+
+    def test_reused_on_new_loop_after_close(self):
+        transport = AsyncioTransport()
+        self.assertEqual(self.run_query(transport), 200)
+        self.assertEqual(self.run_query(transport), 200)
+
+    def test_other_loop_refused_until_closed(self):
+        transport = AsyncioTransport()
+
+        async def refused():
+            # Binds the transport to this loop, without leaving a
+            # connection open.
+            server = FakeGAServer()
+            await server.start()
+            await server.stop()
+            with self.assertRaises(OSError):
+                await transport.request("GET", server.url)
+        asyncio.run(refused())
+
+        with self.assertRaisesRegex(GapyError, "different event loop"):
+            self.run_query(transport)
@@ -0,0 +1,202 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from googleapiclient.http import HttpMockSequence
+
+import gapy.client
+from gapy.client import Client, _build, _cached_discovery_document
+
+
+class FakeCredentials(object):
+    def __init__(self, token="token", authorized=None):
+        self.token = token
+        self.authorized = [] if authorized is None else authorized
+
+    def authorize(self, http):
+        self.authorized.append(http)
+        return http
+
+    def to_json(self):
+        return json.dumps({"token": self.token})
+
+
+class TestBuild(unittest.TestCase):
+    def test_builds_service_from_discovery_document(self):
+        service = _build(FakeCredentials(), "v3")
+        self.assertTrue(hasattr(service.data().ga(), "get"))
+
+    def test_discovery_document_loaded_once(self):
+        with patch.dict(gapy.client._discovery_documents, clear=True), \
+                patch("gapy.client._static_discovery_document",
+                      wraps=gapy.client._static_discovery_document) as load:
+            _build(FakeCredentials(), "v3")
+            _build(FakeCredentials(), "v3")
+        self.assertEqual(load.call_count, 1)
+
+    def test_http_shared_on_a_thread_for_a_storage_path(self):
+        authorized = []
+
+        def build(token="token", path="storage.json"):
+            _build(FakeCredentials(token, authorized), "v3",
+                   storage_path=path)
+
+        with patch("gapy.client._local", threading.local()):
+            build()
+            build()
+            self.assertEqual(len(authorized), 1)
+
+            other_thread = threading.Thread(target=build)
+            other_thread.start()
+            other_thread.join()
+            self.assertEqual(len(authorized), 2)
+            self.assertIsNot(authorized[0], authorized[1])
+
+            build(path="other.json")
+            self.assertEqual(len(authorized), 3)
+            # Replaced credentials get a client of their own.
+            build(token="new token")
+            self.assertEqual(len(authorized), 4)
+            build(token="new token")
+            self.assertEqual(len(authorized), 4)
+
+    def test_http_not_shared_without_storage_path(self):
+        credentials = FakeCredentials()
+        _build(credentials, "v3")
+        _build(credentials, "v3")
+        self.assertEqual(len(credentials.authorized), 2)
+
+    def test_given_http_client_is_used(self):
+        credentials = FakeCredentials()
+        http_client = Mock()
+        _build(credentials, "v3", http_client)
+        self.assertEqual(credentials.authorized, [http_client])
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patcher = patch.dict(
+            os.environ, {"GAPY_DISCOVERY_CACHE": self.cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.http = Mock()
+        self.http.request = Mock(
+            return_value=(Mock(status=200), b'{"name": "analytics"}'))
+        patcher = patch("httplib2.Http", return_value=self.http)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetched_then_read_from_disk(self):
+        for _ in range(2):
+            self.assertEqual(
+                _cached_discovery_document("v3"),
+                '{"name": "analytics"}')
+        self.assertEqual(self.http.request.call_count, 1)
+        self.assertEqual(
+            os.listdir(self.cache_dir), ["analytics.v3.json"])
+
+    def test_refetched_when_expired(self):
+        _cached_discovery_document("v3")
+        path = os.path.join(self.cache_dir, "analytics.v3.json")
+        old = os.path.getmtime(path) - gapy.client.DISCOVERY_CACHE_TTL - 1
+        os.utime(path, (old, old))
+        _cached_discovery_document("v3")
+        self.assertEqual(self.http.request.call_count, 2)
+
+    def test_fetch_error(self):
+        self.http.request.return_value = (Mock(status=404), b"")
+        with self.assertRaises(gapy.client.GapyError):
+            _cached_discovery_document("v3")
+
+
+def batch_response(parts, first_id=0):
+    """Build a multipart batch response from (status, body) pairs."""
+    lines = []
+    for index, (status, body) in enumerate(parts, first_id):
+        content = json.dumps(body)
+        lines.extend([
+            "--batch_boundary",
+            "Content-Type: application/http",
+            "Content-ID: <response-base + %d>" % index,
+            "",
+            "HTTP/1.1 %d Status" % status,
+            "Content-Type: application/json",
+            "Content-Length: %d" % len(content),
+            "",
+            content,
+        ])
+    lines.append("--batch_boundary--")
+    return (
+        {"status": "200",
+         "content-type": "multipart/mixed; boundary=batch_boundary"},
+        "\r\n".join(lines).encode("utf-8"),
+    )
+
+
+def page(value):
+    return {
+        "query": {"start-date": "2020-01-01", "end-date": "2020-01-01"},
+        "rows": [["/path", value]],
+    }
+
+
+class TestQueryBatch(unittest.TestCase):
+    def client(self, *responses):
+        self.http = HttpMockSequence(list(responses))
+        return Client(_build(FakeCredentials(), "v3", self.http))
+
+    def test_batch(self):
+        client = self.client(batch_response([
+            (200, page("1")),
+            (200, page("2")),
+            (403, {"error": {"code": 403, "message": "denied"}}),
+        ]))
+        callbacks = []
+        batch = client.query.batch()
+        batch.get("1", datetime.date(2020, 1, 1), datetime.date(2020, 1, 1),
+                  "pageviews", "pagePath")
+        batch.get_raw_response(
+            callback=lambda response, error: callbacks.append(response),
+            ids="ga:1", start_date="2020-01-01", end_date="2020-01-01",
+            metrics="ga:pageviews")
+        batch.get_raw_response(
+            ids="ga:2", start_date="2020-01-01", end_date="2020-01-01",
+            metrics="ga:pageviews")
+        self.assertEqual(len(batch), 3)
+        results = batch.execute()
+
+        # All three queries went in one request.
+        self.assertEqual(len(self.http.request_sequence), 1)
+        response, error = results[0]
+        self.assertIsNone(error)
+        self.assertEqual(
+            [row["dimensions"]["pagePath"] for row in response],
+            ["/path"])
+        self.assertEqual(results[1], (page("2"), None))
+        self.assertEqual(callbacks, [page("2")])
+        response, error = results[2]
+        self.assertIsNone(response)
+        self.assertEqual(error.resp.status, 403)
+
+    def test_split_into_batches_of_ten(self):
+        client = self.client(
+            batch_response([(200, page(str(i))) for i in range(10)]),
+            batch_response([(200, page("10"))], first_id=10),
+        )
+        batch = client.query.batch()
+        for i in range(11):
+            batch.get_raw_response(
+                ids="ga:%d" % i, start_date="2020-01-01",
+                end_date="2020-01-01", metrics="ga:pageviews")
+        results = batch.execute()
+        self.assertEqual(len(self.http.request_sequence), 2)
+        self.assertEqual(
+            [response["rows"][0][1] for response, _ in results],
+            [str(i) for i in range(11)])
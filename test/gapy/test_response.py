@@ -0,0 +1,185 @@
+import datetime
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from gapy.response import QueryResponse
+
+
+def raw_response(rows, next_link=None):
+    response = {
+        "query": {"start-date": "2020-01-01", "end-date": "2020-01-02"},
+        "rows": rows,
+    }
+    if next_link:
+        response["nextLink"] = next_link
+    return response
+
+
+NEXT_LINK = (
+    "https://www.googleapis.com/analytics/v3/data/ga"
+    "?ids=ga:1&start-date=2020-01-01&end-date=2020-01-02"
+    "&metrics=ga:pageviews&dimensions=ga:date,ga:hour&start-index=3"
+)
+
+
+class TestQueryResponse(unittest.TestCase):
+    def setUp(self):
+        self.service = Mock()
+        self.service.get_raw_response = Mock(return_value=raw_response([
+            ["20200102", "00", "5"],
+        ]))
+        self.response = QueryResponse(
+            self.service,
+            raw_response([
+                ["20200101", "00", "3"],
+                ["20200101", "01", "4"],
+            ], next_link=NEXT_LINK),
+            ["pageviews"], ["date", "hour"], max_results=None,
+        )
+
+    def test_columns(self):
+        self.assertEqual(self.response.columns(), {
+            "metrics": {"pageviews": ["3", "4"]},
+            "start_date": datetime.date(2020, 1, 1),
+            "end_date": datetime.date(2020, 1, 2),
+            "dimensions": {
+                "date": ["20200101", "20200101"],
+                "hour": ["00", "01"],
+                "datetime": [
+                    datetime.datetime(2020, 1, 1, 0),
+                    datetime.datetime(2020, 1, 1, 1),
+                ],
+            },
+        })
+
+    def test_columns_of_empty_page(self):
+        response = QueryResponse(
+            self.service, raw_response([]), ["pageviews"], ["pagePath"],
+            max_results=None)
+        columns = response.columns()
+        self.assertEqual(columns["metrics"], {"pageviews": []})
+        self.assertEqual(columns["dimensions"], {"pagePath": []})
+
+    def test_iter_batches_follows_next_link(self):
+        batches = list(self.response.iter_batches())
+        self.assertEqual(
+            [batch["metrics"]["pageviews"] for batch in batches],
+            [["3", "4"], ["5"]],
+        )
+        kwargs = self.service.get_raw_response.call_args[1]
+        self.assertEqual(kwargs["start_index"], "3")
+
+    def test_iter_batches_stops_at_max_results(self):
+        self.response._max_results = 2
+        batches = list(self.response.iter_batches())
+        self.assertEqual(len(batches), 1)
+        self.assertFalse(self.service.get_raw_response.called)
+
+    def test_iter_rows(self):
+        rows = list(self.response)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0], {
+            "metrics": {"pageviews": "3"},
+            "start_date": datetime.date(2020, 1, 1),
+            "end_date": datetime.date(2020, 1, 2),
+            "dimensions": {
+                "date": "20200101",
+                "hour": "00",
+                "datetime": datetime.datetime(2020, 1, 1, 0),
+            },
+        })
+        self.assertEqual(
+            rows[2]["dimensions"]["datetime"],
+            datetime.datetime(2020, 1, 2, 0))
+
+    def test_iter_rows_without_dimensions(self):
+        response = QueryResponse(
+            self.service, raw_response([["7", "8"]]),
+            ["pageviews", "sessions"], [], max_results=None)
+        self.assertEqual(list(response), [{
+            "metrics": {"pageviews": "7", "sessions": "8"},
+            "start_date": datetime.date(2020, 1, 1),
+            "end_date": datetime.date(2020, 1, 2),
+        }])
+
+
+def next_link(start_index):
+    return NEXT_LINK.replace("start-index=3", "start-index=%d" % start_index)
+
+
+class FakePagedService(object):
+    """Serves pages of one row each, recording which were requested."""
+    def __init__(self, pages, fail_at=None, delay=0.0):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.delay = delay
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def first_page(self):
+        return self.page(1)
+
+    def page(self, start_index):
+        rows = [["20200101", "00", str(start_index)]]
+        link = next_link(start_index + 1) if start_index < self.pages else None
+        return raw_response(rows, next_link=link)
+
+    def get_raw_response(self, **kwargs):
+        start_index = int(kwargs["start_index"])
+        with self.lock:
+            self.requested.append(start_index)
+        time.sleep(self.delay)
+        if start_index == self.fail_at:
+            raise RuntimeError("page %d failed" % start_index)
+        return self.page(start_index)
+
+
+class TestQueryResponsePrefetch(unittest.TestCase):
+    def response(self, service, prefetch, max_results=None):
+        return QueryResponse(
+            service, service.first_page(), ["pageviews"], ["date", "hour"],
+            max_results=max_results, prefetch=prefetch)
+
+    def test_same_rows_as_sequential(self):
+        service = FakePagedService(pages=5)
+        expected = list(self.response(service, prefetch=0))
+        rows = list(self.response(service, prefetch=2))
+        self.assertEqual(rows, expected)
+        self.assertEqual(
+            [row["metrics"]["pageviews"] for row in rows],
+            ["1", "2", "3", "4", "5"])
+
+    def test_lookahead_is_bounded(self):
+        service = FakePagedService(pages=10)
+        batches = self.response(service, prefetch=2).iter_batches()
+        next(batches)
+        time.sleep(0.2)
+        # Two pages queued, and at most one more fetched and waiting for
+        # room in the queue.
+        self.assertLessEqual(len(service.requested), 3)
+        batches.close()
+
+    def test_stopping_early_does_not_wait_for_fetch(self):
+        service = FakePagedService(pages=10, delay=2.0)
+        batches = self.response(service, prefetch=2).iter_batches()
+        next(batches)
+        time.sleep(0.1)
+        started = time.time()
+        batches.close()
+        self.assertLess(time.time() - started, 1.0)
+
+    def test_honours_max_results(self):
+        service = FakePagedService(pages=10)
+        rows = list(self.response(service, prefetch=4, max_results=3))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(service.requested, [2, 3])
+
+    def test_error_raised_when_page_reached(self):
+        service = FakePagedService(pages=5, fail_at=3)
+        batches = self.response(service, prefetch=2).iter_batches()
+        self.assertEqual(next(batches)["metrics"]["pageviews"], ["1"])
+        self.assertEqual(next(batches)["metrics"]["pageviews"], ["2"])
+        with self.assertRaises(RuntimeError):
+            next(batches)